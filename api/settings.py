@@ -45,11 +45,81 @@ INSTALLED_APPS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Imágenes en multipart/form-data: cada archivo va a un temporal mientras llega (nunca
+# entero en memoria) y se calcula su sha256 al mismo tiempo (cultural/uploads.py)
+FILE_UPLOAD_HANDLERS = ['cultural.uploads.HashingTemporaryFileUploadHandler']
+IMAGE_UPLOAD_MAX_BYTES = env.int('IMAGE_UPLOAD_MAX_BYTES', default=20 * 1024 * 1024)
+
 # OpenAI API Key (agregar a variables de entorno)
 OPENAI_API_KEY = env('OPENAI_API_KEY')
 OPENAI_MODEL = env('OPENAI_MODEL')
 OPENAI_MAX_TOKENS = 1000
 OPENAI_TIMEOUT = 30  # segundos
+OPENAI_API_URL = env('OPENAI_API_URL', default='https://api.openai.com/v1/chat/completions')
+OPENAI_POOL_SIZE = env.int('OPENAI_POOL_SIZE', default=10)  # conexiones keep-alive por proceso
+OPENAI_MAX_RETRIES = env.int('OPENAI_MAX_RETRIES', default=2)  # reintentos ante 429/5xx
+OPENAI_ASYNC_POOL_SIZE = env.int('OPENAI_ASYNC_POOL_SIZE', default=200)  # llamadas en vuelo (vista async/ASGI)
+# Circuito: se abre si en las últimas 20 llamadas fallan (429/5xx/timeout) o son lentas la mayoría
+OPENAI_CIRCUIT_FAILURE_RATE = env.float('OPENAI_CIRCUIT_FAILURE_RATE', default=0.5)
+OPENAI_CIRCUIT_SLOW_CALL_SECONDS = env.int('OPENAI_CIRCUIT_SLOW_CALL_SECONDS', default=20)
+OPENAI_CIRCUIT_OPEN_SECONDS = env.int('OPENAI_CIRCUIT_OPEN_SECONDS', default=30)  # antes de la llamada de prueba
+# Límite adaptativo de llamadas en vuelo por proceso (arranca en OPENAI_POOL_SIZE, o en
+# OPENAI_ASYNC_POOL_SIZE para la vista async, que tiene su propio límite)
+OPENAI_MAX_IN_FLIGHT = env.int('OPENAI_MAX_IN_FLIGHT', default=200)
+OPENAI_LATENCY_TARGET_SECONDS = env.int('OPENAI_LATENCY_TARGET_SECONDS', default=15)  # más lento reduce el límite
+OPENAI_QUEUE_TIMEOUT = env.int('OPENAI_QUEUE_TIMEOUT', default=5)  # espera por un cupo antes de responder 503
+
+# Búsqueda en la base local: 'base_conocimiento_local_v2' (título), 'tfidf_ngramas_v1'
+# o 'embeddings_locales_v1' (embeddings en cultural/data/embeddings/, sin API externa)
+LOCAL_VALIDATION_METHOD = env('LOCAL_VALIDATION_METHOD', default='base_conocimiento_local_v2')
+
+# Dos etapas: una llamada corta clasifica la imagen y el análisis lleva solo los
+# ejemplos de esa categoría y sus vecinas (menos tokens de entrada, una llamada más)
+ANALYSIS_TWO_STAGE = env.bool('ANALYSIS_TWO_STAGE', default=False)
+
+# Ejemplos few-shot por presupuesto de tokens (mensaje de sistema + prompt, sin la
+# imagen); 0 = los MAX_FEWSHOT_EJEMPLOS de siempre. Conteo con tiktoken si está instalado
+ANALYSIS_PROMPT_TOKEN_BUDGET = env.int('ANALYSIS_PROMPT_TOKEN_BUDGET', default=0)
+
+# Salida estructurada: se envía el JSON schema del análisis (response_format strict) y la
+# respuesta se valida sin el parser tolerante, que queda solo para cuando el modelo no lo respeta
+ANALYSIS_STRUCTURED_OUTPUT = env.bool('ANALYSIS_STRUCTURED_OUTPUT', default=False)
+
+# Preparación de la imagen antes de enviarla a OpenAI
+ANALYSIS_IMAGE_MAX_SIDE = env.int('ANALYSIS_IMAGE_MAX_SIDE', default=1024)  # px del lado mayor
+ANALYSIS_IMAGE_FORMAT = env('ANALYSIS_IMAGE_FORMAT', default='JPEG')  # 'JPEG' o 'WEBP'
+ANALYSIS_IMAGE_QUALITY = env.int('ANALYSIS_IMAGE_QUALITY', default=85)
+ANALYSIS_IMAGE_LOW_DETAIL_MAX_SIDE = env.int('ANALYSIS_IMAGE_LOW_DETAIL_MAX_SIDE', default=512)  # hasta aquí detail=low
+
+# Caché de análisis por nivel: entradas y TTL (segundos)
+ANALYSIS_CACHE_LOCAL_MAX_ENTRIES = env.int('ANALYSIS_CACHE_LOCAL_MAX_ENTRIES', default=512)
+ANALYSIS_CACHE_LOCAL_TTL = env.int('ANALYSIS_CACHE_LOCAL_TTL', default=600)
+ANALYSIS_CACHE_SHARED_TTL = env.int('ANALYSIS_CACHE_SHARED_TTL', default=86400)
+ANALYSIS_CACHE_DB_TTL = env.int('ANALYSIS_CACHE_DB_TTL', default=30 * 86400)  # antigüedad máxima de AnalysisRecord reutilizable
+ANALYSIS_RECORD_MAX_QUEUE = env.int('ANALYSIS_RECORD_MAX_QUEUE', default=1000)  # registros pendientes de escribir
+
+# Caché de casi-duplicados por hash perceptual (bits de diferencia de 64; -1 la desactiva)
+ANALYSIS_NEAR_DUPLICATE_DISTANCE = env.int('ANALYSIS_NEAR_DUPLICATE_DISTANCE', default=8)
+ANALYSIS_NEAR_DUPLICATE_MAX_ENTRIES = env.int('ANALYSIS_NEAR_DUPLICATE_MAX_ENTRIES', default=10000)
+
+# Peticiones simultáneas de la misma imagen esperan a la primera (candado en 'analysis_shared')
+ANALYSIS_COALESCE_TIMEOUT = env.int('ANALYSIS_COALESCE_TIMEOUT', default=0)  # espera máxima por la líder (0 = su presupuesto de reintentos)
+
+# Cola de análisis en segundo plano (/analyze/jobs)
+ANALYSIS_JOB_WORKERS = env.int('ANALYSIS_JOB_WORKERS', default=4)  # análisis simultáneos por proceso
+ANALYSIS_JOB_MAX_QUEUE = env.int('ANALYSIS_JOB_MAX_QUEUE', default=100)  # trabajos en cola antes de responder 503
+ANALYSIS_JOB_RESULT_TTL = env.int('ANALYSIS_JOB_RESULT_TTL', default=3600)  # segundos que se guarda el resultado
+ANALYSIS_JOB_MAINTENANCE_INTERVAL = env.int('ANALYSIS_JOB_MAINTENANCE_INTERVAL', default=60)  # segundos entre recuperaciones (0 = desactivado)
+ANALYSIS_JOB_STALE_AFTER = env.int('ANALYSIS_JOB_STALE_AFTER', default=0)  # segundos "procesando" para reencolar (0 = presupuesto de OpenAI + margen)
+
+# Análisis por lotes (/analyze/batch)
+ANALYSIS_BATCH_MAX_IMAGES = env.int('ANALYSIS_BATCH_MAX_IMAGES', default=50)
+ANALYSIS_BATCH_CONCURRENCY = env.int('ANALYSIS_BATCH_CONCURRENCY', default=8)  # llamadas a OpenAI a la vez por lote
+
+# Métricas de Prometheus (/metrics): cada worker vuelca las suyas a METRICS_DIR y
+# /metrics las suma (se vacía solo al arrancar un master nuevo). Vacío = solo el proceso que responde
+METRICS_DIR = env('METRICS_DIR', default='/tmp/cultural_metrics')
+METRICS_FLUSH_INTERVAL = env.int('METRICS_FLUSH_INTERVAL', default=5)  # segundos
 
 # Limites de uso de la API de OpenAI
 ANALYSIS_RATE_LIMIT = '10/hour'  # 10 analisis por hora por usuarios autenticados
@@ -59,6 +129,7 @@ GOOGLE_CLIENT_ID = env('GOOGLE_CLIENT_ID')
 
 
 MIDDLEWARE = [
+    'cultural.middleware.metrics_middleware',  # primero: mide la petición completa
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -155,6 +226,14 @@ DATABASES = {
     }
 }
 
+# Cachés. Los análisis usan tres niveles (ver cultural/cache.py): LRU del proceso,
+# 'analysis_shared' (compartida entre workers; en producción redis://...) y la
+# tabla AnalysisRecord (persistente)
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+    'analysis_shared': env.cache('ANALYSIS_CACHE_URL', default='filecache:///tmp/cultural_analysis_cache'),
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -3,11 +3,13 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from cultural.views import get_metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/auth/', include('authentication.urls')),
     path('api/cultural/', include('cultural.urls')),  
+    path('metrics', get_metrics, name='metrics'),  # Admin only (Prometheus)
 ]
 
 # Servir archivos media en desarrollo
@@ -1,6 +1,6 @@
 # cultural/admin.py
 from django.contrib import admin
-from .models import CulturalItem, CulturalAnalysisLog, CulturalReport
+from .models import AnalysisJob, AnalysisRecord, CulturalItem, CulturalAnalysisLog, CulturalReport
 
 @admin.register(CulturalItem)
 class CulturalItemAdmin(admin.ModelAdmin):
@@ -104,4 +104,21 @@ class CulturalReportAdmin(admin.ModelAdmin):
         
         self.message_user(request, f'{rejected} reportes rechazados.')
     
-    reject_reports.short_description = "Rechazar reportes seleccionados"
\ No newline at end of file
+    reject_reports.short_description = "Rechazar reportes seleccionados"
+
+
+@admin.register(AnalysisJob)
+class AnalysisJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'status', 'attempts', 'created_by', 'created_at', 'finished_at']
+    list_filter = ['status', 'created_at']
+    readonly_fields = ['created_at', 'started_at', 'finished_at', 'expires_at']
+    exclude = ['image_base64']
+
+
+@admin.register(AnalysisRecord)
+class AnalysisRecordAdmin(admin.ModelAdmin):
+    list_display = ['content_hash', 'model', 'prompt_version', 'success', 'total_tokens',
+                    'api_cost', 'processing_time', 'created_at']
+    list_filter = ['success', 'model', 'prompt_version', 'created_at']
+    search_fields = ['content_hash', 'error']
+    readonly_fields = ['created_at']
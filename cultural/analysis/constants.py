@@ -1,3 +1,10 @@
-PROMPT_VERSION = "2.1"        # tracking - Aumentados ejemplos few-shot
+PROMPT_VERSION = "2.2"        # tracking - Ejemplos few-shot al final (prefijo cacheable)
 MIN_CONFIDENCE_THRESHOLD = 0.65
-MAX_FEWSHOT_EJEMPLOS = 30  # Aumentado de 10 a 30 para mejor cobertura cultural
\ No newline at end of file
+MAX_FEWSHOT_EJEMPLOS = 30  # Aumentado de 10 a 30 para mejor cobertura cultural
+
+# Mensaje de sistema de cada llamada (fuerza JSON puro)
+SYSTEM_MESSAGE = (
+    "Eres un analista cultural experto en Huánuco, Perú. "
+    "Responde únicamente con un JSON válido y bien formado, sin texto adicional, sin markdown, "
+    "sin explicaciones ni comentarios fuera del JSON."
+)
@@ -0,0 +1,216 @@
+"""
+Embeddings locales (sin API externa) para búsqueda semántica en la base de conocimiento.
+
+Cada elemento se representa con sus palabras y trigramas de caracteres, proyectados
+a EMBEDDING_DIM dimensiones con una proyección aleatoria dispersa basada en hashing
+(cada rasgo suma ±peso en HASHES_PER_FEATURE dimensiones). Al no depender de
+estadísticas globales (idf), la fila de un elemento solo depende de su contenido:
+agregar un elemento no obliga a recalcular los demás.
+
+Las filas se guardan en un .npy float32 que se abre con memory-map; el manifiesto
+asocia cada fila al hash del contenido de su elemento. Si solo se agregaron elementos
+al final, las filas nuevas se escriben al final del .npy (numpy deja espacio en la
+cabecera para que crezca el primer eje) en vez de reescribirlo entero.
+"""
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import re
+import threading
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .knowledge import DATA_DIR
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_VERSION = "hash-rp-1"  # cambiarlo invalida los embeddings guardados
+EMBEDDING_DIM = 256
+HASHES_PER_FEATURE = 4
+FIELD_WEIGHTS = {'titulo': 2.0, 'descripcion': 1.0, 'contexto_cultural': 1.0}
+
+EMBEDDINGS_DIR = DATA_DIR / "embeddings"
+EMBEDDINGS_FILE = EMBEDDINGS_DIR / "elementos_huanuco.npy"
+MANIFEST_FILE = EMBEDDINGS_DIR / "elementos_huanuco.manifest.json"
+
+_write_lock = threading.Lock()  # una sola escritura del .npy a la vez en el proceso
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+_STOPWORDS = {
+    'de', 'la', 'el', 'en', 'y', 'los', 'las', 'del', 'con', 'un', 'una', 'por', 'para',
+    'que', 'se', 'su', 'sus', 'al', 'es', 'o', 'a', 'como', 'lo', 'más', 'e',
+}
+
+
+def _features(doc: Mapping) -> Counter:
+    feats = Counter()
+    for field, weight in FIELD_WEIGHTS.items():
+        for w in _WORD.findall(str(doc.get(field) or '').lower()):
+            if w in _STOPWORDS:
+                continue
+            feats['w:' + w] += weight
+            padded = f" {w} "
+            for i in range(len(padded) - 2):
+                feats['c:' + padded[i:i + 3]] += weight * 0.5
+    return feats
+
+
+def embed(doc: Mapping) -> np.ndarray:
+    """Vector unitario float32 del documento (titulo/descripcion/contexto_cultural)."""
+    v = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for feat, tf in _features(doc).items():
+        w = 1.0 + math.log(tf) if tf >= 1 else tf
+        data = feat.encode('utf-8')
+        for seed in range(HASHES_PER_FEATURE):
+            h = zlib.crc32(data, seed)
+            v[h % EMBEDDING_DIM] += -w if h & 0x80000000 else w
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm else v
+
+
+def content_hash(elem: Mapping) -> str:
+    fields = {k: elem.get(k) for k in FIELD_WEIGHTS}
+    raw = json.dumps(fields, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()
+
+
+class EmbeddingIndex:
+    """Matriz (N, EMBEDDING_DIM) alineada con los elementos del snapshot."""
+
+    def __init__(self, matrix: np.ndarray, reused: int = 0, computed: int = 0):
+        self.matrix = matrix
+        self.reused = reused
+        self.computed = computed
+
+    @classmethod
+    def for_elements(cls, elementos: Sequence[Mapping], path: Path = EMBEDDINGS_FILE,
+                     manifest_path: Path = MANIFEST_FILE) -> "EmbeddingIndex":
+        """
+        Abre el .npy con memory-map y lo sincroniza con `elementos`: las filas cuyo
+        contenido no cambió se reutilizan y solo se calculan las nuevas o editadas.
+        """
+        hashes = [content_hash(e) for e in elementos]
+        stored, stored_hashes = cls._load(path, manifest_path)
+        if stored is not None and stored_hashes == hashes:
+            return cls(stored, reused=len(hashes))
+        if stored is not None and hashes[:len(stored_hashes)] == stored_hashes:
+            del stored
+            index = cls._append(elementos, hashes, path, manifest_path)
+            if index is not None:
+                return index
+            stored, stored_hashes = cls._load(path, manifest_path)
+
+        previous = {h: i for i, h in enumerate(stored_hashes)} if stored is not None else {}
+        matrix = np.empty((len(elementos), EMBEDDING_DIM), dtype=np.float32)
+        reused = computed = 0
+        for i, (elem, h) in enumerate(zip(elementos, hashes)):
+            j = previous.get(h)
+            if j is not None:
+                matrix[i] = stored[j]
+                reused += 1
+            else:
+                matrix[i] = embed(elem)
+                computed += 1
+        del stored
+        logger.info(f"Embeddings sincronizados: {reused} reutilizados, {computed} calculados")
+
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with _write_lock:
+                tmp = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npy")
+                np.save(tmp, matrix)
+                os.replace(tmp, path)
+                cls._write_manifest(manifest_path, hashes)
+            matrix = np.load(path, mmap_mode='r')
+        except OSError as e:
+            logger.warning(f"No se pudieron guardar los embeddings: {e}")
+        return cls(matrix, reused=reused, computed=computed)
+
+    @classmethod
+    def _append(cls, elementos: Sequence[Mapping], hashes: List[str], path: Path,
+                manifest_path: Path) -> Optional["EmbeddingIndex"]:
+        """Escribe al final del .npy solo las filas que faltan. None si lo guardado ya no es prefijo."""
+        with _write_lock:
+            stored, stored_hashes = cls._load(path, manifest_path)  # otro hilo pudo escribir antes
+            n = len(stored_hashes)
+            if stored is None or hashes[:n] != stored_hashes:
+                return None
+            del stored
+            if n < len(hashes):
+                rows = np.stack([embed(e) for e in elementos[n:]])
+                try:
+                    _append_rows(path, n, rows)
+                    cls._write_manifest(manifest_path, hashes)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"No se pudieron agregar embeddings, se reescriben: {e}")
+                    return None
+        logger.info(f"Embeddings agregados: {n} reutilizados, {len(hashes) - n} calculados")
+        return cls(np.load(path, mmap_mode='r')[:len(hashes)], reused=n, computed=len(hashes) - n)
+
+    @staticmethod
+    def _write_manifest(manifest_path: Path, hashes: List[str]) -> None:
+        manifest_tmp = manifest_path.with_name(f"{manifest_path.name}.{os.getpid()}.tmp")
+        manifest_tmp.write_text(json.dumps({
+            'version': EMBEDDING_VERSION, 'dim': EMBEDDING_DIM, 'hashes': hashes,
+        }), encoding='utf-8')
+        os.replace(manifest_tmp, manifest_path)
+
+    @staticmethod
+    def _load(path: Path, manifest_path: Path):
+        try:
+            manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+            if manifest.get('version') != EMBEDDING_VERSION or manifest.get('dim') != EMBEDDING_DIM:
+                return None, []
+            matrix = np.load(path, mmap_mode='r')
+            n = len(manifest['hashes'])
+            # filas de más: un agregado que aún no escribió (o no llegó a escribir) el manifiesto
+            if matrix.ndim != 2 or matrix.shape[1] != EMBEDDING_DIM or matrix.shape[0] < n:
+                return None, []
+            return matrix[:n], manifest['hashes']
+        except FileNotFoundError:
+            return None, []
+        except Exception as e:
+            logger.warning(f"Embeddings guardados inválidos, se recalculan: {e}")
+            return None, []
+
+    def top_k(self, doc: Mapping, k: int = 5) -> List[Tuple[int, float]]:
+        """(índice, similitud coseno) de los k elementos más parecidos, de mayor a menor."""
+        if not len(self.matrix):
+            return []
+        scores = self.matrix @ embed(doc)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((top, -scores[top]))]  # orden estable ante empates
+        return [(int(i), float(scores[i])) for i in top]
+
+
+def _append_rows(path: Path, n: int, rows: np.ndarray) -> None:
+    """Escribe `rows` desde la fila `n` del .npy y actualiza la forma en la cabecera, en el lugar."""
+    fmt = np.lib.format
+    with open(path, 'r+b') as f:
+        version = fmt.read_magic(f)
+        read_header = fmt.read_array_header_1_0 if version == (1, 0) else fmt.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+        if fortran_order or dtype != np.float32 or shape[1:] != (EMBEDDING_DIM,) or shape[0] < n:
+            raise ValueError(f"formato inesperado: {shape} {dtype}")
+        header = io.BytesIO()
+        write_header = fmt.write_array_header_1_0 if version == (1, 0) else fmt.write_array_header_2_0
+        write_header(header, {'descr': fmt.dtype_to_descr(dtype), 'fortran_order': False,
+                              'shape': (n + len(rows), EMBEDDING_DIM)})
+        if header.tell() != offset:
+            # numpy reserva dígitos para que crezca el primer eje: no debería pasar
+            raise ValueError("la cabecera del .npy cambiaría de tamaño")
+        f.seek(offset + n * EMBEDDING_DIM * dtype.itemsize)
+        f.write(np.ascontiguousarray(rows, dtype=np.float32).tobytes())
+        f.flush()
+        os.fsync(f.fileno())  # las filas antes que la cabecera que las cuenta
+        f.seek(0)
+        f.write(header.getvalue())
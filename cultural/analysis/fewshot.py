@@ -0,0 +1,99 @@
+"""
+Selección de ejemplos few-shot por presupuesto de tokens.
+
+En vez de un número fijo de ejemplos con la descripción cortada a 180
+caracteres, se eligen en rondas (uno por categoría en cada ronda, para que
+todas tengan representación) hasta que el siguiente ya no entra en el
+presupuesto. Dentro de cada categoría el siguiente es el de mejor puntaje MMR:
+- representativo: parecido al centroide de su categoría (embeddings locales)
+  y con alta confianza de referencia;
+- variado: se penaliza el parecido con los ya elegidos de su categoría.
+Con la misma base y el mismo presupuesto el resultado es siempre el mismo.
+"""
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+
+from .embeddings import embed
+from .knowledge import format_example, get_hardcoded_examples
+
+MMR_LAMBDA = 0.7               # peso de la representatividad frente a la variedad
+CANDIDATES_PER_CATEGORY = 50   # los de mayor confianza; acota el costo con bases grandes
+DESCRIPCION_MAX_TOKENS = 60
+
+
+def clip_to_tokens(text: str, max_tokens: int, count: Callable[[str], int]) -> str:
+    """`text` completo si entra en `max_tokens`; si no, cortado entre palabras y con '...'."""
+    if count(text) <= max_tokens:
+        return text
+    words = text.split()
+    lo, hi = 0, len(words)
+    while lo < hi:  # más palabras que entran
+        mid = (lo + hi + 1) // 2
+        if count(' '.join(words[:mid]) + '...') <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return ' '.join(words[:lo]) + '...'
+
+
+def _ranked(items: Sequence, vectors: np.ndarray) -> List[int]:
+    """Orden MMR de los índices de `items` (todos de la misma categoría)."""
+    centroid = vectors.mean(axis=0)
+    norm = np.linalg.norm(centroid)
+    relevance = vectors @ (centroid / norm) if norm else np.zeros(len(items))
+    relevance = relevance + np.array([float(it.get('confianza', 0.8)) for it in items]) * 0.5
+
+    order, remaining = [], list(range(len(items)))
+    max_sim = np.zeros(len(items))
+    while remaining:
+        best = max(remaining, key=lambda i: (MMR_LAMBDA * relevance[i] - (1 - MMR_LAMBDA) * max_sim[i], -i))
+        order.append(best)
+        remaining.remove(best)
+        max_sim = np.maximum(max_sim, vectors @ vectors[best])
+    return order
+
+
+def select_examples(elementos: Sequence, budget_tokens: int, count: Callable[[str], int],
+                    max_examples: int) -> Dict[str, List[str]]:
+    """categoría -> bloques de ejemplos elegidos, en el orden de aparición de las categorías."""
+    por_cat: Dict[str, list] = {}
+    for e in elementos:
+        por_cat.setdefault(e.get('categoria', 'General'), []).append(e)
+
+    colas = {}
+    for cat, items in por_cat.items():
+        items = sorted(items, key=lambda e: -float(e.get('confianza', 0.8)))[:CANDIDATES_PER_CATEGORY]
+        vectors = np.stack([embed(e) for e in items])
+        colas[cat] = [items[i] for i in _ranked(items, vectors)]
+
+    elegidos = {cat: [] for cat in por_cat}
+    used, total = 0, 0
+    while total < max_examples and any(colas.values()):
+        for cat, cola in colas.items():
+            if not cola or total >= max_examples:
+                continue
+            it = cola.pop(0)
+            bloque = format_example(it, clip_to_tokens(it.get('descripcion', ''), DESCRIPCION_MAX_TOKENS, count))
+            cost = count(bloque) + (0 if elegidos[cat] else count(f"\n{cat}:"))
+            if used + cost > budget_tokens:
+                continue  # no entra; uno más corto de la categoría quizá sí
+            elegidos[cat].append(bloque)
+            used += cost
+            total += 1
+    return {cat: bloques for cat, bloques in elegidos.items() if bloques}
+
+
+def load_budgeted_examples(budget_tokens: int, count: Callable[[str], int], max_examples: int,
+                           elementos: Sequence) -> str:
+    """
+    Como load_cultural_examples, pero hasta `budget_tokens` tokens en vez de un
+    número fijo. Si no entra ninguno, sin ejemplos: el presupuesto se respeta.
+    """
+    if not elementos:
+        return get_hardcoded_examples()
+    bloques = []
+    for cat, ejemplos in select_examples(elementos, budget_tokens, count, max_examples).items():
+        bloques.append(f"\n{cat}:")
+        bloques.extend(ejemplos)
+    return "\n".join(bloques)
@@ -0,0 +1,271 @@
+"""
+Preparación de la imagen antes de enviarla al modelo de visión.
+
+Aplica la orientación EXIF, reduce el lado mayor a `max_side`, recomprime a
+JPEG/WebP y elige el nivel de `detail` según el tamaño final. Las fotos de
+celular (4–12 MB) bajan a unos cientos de KB: menos tiempo de subida y, con
+`detail=low` en imágenes pequeñas, menos tokens de imagen.
+
+El modelo (detail=high) reescala toda imagen a 2048 px de lado mayor y 768 px
+de lado menor antes de dividirla en bloques de 512 px, así que reducir a
+~1024 px de lado mayor no quita información que el modelo fuera a ver.
+
+SourceImage es la imagen tal como llegó, decodificada una sola vez al validar
+la petición; la usan el serializer, la clave de caché y prepare_image.
+"""
+import base64
+import binascii
+import hashlib
+import io
+import math
+import threading
+from dataclasses import dataclass
+from typing import BinaryIO, Optional, Union
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .phash import phash
+
+# formatos que acepta la API de visión tal cual (Pillow format -> MIME)
+SUPPORTED_MIME = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp', 'GIF': 'image/gif'}
+
+DEFAULT_MAX_SIDE = 1024
+DEFAULT_FORMAT = 'JPEG'
+DEFAULT_QUALITY = 85
+DEFAULT_LOW_DETAIL_MAX_SIDE = 512  # cabe en un solo bloque: 'low' (85 tokens) no pierde nada
+
+# tokens de imagen según la tabla pública de precios de visión
+_BASE_TOKENS = 85
+_TILE_TOKENS = 170
+
+
+class ImagePreparationError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class PreparedImage:
+    base64: str
+    mime: str
+    detail: str
+    width: int
+    height: int
+    original_bytes: int
+    sent_bytes: int
+    original_tokens: int  # estimado si se hubiera enviado la original con detail=high
+    sent_tokens: int
+    phash: int = 0  # hash perceptual (caché de casi-duplicados)
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{self.mime};base64,{self.base64}"
+
+    def metrics(self) -> dict:
+        return {
+            'mime': self.mime,
+            'detail': self.detail,
+            'size': [self.width, self.height],
+            'original_bytes': self.original_bytes,
+            'sent_bytes': self.sent_bytes,
+            'bytes_saved': self.original_bytes - self.sent_bytes,
+            'original_tokens': self.original_tokens,
+            'sent_tokens': self.sent_tokens,
+            'tokens_saved': self.original_tokens - self.sent_tokens,
+        }
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = 'high') -> int:
+    """Tokens que cobra el modelo por una imagen de width x height."""
+    if detail == 'low' or not width or not height:
+        return _BASE_TOKENS
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return _BASE_TOKENS + _TILE_TOKENS * math.ceil(w / 512) * math.ceil(h / 512)
+
+
+_stats = {'images': 0, 'reencoded': 0, 'original_bytes': 0, 'sent_bytes': 0,
+          'original_tokens': 0, 'sent_tokens': 0}
+_stats_lock = threading.Lock()
+
+
+def get_image_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['bytes_saved'] = stats['original_bytes'] - stats['sent_bytes']
+    stats['tokens_saved'] = stats['original_tokens'] - stats['sent_tokens']
+    return stats
+
+
+def decode_base64_image(image_base64: str) -> bytes:
+    """Bytes de la imagen; acepta el prefijo data:...;base64,"""
+    start = image_base64.find(';base64,', 0, 256)
+    payload = image_base64[start + 8:] if start >= 0 else image_base64
+    try:
+        # a2b_base64 lee el str ASCII sin copiarlo (b64decode lo pasaría antes a bytes)
+        return binascii.a2b_base64(payload)
+    except (binascii.Error, ValueError) as e:
+        raise ImagePreparationError(f"Formato de imagen base64 inválido: {e}")
+
+
+class SourceImage:
+    """
+    Imagen recibida: bytes decodificados (o el archivo subido, sin leerlo a memoria),
+    sha256 del contenido y MIME y tamaño leídos de la cabecera. Si la cabecera no es
+    de una imagen conocida, `mime` es None (el rechazo queda para prepare_image).
+    """
+
+    def __init__(self, data: Optional[bytes] = None, file: Optional[BinaryIO] = None,
+                 content_hash: Optional[str] = None, size: Optional[int] = None,
+                 image_base64: Optional[str] = None):
+        if (data is None) == (file is None):
+            raise ValueError("SourceImage necesita data o file")
+        self.data = data
+        self.file = file
+        self.size = len(data) if data is not None else size
+        self._content_hash = content_hash
+        self._base64 = image_base64
+        self.mime, self.width, self.height = None, 0, 0
+        try:
+            with Image.open(self.open()) as img:  # solo lee la cabecera
+                self.mime = SUPPORTED_MIME.get(img.format) or Image.MIME.get(img.format)
+                self.width, self.height = img.size
+        except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+            pass
+
+    @classmethod
+    def from_base64(cls, image_base64: str, content_hash: Optional[str] = None) -> 'SourceImage':
+        return cls(decode_base64_image(image_base64), content_hash=content_hash, image_base64=image_base64)
+
+    @property
+    def content_hash(self) -> str:
+        """sha256 de los bytes (se calcula una vez, al pedirlo)."""
+        if self._content_hash is None:
+            if self.data is not None:
+                self._content_hash = hashlib.sha256(self.data).hexdigest()
+            else:
+                sha256 = hashlib.sha256()
+                fp = self.open()
+                for chunk in iter(lambda: fp.read(1 << 20), b''):
+                    sha256.update(chunk)
+                self._content_hash = sha256.hexdigest()
+        return self._content_hash
+
+    @property
+    def extension(self) -> str:
+        subtype = self.mime.split('/')[-1] if self.mime else 'jpg'
+        return 'jpg' if subtype == 'jpeg' else subtype
+
+    def open(self) -> BinaryIO:
+        """Archivo para leer desde el principio (BytesIO comparte los bytes, no los copia)."""
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        self.file.seek(0)
+        return self.file
+
+    def read(self) -> bytes:
+        return self.data if self.data is not None else self.open().read()
+
+    def to_base64(self) -> str:
+        """El base64 recibido o, si llegó como archivo, el contenido codificado."""
+        if self._base64 is None:
+            self._base64 = base64.b64encode(self.read()).decode('ascii')
+        return self._base64
+
+    def __repr__(self):
+        return f"SourceImage({self.mime}, {self.width}x{self.height}, {self.size} bytes)"
+
+
+def as_source_image(image: Union[str, SourceImage]) -> SourceImage:
+    return image if isinstance(image, SourceImage) else SourceImage.from_base64(image)
+
+
+def prepare_image(
+    image: Union[str, SourceImage],
+    max_side: int = DEFAULT_MAX_SIDE,
+    fmt: str = DEFAULT_FORMAT,
+    quality: int = DEFAULT_QUALITY,
+    low_detail_max_side: int = DEFAULT_LOW_DETAIL_MAX_SIDE,
+) -> PreparedImage:
+    """
+    Orienta, reduce y recomprime la imagen. Si ya está orientada, dentro de
+    `max_side`, en un formato soportado y recomprimir no la achica, se envía
+    tal cual (sin pérdida adicional de calidad).
+    `image`: SourceImage o base64 (se decodifica aquí).
+    """
+    source = as_source_image(image)
+    try:
+        img = Image.open(source.open())
+        src_format = img.format
+        orig_w, orig_h = img.size
+        orientation = img.getexif().get(0x0112, 1)
+        if max(orig_w, orig_h) > max_side:
+            # JPEG: decodificar directamente a escala reducida (1/2, 1/4, 1/8)
+            img.draft('RGB', (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+        img.load()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ImagePreparationError(f"Imagen no válida o formato no soportado: {e}")
+
+    rotated = orientation != 1
+    if orientation in (5, 6, 7, 8):  # rotaciones de 90°: ancho y alto se intercambian
+        orig_w, orig_h = orig_h, orig_w
+    # tokens si se enviara la original con detail=high
+    original_tokens = estimate_image_tokens(orig_w, orig_h)
+
+    resized = max(img.size) > max_side
+    if resized:
+        img.thumbnail((max_side, max_side))
+
+    reencoded = True
+    if not resized and not rotated and src_format in SUPPORTED_MIME:
+        # solo aquí hacen falta los bytes originales (un archivo subido se lee recién ahora)
+        encoded, mime = _encode(img, fmt, quality), SUPPORTED_MIME[fmt.upper()]
+        if len(encoded) >= source.size:
+            encoded, mime, reencoded = source.read(), SUPPORTED_MIME[src_format], False
+    else:
+        encoded, mime = _encode(img, fmt, quality), SUPPORTED_MIME[fmt.upper()]
+
+    width, height = img.size
+    detail = 'low' if max(width, height) <= low_detail_max_side else 'high'
+    prepared = PreparedImage(
+        base64=base64.b64encode(encoded).decode('ascii'),
+        mime=mime,
+        detail=detail,
+        width=width,
+        height=height,
+        original_bytes=source.size,
+        sent_bytes=len(encoded),
+        original_tokens=original_tokens,
+        sent_tokens=estimate_image_tokens(width, height, detail),
+        phash=phash(img),
+    )
+    with _stats_lock:
+        _stats['images'] += 1
+        _stats['reencoded'] += reencoded
+        _stats['original_bytes'] += prepared.original_bytes
+        _stats['sent_bytes'] += prepared.sent_bytes
+        _stats['original_tokens'] += prepared.original_tokens
+        _stats['sent_tokens'] += prepared.sent_tokens
+    return prepared
+
+
+def _encode(img: Image.Image, fmt: str, quality: int) -> bytes:
+    fmt = fmt.upper()
+    if fmt == 'JPEG' and img.mode not in ('RGB', 'L'):
+        # JPEG no tiene transparencia: componer sobre blanco
+        rgba = img.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        img = background
+    elif fmt == 'WEBP' and img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() or img.mode == 'P' else 'RGB')
+    buf = io.BytesIO()
+    save_kwargs = {'quality': quality}
+    if fmt == 'JPEG':
+        save_kwargs.update(optimize=True, progressive=True)
+    elif fmt == 'WEBP':
+        save_kwargs.update(method=4)
+    img.save(buf, fmt, **save_kwargs)
+    return buf.getvalue()
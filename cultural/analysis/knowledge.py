@@ -1,22 +1,124 @@
+from dataclasses import dataclass, field
 from pathlib import Path
+from types import MappingProxyType
+import hashlib
 import json
 import logging
+import threading
 from .constants import MAX_FEWSHOT_EJEMPLOS
 
 logger = logging.getLogger(__name__)
 DATA_DIR = Path(__file__).resolve().parent.parent / "data"
 DATA_FILE = DATA_DIR / "elementos_huanuco.json"
 
-def load_verified_elements() -> list:
+
+@dataclass(frozen=True)
+class KnowledgeSnapshot:
+    """
+    Copia inmutable de elementos_huanuco.json en memoria.
+    `version` es el sha1 del contenido; cambia solo si cambia el archivo.
+    """
+    elementos: tuple
+    version: str
+    # estructuras derivadas (índices, matrices) válidas solo para esta versión
+    _derived: dict = field(default_factory=dict, compare=False, repr=False)
+    _derived_locks: dict = field(default_factory=dict, compare=False, repr=False)
+
+    def derived(self, name: str, builder):
+        """
+        Construye una sola vez por versión una estructura derivada de `elementos`.
+        El candado es por snapshot y nombre: una construcción lenta no frena
+        las recargas ni las otras estructuras.
+        """
+        value = self._derived.get(name)
+        if value is None:
+            with self._derived_locks.setdefault(name, threading.Lock()):
+                value = self._derived.get(name)
+                if value is None:
+                    value = builder(self.elementos)
+                    self._derived[name] = value
+        return value
+
+
+_EMPTY_SNAPSHOT = KnowledgeSnapshot(elementos=(), version="")
+
+_snapshot = _EMPTY_SNAPSHOT
+_snapshot_stat = ()  # (mtime_ns, size) del archivo con el que se validó el snapshot
+_snapshot_lock = threading.RLock()
+_stats = {"hits": 0, "reloads": 0, "stat_changes": 0, "errors": 0}
+
+
+def _stat_key(path: Path) -> tuple:
+    st = path.stat()
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _freeze(elementos) -> tuple:
+    if not isinstance(elementos, list):
+        raise ValueError("elementos_huanuco.json debe contener una lista")
+    return tuple(MappingProxyType(dict(e)) for e in elementos if isinstance(e, dict))
+
+
+def get_knowledge_snapshot(force: bool = False) -> KnowledgeSnapshot:
+    """
+    Retorna el snapshot vigente. Solo relee el archivo si cambió su mtime/tamaño
+    (o si force=True), y solo lo reemplaza si cambió el hash del contenido.
+    """
+    global _snapshot, _snapshot_stat
     try:
-        with DATA_FILE.open("r", encoding="utf-8") as f:
-            return json.load(f)
+        key = _stat_key(DATA_FILE)
     except FileNotFoundError:
         logger.error("Archivo elementos_huanuco.json no encontrado en cultural/data/")
-        return []
-    except Exception as e:
-        logger.error(f"Error leyendo elementos verificados: {e}")
-        return []
+        with _snapshot_lock:
+            _snapshot, _snapshot_stat = _EMPTY_SNAPSHOT, ()
+            _stats["errors"] += 1
+        return _EMPTY_SNAPSHOT
+
+    if not force and _snapshot_stat == key:
+        _stats["hits"] += 1
+        return _snapshot
+
+    with _snapshot_lock:
+        current = _snapshot
+        if not force and _snapshot_stat == key:  # otro hilo ya recargó
+            _stats["hits"] += 1
+            return current
+        try:
+            raw = DATA_FILE.read_bytes()
+        except OSError as e:
+            logger.error(f"Error leyendo elementos verificados: {e}")
+            _stats["errors"] += 1
+            return current
+        version = hashlib.sha1(raw).hexdigest()
+        _stats["stat_changes"] += 1
+        if version == current.version:
+            # mismo contenido (p. ej. touch): conservar el snapshot y sus índices
+            _snapshot_stat = key
+            return current
+        try:
+            elementos = _freeze(json.loads(raw.decode("utf-8")))
+        except (ValueError, TypeError) as e:
+            # JSON inválido: se sigue con el último snapshot bueno y se recuerda el stat
+            # para no releer, rehashear ni volver a loguear el archivo hasta que cambie
+            logger.error(f"elementos_huanuco.json inválido, se mantiene v{current.version[:8]}: {e}")
+            _stats["errors"] += 1
+            _snapshot_stat = key
+            return current
+
+        _snapshot, _snapshot_stat = KnowledgeSnapshot(elementos, version), key
+        _stats["reloads"] += 1
+        logger.info(f"Base de conocimiento cargada: {len(elementos)} elementos (v{version[:8]})")
+        return _snapshot
+
+
+def get_knowledge_stats() -> dict:
+    """Contadores del snapshot (hits, recargas) para verificar que la caché funciona."""
+    snap = _snapshot
+    return {**_stats, "version": snap.version, "elementos": len(snap.elementos)}
+
+
+def load_verified_elements() -> list:
+    return list(get_knowledge_snapshot().elementos)
 
 def get_hardcoded_examples() -> str:
     return """
@@ -33,8 +135,17 @@ def get_hardcoded_examples() -> str:
             Periodo: Precerámico (2000–1500 a.C.)
         """
 
-def load_cultural_examples(num_examples: int = MAX_FEWSHOT_EJEMPLOS) -> str:
-    elementos = load_verified_elements()
+def format_example(it, descripcion: str) -> str:
+    """Bloque de un ejemplo few-shot (`descripcion` ya recortada)."""
+    conf = float(it.get("confianza", 0.8))
+    return f"""  - {it.get('titulo','(sin título)')} (Confianza esperada: {conf:.2f})
+                Descripción: {descripcion}
+                Ubicación: {it.get('ubicacion','')}
+                Periodo: {it.get('periodo_historico','')}"""
+
+def load_cultural_examples(num_examples: int = MAX_FEWSHOT_EJEMPLOS, elementos=None) -> str:
+    if elementos is None:
+        elementos = get_knowledge_snapshot().elementos
     if not elementos:
         return get_hardcoded_examples()
 
@@ -52,13 +163,7 @@ def load_cultural_examples(num_examples: int = MAX_FEWSHOT_EJEMPLOS) -> str:
         bloques.append(f"\n{cat}:")
         for it in items:
             if count >= num_examples: break
-            conf = float(it.get("confianza", 0.8))
-            bloques.append(
-                f"""  - {it.get('titulo','(sin título)')} (Confianza esperada: {conf:.2f})
-                Descripción: {it.get('descripcion','')[:180]}...
-                Ubicación: {it.get('ubicacion','')}
-                Periodo: {it.get('periodo_historico','')}"""
-            )
+            bloques.append(format_example(it, it.get('descripcion', '')[:180] + '...'))
             count += 1
 
     return "\n".join(bloques) if bloques else get_hardcoded_examples()
@@ -1,22 +1,203 @@
+import asyncio
+import email.utils
+import json
+import logging
+import random
+import threading
+import time
+import weakref
+from types import SimpleNamespace
+from typing import Iterator, Optional
+
 import requests
-from requests.exceptions import Timeout
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout, ConnectionError as RequestsConnectionError, RequestException
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    import aiohttp  # cliente async (opcional; solo lo usa la vista ASGI)
+except ImportError:
+    aiohttp = None
+
+from .constants import SYSTEM_MESSAGE
+from .resilience import OPEN, CircuitOpenError, UpstreamGuard
+
+logger = logging.getLogger(__name__)
+
 
 class OpenAIClientError(Exception):
     pass
 
-def call_openai_api(
-    api_url: str,
-    api_key: str,
-    model: str,
-    max_tokens: int,
-    timeout: int,
-    prompt: str,
-    image_base64: str
-  ) -> dict:
+
+class UpstreamUnavailableError(OpenAIClientError):
+    """No se llamó a OpenAI: circuito abierto o demasiadas llamadas en curso."""
+    code = 'upstream_unavailable'
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _enter_guard(guard: Optional[UpstreamGuard]) -> None:
+    if guard is None:
+        return
+    try:
+        guard.enter()
+    except CircuitOpenError as e:
+        raise UpstreamUnavailableError(str(e), e.retry_after)
+
+
+async def _aenter_guard(guard: Optional[UpstreamGuard]) -> None:
+    if guard is None:
+        return
+    try:
+        await guard.aenter()
+    except CircuitOpenError as e:
+        raise UpstreamUnavailableError(str(e), e.retry_after)
+
+
+def _circuit_opened(guard: Optional[UpstreamGuard]) -> bool:
+    """El circuito se abrió durante los reintentos: no seguir esperando."""
+    return guard is not None and guard.breaker.state == OPEN
+
+
+def _unavailable(guard: UpstreamGuard) -> UpstreamUnavailableError:
+    return UpstreamUnavailableError("OpenAI no está disponible en este momento; intenta más tarde",
+                                    guard.breaker.open_seconds)
+
+# === sesión HTTP compartida (keep-alive) ===
+DEFAULT_POOL_SIZE = 10
+RETRY_STATUS = {429, 500, 502, 503, 504}
+MAX_RETRY_AFTER = 30.0  # segundos; si el servidor pide esperar más, no se reintenta
+
+_timing = threading.local()
+
+
+def _record_connect(seconds: float) -> None:
+    _timing.connect = getattr(_timing, 'connect', 0.0) + seconds
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        t0 = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _record_connect(time.perf_counter() - t0)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):  # incluye el handshake TLS
+        t0 = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _record_connect(time.perf_counter() - t0)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _PooledAdapter(HTTPAdapter):
+    """HTTPAdapter que mide el tiempo de conexión de cada socket nuevo."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+_session: Optional[requests.Session] = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size: int = DEFAULT_POOL_SIZE) -> requests.Session:
+    """Sesión de proceso con pool de conexiones reutilizables hacia la API."""
+    global _session, _session_pool_size
+    if _session is not None and _session_pool_size == pool_size:
+        return _session
+    with _session_lock:
+        if _session is None or _session_pool_size != pool_size:
+            session = requests.Session()
+            adapter = _PooledAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                     max_retries=0, pool_block=False)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            old, _session, _session_pool_size = _session, session, pool_size
+            if old is not None:
+                old.close()
+    return _session
+
+
+def _retry_after_seconds(headers) -> Optional[float]:
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        # ni segundos ni fecha HTTP: se ignora y se usa el backoff exponencial
+        logger.warning(f"Retry-After inválido: {value!r}")
+        return None
+    return max(0.0, parsed.timestamp() - time.time())
+
+
+def _backoff(attempt: int, base: float, cap: float) -> float:
+    """Backoff exponencial con jitter completo."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def _retry_wait(status_code: int, headers, attempt: int, max_retries: int,
+                backoff_base: float, backoff_max: float) -> Optional[float]:
+    """Segundos a esperar antes de reintentar, o None si la respuesta es definitiva."""
+    if status_code not in RETRY_STATUS or attempt > max_retries:
+        return None
+    wait = _retry_after_seconds(headers)
+    if wait is None:
+        wait = _backoff(attempt - 1, backoff_base, backoff_max)
+    return wait if wait <= MAX_RETRY_AFTER else None
+
+
+def max_call_seconds(timeout: float, max_retries: int, backoff_max: float = 8.0) -> float:
+    """Cota de lo que tarda una llamada con sus reintentos: todos los intentos más la espera máxima entre ellos."""
+    return (max_retries + 1) * timeout + max_retries * max(MAX_RETRY_AFTER, backoff_max)
+
+
+def _raise_for_status(status_code: int, text: str) -> None:
+    if status_code < 400:
+        return
+    if status_code == 429:
+        raise OpenAIClientError("Límite de uso de la API excedido")
+    if status_code == 401:
+        raise OpenAIClientError("Error de autenticación con OpenAI")
+    raise OpenAIClientError(f"Error en la API: {status_code} - {text}")
+
+
+def build_request(api_key: str, model: str, max_tokens: int, prompt: str, image_base64: str,
+                  image_mime: str = "image/jpeg", image_detail: Optional[str] = None,
+                  stream: bool = False, response_format: Optional[dict] = None) -> tuple:
     """
-    Envía la imagen + prompt a OpenAI y retorna el JSON de respuesta.
-    Incluye un mensaje de sistema para forzar formato JSON puro.
+    Cabeceras y payload de la llamada (compartidos por el cliente sync y async).
+    Incluye un mensaje de sistema para forzar formato JSON puro. El orden importa:
+    sistema y prompt (iguales en todas las llamadas) antes que la imagen, para que
+    OpenAI reutilice el prefijo cacheado (usage.prompt_tokens_details.cached_tokens).
     """
+    image_url = {"url": f"data:{image_mime};base64,{image_base64}"}
+    if image_detail:
+        image_url["detail"] = image_detail
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}"
@@ -26,20 +207,13 @@ def call_openai_api(
     messages = [
         {
             "role": "system",
-            "content": (
-                "Eres un analista cultural experto en Huánuco, Perú. "
-                "Responde únicamente con un JSON válido y bien formado, sin texto adicional, sin markdown, "
-                "sin explicaciones ni comentarios fuera del JSON."
-            ),
+            "content": SYSTEM_MESSAGE,
         },
         {
             "role": "user",
             "content": [
                 {"type": "text", "text": prompt},
-                {
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}
-                },
+                {"type": "image_url", "image_url": image_url},
             ],
         },
     ]
@@ -49,21 +223,322 @@ def call_openai_api(
         "messages": messages,
         "max_tokens": max_tokens,
     }
+    if response_format:
+        payload["response_format"] = response_format  # salida estructurada (analysis.schema)
+    if stream:
+        # el último evento trae el uso de tokens
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
+    return headers, payload
+
 
+def _fill_timing(timing: Optional[dict], connect: float, ttfb: float, t_start: float, attempts: int) -> None:
+    if timing is not None:
+        timing.update({
+            'connect_ms': round(connect * 1000, 1),
+            'ttfb_ms': round(ttfb * 1000, 1),
+            'total_ms': round((time.perf_counter() - t_start) * 1000, 1),
+            'attempts': attempts,
+        })
+
+def call_openai_api(
+    api_url: str,
+    api_key: str,
+    model: str,
+    max_tokens: int,
+    timeout: int,
+    prompt: str,
+    image_base64: str,
+    max_retries: int = 2,
+    backoff_base: float = 0.5,
+    backoff_max: float = 8.0,
+    pool_size: int = DEFAULT_POOL_SIZE,
+    timing: Optional[dict] = None,
+    image_mime: str = "image/jpeg",
+    image_detail: Optional[str] = None,
+    guard: Optional[UpstreamGuard] = None,
+    response_format: Optional[dict] = None,
+  ) -> dict:
+    """
+    Envía la imagen + prompt a OpenAI y retorna el JSON de respuesta.
+
+    Reutiliza conexiones de la sesión compartida y reintenta errores de conexión,
+    429 y 5xx con backoff exponencial (respetando Retry-After). Si se pasa `timing`,
+    se llena con connect/ttfb/total en ms y el número de intentos. `image_mime` y
+    `image_detail` vienen de la preparación de la imagen (analysis.images) y
+    `response_format` de analysis.schema (salida estructurada).
+    Con `guard` (analysis.resilience) la llamada pasa por el circuito y el límite
+    de concurrencia; si no puede pasar lanza UpstreamUnavailableError al instante.
+    """
+    headers, payload = build_request(api_key, model, max_tokens, prompt, image_base64, image_mime, image_detail,
+                                     response_format=response_format)
+
+    session = get_session(pool_size)
+    _enter_guard(guard)
+    t_start = time.perf_counter()
+    _timing.connect = 0.0
+    ttfb = 0.0
+    attempt = 0
+    failed = overloaded = False
     try:
-        r = requests.post(api_url, headers=headers, json=payload, timeout=timeout)
-        r.raise_for_status()
-        return r.json()
+        while True:
+            attempt += 1
+            try:
+                t_attempt = time.perf_counter()
+                r = session.post(api_url, headers=headers, json=payload, timeout=timeout, stream=True)
+                ttfb = time.perf_counter() - t_attempt  # cabeceras recibidas
+                r.content  # leer el cuerpo completo
+            except RequestsConnectionError:
+                overloaded = True
+                if attempt > max_retries:
+                    failed = True
+                    raise OpenAIClientError("Error de conexión con OpenAI")
+                if _circuit_opened(guard):
+                    failed = True
+                    raise _unavailable(guard)
+                time.sleep(_backoff(attempt - 1, backoff_base, backoff_max))
+                continue
+
+            if r.status_code in RETRY_STATUS:
+                overloaded = True
+            wait = _retry_wait(r.status_code, r.headers, attempt, max_retries, backoff_base, backoff_max)
+            if wait is not None:
+                if _circuit_opened(guard):
+                    failed = True
+                    raise _unavailable(guard)
+                time.sleep(wait)
+                continue
+
+            failed = r.status_code in RETRY_STATUS
+            _raise_for_status(r.status_code, r.text)
+            return r.json()
 
     except Timeout:
+        failed = overloaded = True
+        raise OpenAIClientError("Timeout en llamada a OpenAI")
+    finally:
+        if guard is not None:
+            guard.exit(failed, overloaded, time.perf_counter() - t_start)
+        _fill_timing(timing, getattr(_timing, 'connect', 0.0), ttfb, t_start, attempt)
+
+
+def stream_openai_api(
+    api_url: str,
+    api_key: str,
+    model: str,
+    max_tokens: int,
+    timeout: int,
+    prompt: str,
+    image_base64: str,
+    max_retries: int = 2,
+    backoff_base: float = 0.5,
+    backoff_max: float = 8.0,
+    pool_size: int = DEFAULT_POOL_SIZE,
+    timing: Optional[dict] = None,
+    image_mime: str = "image/jpeg",
+    image_detail: Optional[str] = None,
+    guard: Optional[UpstreamGuard] = None,
+    usage: Optional[dict] = None,
+    response_format: Optional[dict] = None,
+  ) -> Iterator[str]:
+    """
+    Como call_openai_api pero con "stream": true: produce el texto de la
+    respuesta a medida que OpenAI lo genera. Solo se reintenta antes del primer
+    byte. Al terminar, `usage` (si se pasa) recibe el uso de tokens y `timing`
+    incluye first_token_ms. Para el circuito cuenta la latencia hasta el primer token.
+    """
+    headers, payload = build_request(api_key, model, max_tokens, prompt, image_base64,
+                                     image_mime, image_detail, stream=True, response_format=response_format)
+
+    session = get_session(pool_size)
+    _enter_guard(guard)
+    t_start = time.perf_counter()
+    _timing.connect = 0.0
+    ttfb = first_token = 0.0
+    attempt = 0
+    failed = overloaded = False
+    try:
+        while True:
+            attempt += 1
+            try:
+                t_attempt = time.perf_counter()
+                r = session.post(api_url, headers=headers, json=payload, timeout=timeout, stream=True)
+                ttfb = time.perf_counter() - t_attempt
+            except RequestsConnectionError:
+                overloaded = True
+                if attempt > max_retries:
+                    failed = True
+                    raise OpenAIClientError("Error de conexión con OpenAI")
+                if _circuit_opened(guard):
+                    failed = True
+                    raise _unavailable(guard)
+                time.sleep(_backoff(attempt - 1, backoff_base, backoff_max))
+                continue
+
+            if r.status_code in RETRY_STATUS:
+                overloaded = True
+            wait = _retry_wait(r.status_code, r.headers, attempt, max_retries, backoff_base, backoff_max)
+            if wait is not None:
+                r.close()
+                if _circuit_opened(guard):
+                    failed = True
+                    raise _unavailable(guard)
+                time.sleep(wait)
+                continue
+
+            failed = r.status_code in RETRY_STATUS
+            if r.status_code >= 400:  # r.text consumiría el stream
+                _raise_for_status(r.status_code, r.text)
+            break
+
+        r.encoding = 'utf-8'  # text/event-stream sin charset se tomaría como latin-1
+        with r:
+            try:
+                # chunk_size=None: entregar cada trozo al llegar, sin esperar a juntar 512 bytes
+                for line in r.iter_lines(chunk_size=None, decode_unicode=True):
+                    # eventos SSE: "data: {...}" y "data: [DONE]" al final
+                    if not line or not line.startswith('data:'):
+                        continue
+                    data = line[5:].strip()
+                    if data == '[DONE]':
+                        break
+                    if not data:
+                        continue
+                    try:
+                        chunk = json.loads(data)
+                    except ValueError:
+                        # sin ese trozo el texto quedaría incompleto: se corta con error (evento "error")
+                        logger.warning(f"Trozo mal formado en el stream de OpenAI: {data[:200]!r}")
+                        failed = True
+                        raise OpenAIClientError("Respuesta de OpenAI mal formada en el stream")
+                    if chunk.get('usage') and usage is not None:
+                        usage.update(chunk['usage'])
+                    for choice in chunk.get('choices') or []:
+                        text = (choice.get('delta') or {}).get('content')
+                        if text:
+                            if not first_token:
+                                first_token = time.perf_counter() - t_start
+                            yield text
+            except RequestException:
+                failed = overloaded = True
+                raise OpenAIClientError("Se interrumpió la respuesta de OpenAI")
+
+    except Timeout:
+        failed = overloaded = True
+        raise OpenAIClientError("Timeout en llamada a OpenAI")
+    finally:
+        if guard is not None:
+            guard.exit(failed, overloaded, first_token or (time.perf_counter() - t_start))
+        _fill_timing(timing, getattr(_timing, 'connect', 0.0), ttfb, t_start, attempt)
+        if timing is not None:
+            timing['first_token_ms'] = round(first_token * 1000, 1)
+
+
+# === cliente async (vista ASGI) ===
+_async_sessions = weakref.WeakKeyDictionary()  # event loop -> aiohttp.ClientSession
+
+
+async def _on_connect_start(session, ctx, params):
+    ctx.connect_t0 = time.perf_counter()
+
+
+async def _on_connect_end(session, ctx, params):
+    ctx.timing['connect'] += time.perf_counter() - ctx.connect_t0
+
+
+def get_async_session(pool_size: int = DEFAULT_POOL_SIZE):
+    """ClientSession con pool keep-alive, una por event loop."""
+    if aiohttp is None:
+        raise OpenAIClientError("aiohttp no está instalado; el cliente async no está disponible")
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        trace = aiohttp.TraceConfig(trace_config_ctx_factory=lambda trace_request_ctx: SimpleNamespace(
+            timing=trace_request_ctx, connect_t0=0.0))
+        trace.on_connection_create_start.append(_on_connect_start)
+        trace.on_connection_create_end.append(_on_connect_end)
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size),
+                                        trace_configs=[trace])
+        _async_sessions[loop] = session
+    return session
+
+
+async def aclose_async_session() -> None:
+    """Cierra la sesión del event loop actual (p. ej. al terminar un asyncio.run)."""
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def acall_openai_api(
+    api_url: str,
+    api_key: str,
+    model: str,
+    max_tokens: int,
+    timeout: int,
+    prompt: str,
+    image_base64: str,
+    max_retries: int = 2,
+    backoff_base: float = 0.5,
+    backoff_max: float = 8.0,
+    pool_size: int = DEFAULT_POOL_SIZE,
+    timing: Optional[dict] = None,
+    image_mime: str = "image/jpeg",
+    image_detail: Optional[str] = None,
+    guard: Optional[UpstreamGuard] = None,
+    response_format: Optional[dict] = None,
+  ) -> dict:
+    """Versión async de call_openai_api: no bloquea un hilo mientras espera a OpenAI."""
+    headers, payload = build_request(api_key, model, max_tokens, prompt, image_base64, image_mime, image_detail,
+                                     response_format=response_format)
+    session = get_async_session(pool_size)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    trace_ctx = {'connect': 0.0}
+
+    await _aenter_guard(guard)
+    t_start = time.perf_counter()
+    ttfb = 0.0
+    attempt = 0
+    failed = overloaded = False
+    try:
+        while True:
+            attempt += 1
+            try:
+                t_attempt = time.perf_counter()
+                async with session.post(api_url, headers=headers, json=payload, timeout=client_timeout,
+                                        trace_request_ctx=trace_ctx) as r:
+                    ttfb = time.perf_counter() - t_attempt  # cabeceras recibidas
+                    status_code, resp_headers = r.status, r.headers
+                    text = await r.text()
+            except aiohttp.ClientConnectionError:
+                overloaded = True
+                if attempt > max_retries:
+                    failed = True
+                    raise OpenAIClientError("Error de conexión con OpenAI")
+                if _circuit_opened(guard):
+                    failed = True
+                    raise _unavailable(guard)
+                await asyncio.sleep(_backoff(attempt - 1, backoff_base, backoff_max))
+                continue
+
+            if status_code in RETRY_STATUS:
+                overloaded = True
+            wait = _retry_wait(status_code, resp_headers, attempt, max_retries, backoff_base, backoff_max)
+            if wait is not None:
+                if _circuit_opened(guard):
+                    failed = True
+                    raise _unavailable(guard)
+                await asyncio.sleep(wait)
+                continue
+
+            failed = status_code in RETRY_STATUS
+            _raise_for_status(status_code, text)
+            return json.loads(text)
+
+    except asyncio.TimeoutError:
+        failed = overloaded = True
         raise OpenAIClientError("Timeout en llamada a OpenAI")
-    except requests.HTTPError as e:
-        if e.response is not None:
-            if e.response.status_code == 429:
-                raise OpenAIClientError("Límite de uso de la API excedido")
-            if e.response.status_code == 401:
-                raise OpenAIClientError("Error de autenticación con OpenAI")
-            raise OpenAIClientError(
-                f"Error en la API: {e.response.status_code} - {e.response.text}"
-            )
-        raise OpenAIClientError("HTTPError sin respuesta")
+    finally:
+        if guard is not None:
+            guard.exit(failed, overloaded, time.perf_counter() - t_start)
+        _fill_timing(timing, trace_ctx['connect'], ttfb, t_start, attempt)
@@ -1,6 +1,8 @@
 import json
 import logging
 
+from .schema import REQUIRED_FIELDS, Validator
+
 logger = logging.getLogger(__name__)
 
 def extract_json(content: str) -> str:
@@ -10,25 +12,29 @@ def extract_json(content: str) -> str:
         raise ValueError("No se encontró JSON válido en la respuesta")
     return content[i:j]
 
+_CATEGORIAS = {
+    'gastronomia': 'GASTRONOMIA', 'gastronomía': 'GASTRONOMIA',
+    'patrimonio arqueologico': 'PATRIMONIO_ARQUEOLOGICO',
+    'patrimonio arqueológico': 'PATRIMONIO_ARQUEOLOGICO',
+    'patrimonio': 'PATRIMONIO_ARQUEOLOGICO',
+    'arqueologico': 'PATRIMONIO_ARQUEOLOGICO', 'arqueológico': 'PATRIMONIO_ARQUEOLOGICO',
+    'flora medicinal': 'FLORA_MEDICINAL', 'flora': 'FLORA_MEDICINAL', 'medicinal': 'FLORA_MEDICINAL',
+    'leyendas y tradiciones': 'LEYENDAS_Y_TRADICIONES', 'leyendas': 'LEYENDAS_Y_TRADICIONES', 'tradiciones': 'LEYENDAS_Y_TRADICIONES',
+    'festividades': 'FESTIVIDADES', 'festividad': 'FESTIVIDADES',
+    'danza': 'DANZA', 'danzas': 'DANZA', 'baile': 'DANZA',
+    'musica': 'MUSICA', 'música': 'MUSICA',
+    'vestimenta': 'VESTIMENTA', 'vestuario': 'VESTIMENTA', 'traje': 'VESTIMENTA',
+    'arte popular': 'ARTE_POPULAR', 'artesania': 'ARTE_POPULAR', 'artesanía': 'ARTE_POPULAR',
+    'naturaleza/cultural': 'NATURALEZA_CULTURAL', 'naturaleza': 'NATURALEZA_CULTURAL',
+    'otro': 'OTRO', 'otros': 'OTRO',
+}
+# los códigos de CulturalCategory (salida estructurada) también se aceptan tal cual
+_CATEGORIAS.update({code.lower(): code for code in set(_CATEGORIAS.values())})
+
+
 def normalize_category(category: str) -> str:
-    m = {
-        'gastronomia': 'GASTRONOMIA', 'gastronomía': 'GASTRONOMIA',
-        'patrimonio arqueologico': 'PATRIMONIO_ARQUEOLOGICO',
-        'patrimonio arqueológico': 'PATRIMONIO_ARQUEOLOGICO',
-        'patrimonio': 'PATRIMONIO_ARQUEOLOGICO',
-        'arqueologico': 'PATRIMONIO_ARQUEOLOGICO', 'arqueológico': 'PATRIMONIO_ARQUEOLOGICO',
-        'flora medicinal': 'FLORA_MEDICINAL', 'flora': 'FLORA_MEDICINAL', 'medicinal': 'FLORA_MEDICINAL',
-        'leyendas y tradiciones': 'LEYENDAS_Y_TRADICIONES', 'leyendas': 'LEYENDAS_Y_TRADICIONES', 'tradiciones': 'LEYENDAS_Y_TRADICIONES',
-        'festividades': 'FESTIVIDADES', 'festividad': 'FESTIVIDADES',
-        'danza': 'DANZA', 'danzas': 'DANZA', 'baile': 'DANZA',
-        'musica': 'MUSICA', 'música': 'MUSICA',
-        'vestimenta': 'VESTIMENTA', 'vestuario': 'VESTIMENTA', 'traje': 'VESTIMENTA',
-        'arte popular': 'ARTE_POPULAR', 'artesania': 'ARTE_POPULAR', 'artesanía': 'ARTE_POPULAR',
-        'naturaleza/cultural': 'NATURALEZA_CULTURAL', 'naturaleza': 'NATURALEZA_CULTURAL',
-        'otro': 'OTRO', 'otros': 'OTRO',
-    }
     key = category.lower().strip()
-    return m.get(key, 'OTRO')  # Default a OTRO en vez de GASTRONOMIA
+    return _CATEGORIAS.get(key, 'OTRO')  # Default a OTRO en vez de GASTRONOMIA
 
 def parse_response(openai_response: dict) -> dict:
     choices = openai_response.get('choices', [])
@@ -42,8 +48,7 @@ def parse_response(openai_response: dict) -> dict:
     json_content = extract_json(content)
     analysis = json.loads(json_content)
 
-    required = ['titulo','categoria','confianza','descripcion','contexto_cultural','periodo_historico','ubicacion','significado']
-    missing = [f for f in required if f not in analysis]
+    missing = [f for f in REQUIRED_FIELDS if f not in analysis]
     if missing:
         raise ValueError(f"Campos faltantes en respuesta: {missing}")
 
@@ -52,3 +57,86 @@ def parse_response(openai_response: dict) -> dict:
 
     analysis['categoria'] = normalize_category(analysis['categoria'])
     return analysis
+
+
+def parse_structured(openai_response: dict, validator: Validator) -> dict:
+    """
+    Camino rápido para respuestas con salida estructurada (analysis.schema): el
+    contenido es el JSON tal cual y la categoría ya es un código. Lanza
+    ValueError si el modelo no respetó el schema; entonces va parse_response.
+    """
+    try:
+        message = openai_response['choices'][0]['message']
+    except (KeyError, IndexError, TypeError):
+        raise ValueError("OpenAI no retornó resultados")
+    if message.get('refusal'):
+        raise ValueError(f"OpenAI rechazó el análisis: {message['refusal']}")
+    analysis = json.loads(message.get('content') or '')
+    validator(analysis)
+    if not 0 <= analysis['confianza'] <= 1:
+        raise ValueError("Confianza inválida")
+    return analysis
+
+
+class IncrementalJSONParser:
+    """
+    Lee el JSON del análisis a medida que llegan los tokens y devuelve cada campo
+    de primer nivel en cuanto se completa (al ver la coma o la llave que lo cierra).
+    Ignora lo que haya antes de la primera llave (```json, texto suelto).
+    El resultado definitivo sigue saliendo de parse_response sobre el texto completo.
+    """
+
+    def __init__(self):
+        self.text = ''
+        self.done = False
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+
+    def feed(self, chunk: str) -> list:
+        """Agrega texto; devuelve [(campo, valor)] completados con este trozo."""
+        self.text += chunk
+        text, fields = self.text, []
+        for i in range(self._pos, len(text)):
+            if self.done:
+                break
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._key_start is not None and self._key is None:
+                        self._key = json.loads(text[self._key_start:i + 1])
+                continue
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1 and self._key is None:
+                    self._key_start = i
+            elif c in '{[':
+                self._depth += 1
+            elif c in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    self._emit(text, i, fields)
+                    self.done = True
+            elif self._depth == 1 and c == ':' and self._key is not None and self._value_start is None:
+                self._value_start = i + 1
+            elif self._depth == 1 and c == ',':
+                self._emit(text, i, fields)
+        self._pos = len(text)
+        return fields
+
+    def _emit(self, text: str, end: int, fields: list) -> None:
+        if self._key is not None and self._value_start is not None:
+            try:
+                fields.append((self._key, json.loads(text[self._value_start:end])))
+            except ValueError:
+                logger.debug(f"Campo {self._key!r} incompleto en el stream")
+        self._key_start = self._key = self._value_start = None
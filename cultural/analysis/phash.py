@@ -0,0 +1,122 @@
+"""
+Hashes perceptuales (dHash / pHash de 64 bits) e índice por distancia de Hamming.
+
+Dos fotos de lo mismo que solo difieren en recompresión, tamaño o un recorte leve
+dan hashes a pocos bits de distancia. `HammingIndex` guarda los hashes en un
+arreglo uint64 contiguo y compara la consulta contra todos con XOR + popcount
+vectorizado: con las decenas de miles de entradas que se guardan es más rápido
+que recorrer un BK-tree o una tabla multi-índice en Python, y el resultado es exacto.
+"""
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+HASH_BITS = 64
+
+
+def dhash(img: Image.Image) -> int:
+    """Gradiente horizontal sobre una miniatura de 9x8 en grises."""
+    small = np.asarray(img.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return _pack(small[:, 1:] > small[:, :-1])
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    m = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n))
+    m[0] *= 1 / np.sqrt(2)
+    return m * np.sqrt(2 / n)
+
+
+def phash(img: Image.Image) -> int:
+    """Frecuencias bajas (8x8) de la DCT de una miniatura de 32x32 comparadas con su mediana."""
+    small = np.asarray(img.convert('L').resize((32, 32), Image.BILINEAR), dtype=np.float64)
+    c = _dct_matrix(32)
+    low = (c @ small @ c.T)[:8, :8]
+    return _pack(low > np.median(low.ravel()[1:]))  # sin el término DC
+
+
+def _pack(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+if hasattr(np, 'bitwise_count'):
+    _popcount = np.bitwise_count
+else:  # numpy < 2.0
+    _POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def _popcount(a: np.ndarray) -> np.ndarray:
+        return _POPCOUNT8[a.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class HammingIndex:
+    """
+    hash -> valor, con búsqueda del vecino más cercano dentro de un radio.
+    Acotado a `max_entries`: al llenarse se descarta el hash usado hace más tiempo.
+    """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._values: "OrderedDict[int, Hashable]" = OrderedDict()
+        self._hashes = np.zeros(max_entries, dtype=np.uint64)
+        self._slots: Dict[int, int] = {}   # hash -> posición en _hashes
+        self._by_slot: List[int] = []      # posición -> hash
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def add(self, h: int, value: Hashable) -> None:
+        with self._lock:
+            if h in self._values:
+                self._values.move_to_end(h)
+            else:
+                while len(self._values) >= self.max_entries:
+                    self._discard(next(iter(self._values)))
+                self._slots[h] = len(self._by_slot)
+                self._hashes[len(self._by_slot)] = h
+                self._by_slot.append(h)
+            self._values[h] = value
+
+    def remove(self, h: int) -> None:
+        with self._lock:
+            if h in self._values:
+                self._discard(h)
+
+    def _discard(self, h: int) -> None:
+        # mover el último hash al hueco para mantener el arreglo compacto
+        del self._values[h]
+        slot = self._slots.pop(h)
+        last = self._by_slot.pop()
+        if last != h:
+            self._slots[last] = slot
+            self._by_slot[slot] = last
+            self._hashes[slot] = last
+
+    def nearest(self, h: int, max_distance: int) -> Optional[Tuple[int, Hashable, int]]:
+        """(hash, valor, distancia) del más cercano a distancia <= max_distance, o None."""
+        if max_distance < 0:
+            return None
+        with self._lock:
+            if h in self._values:
+                self._values.move_to_end(h)
+                return h, self._values[h], 0
+            size = len(self._by_slot)
+            if not size:
+                return None
+            distances = _popcount(self._hashes[:size] ^ np.uint64(h))
+            slot = int(np.argmin(distances))
+            distance = int(distances[slot])
+            if distance > max_distance:
+                return None
+            best = self._by_slot[slot]
+            self._values.move_to_end(best)
+            return best, self._values[best], distance
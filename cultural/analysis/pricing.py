@@ -0,0 +1,50 @@
+"""Costo estimado de una llamada a partir del campo `usage` de la respuesta."""
+from typing import Mapping, Optional
+
+# USD por millón de tokens: (entrada, entrada en caché, salida). Actualizar si cambian los precios.
+PRECIOS_MODELOS = {
+    'gpt-4o': (2.50, 1.25, 10.00),
+    'gpt-4o-mini': (0.15, 0.075, 0.60),
+    'gpt-4.1': (2.00, 0.50, 8.00),
+    'gpt-4.1-mini': (0.40, 0.10, 1.60),
+    'gpt-4.1-nano': (0.10, 0.025, 0.40),
+}
+
+
+def model_prices(model: str) -> Optional[tuple]:
+    """Precios del modelo; las versiones fechadas (gpt-4o-2024-08-06) usan los de su familia."""
+    if model in PRECIOS_MODELOS:
+        return PRECIOS_MODELOS[model]
+    family = max((m for m in PRECIOS_MODELOS if model.startswith(m + '-')), key=len, default=None)
+    return PRECIOS_MODELOS.get(family)
+
+
+def usage_tokens(usage: Optional[Mapping]) -> dict:
+    usage = usage or {}
+    details = usage.get('prompt_tokens_details') or {}
+    return {
+        'prompt_tokens': usage.get('prompt_tokens', 0),
+        'cached_tokens': details.get('cached_tokens', 0),
+        'completion_tokens': usage.get('completion_tokens', 0),
+        'total_tokens': usage.get('total_tokens', 0),
+    }
+
+
+def estimate_cost(model: str, usage: Optional[Mapping]) -> Optional[float]:
+    """Costo en USD, o None si el modelo no está en PRECIOS_MODELOS."""
+    prices = model_prices(model)
+    if prices is None:
+        return None
+    tokens = usage_tokens(usage)
+    price_in, price_cached, price_out = prices
+    fresh = tokens['prompt_tokens'] - tokens['cached_tokens']
+    cost = (fresh * price_in + tokens['cached_tokens'] * price_cached + tokens['completion_tokens'] * price_out) / 1e6
+    return round(cost, 6)
+
+
+def add_usage(a: Optional[Mapping], b: Optional[Mapping]) -> dict:
+    """Suma el `usage` de dos llamadas (p. ej. las dos etapas del análisis)."""
+    ta, tb = usage_tokens(a), usage_tokens(b)
+    total = {k: ta[k] + tb[k] for k in ('prompt_tokens', 'completion_tokens', 'total_tokens')}
+    total['prompt_tokens_details'] = {'cached_tokens': ta['cached_tokens'] + tb['cached_tokens']}
+    return total
@@ -1,8 +1,114 @@
-from .knowledge import load_cultural_examples
-from .constants import MAX_FEWSHOT_EJEMPLOS
+import logging
+import threading
+from typing import Optional, Tuple
+from .knowledge import load_cultural_examples, get_knowledge_snapshot
+from .constants import MAX_FEWSHOT_EJEMPLOS, PROMPT_VERSION, SYSTEM_MESSAGE
+from .fewshot import load_budgeted_examples
+from .parsing import normalize_category
+from .tokens import get_token_counter
 
-def build_analysis_prompt() -> str:
-    ejemplos = load_cultural_examples(num_examples=MAX_FEWSHOT_EJEMPLOS)
+logger = logging.getLogger(__name__)
+
+# (PROMPT_VERSION, versión de la base de conocimiento, nº de ejemplos, categorías,
+#  presupuesto de tokens, modelo) -> prompt compilado
+_prompt_cache = {}
+_prompt_cache_lock = threading.Lock()
+_prompt_stats = {"hits": 0, "misses": 0}
+# (clave del prompt compilado, modelo) -> tokens del mensaje de sistema + prompt
+_prompt_tokens = {}
+
+
+def _prompt_key(num_examples, categorias, token_budget, model, snapshot) -> tuple:
+    return (PROMPT_VERSION, snapshot.version, num_examples, categorias, token_budget,
+            model if token_budget else None)
+
+
+def build_analysis_prompt(num_examples: int = MAX_FEWSHOT_EJEMPLOS,
+                          categorias: Optional[Tuple[str, ...]] = None,
+                          token_budget: Optional[int] = None, model: str = 'gpt-4o') -> str:
+    """
+    Retorna el prompt compilado. Solo se recompone cuando cambia PROMPT_VERSION
+    o el contenido de elementos_huanuco.json; el resto es un lookup en memoria.
+    Con `categorias` (códigos de CulturalCategory, ver analysis.routing) los
+    ejemplos few-shot salen solo de esas categorías; se compila uno por combinación.
+    Con `token_budget` se eligen ejemplos (hasta `num_examples`) mientras el
+    mensaje de sistema + el prompt no pasen de ese número de tokens de `model`
+    (ver analysis.fewshot); la imagen no cuenta.
+    """
+    snapshot = get_knowledge_snapshot()
+    key = _prompt_key(num_examples, categorias, token_budget, model, snapshot)
+    prompt = _prompt_cache.get(key)
+    if prompt is not None:
+        _prompt_stats["hits"] += 1
+        return prompt
+
+    with _prompt_cache_lock:
+        prompt = _prompt_cache.get(key)
+        if prompt is None:
+            prompt = _compile_analysis_prompt(_filter_categories(snapshot.elementos, categorias), num_examples,
+                                              token_budget, model)
+            # descartar versiones anteriores de la base de conocimiento
+            for old in [k for k in _prompt_cache if k[:2] != key[:2]]:
+                del _prompt_cache[old]
+            for old in [k for k in _prompt_tokens if k[0][:2] != key[:2]]:
+                del _prompt_tokens[old]
+            _prompt_cache[key] = prompt
+            _prompt_stats["misses"] += 1
+        else:
+            _prompt_stats["hits"] += 1
+    return prompt
+
+
+def count_prompt_tokens(num_examples: int = MAX_FEWSHOT_EJEMPLOS,
+                        categorias: Optional[Tuple[str, ...]] = None,
+                        token_budget: Optional[int] = None, model: str = 'gpt-4o') -> int:
+    """
+    Tokens de `model` (sin calibrar) del mensaje de sistema + el prompt que
+    devuelve build_analysis_prompt con los mismos argumentos. Se cuentan una
+    vez por prompt compilado, no en cada análisis.
+    """
+    prompt = build_analysis_prompt(num_examples, categorias, token_budget, model)
+    key = (_prompt_key(num_examples, categorias, token_budget, model, get_knowledge_snapshot()), model)
+    tokens = _prompt_tokens.get(key)
+    if tokens is None:
+        count = get_token_counter(model).count
+        tokens = _prompt_tokens[key] = count(SYSTEM_MESSAGE) + count(prompt)
+    return tokens
+
+
+def warm_up_prompt_cache() -> None:
+    """Precompila el prompt por defecto al iniciar el proceso."""
+    build_analysis_prompt()
+
+
+def get_prompt_cache_stats() -> dict:
+    return {**_prompt_stats, "entries": len(_prompt_cache)}
+
+
+def _filter_categories(elementos, categorias: Optional[Tuple[str, ...]]):
+    if not categorias:
+        return elementos
+    filtrados = tuple(e for e in elementos if normalize_category(e.get('categoria', '')) in categorias)
+    return filtrados or elementos  # sin ejemplos de esas categorías: todos
+
+
+def _compile_analysis_prompt(elementos, num_examples: int, token_budget: Optional[int] = None,
+                             model: str = 'gpt-4o') -> str:
+    if token_budget:
+        count = get_token_counter(model).count
+        fijo = count(SYSTEM_MESSAGE) + count(_render_prompt(''))
+        if token_budget <= fijo:
+            logger.warning(f"Presupuesto de {token_budget} tokens sin lugar para ejemplos (el resto del prompt usa {fijo})")
+        ejemplos = load_budgeted_examples(token_budget - fijo, count, num_examples, elementos)
+    else:
+        ejemplos = load_cultural_examples(num_examples=num_examples, elementos=elementos)
+    return _render_prompt(ejemplos)
+
+
+def _render_prompt(ejemplos: str) -> str:
+    # Instrucciones fijas primero y los ejemplos al final (lo único que cambia con la
+    # base, el presupuesto o las categorías): OpenAI cachea el prefijo más largo que
+    # se repite entre llamadas, y la imagen va después del texto (ver build_request).
     return f"""
         Analiza la imagen y determina si representa un elemento cultural **ESPECÍFICO de Huánuco, Perú**.
 
@@ -11,9 +117,6 @@ def build_analysis_prompt() -> str:
         - Diferencia entre: (a) elementos genéricos del Perú y (b) variantes **huanuqueñas** (estilo/ingredientes/vestimenta/ritual/ubicación).
         - **IMPORTANTE:** Los ciudadanos de Huánuco consideran SUYOS elementos que pueden parecer genéricos pero tienen variantes/preparaciones/contextos LOCALES específicos (ej: Juane Huanuqueño, Prestiños, Sango, Mondongo Huanuqueño, etc.).
 
-        === EJEMPLOS VERIFICADOS (FEW-SHOT) ===
-        {ejemplos}
-
         === CHECKLIST DE DECISIÓN (paso a paso) ===
         1) ¿Identificas un elemento de la imagen que coincida con algún ejemplo o variante clara de Huánuco?
         2) Si sí: explica **qué rasgos visuales** soportan la identificación (ingredientes, vestimenta, arquitectura, contexto geográfico).
@@ -60,4 +163,7 @@ def build_analysis_prompt() -> str:
         - Si NO es específico de Huánuco → "es_de_huanuco": false y "confianza" < 0.30.
         - Si SÍ coincide con ejemplos huanuqueños → "es_de_huanuco": true y "confianza" ≥ 0.70.
         - No incluyas texto fuera del JSON.
+
+        === EJEMPLOS VERIFICADOS (FEW-SHOT) ===
+        {ejemplos}
         """.strip()
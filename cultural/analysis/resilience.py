@@ -0,0 +1,265 @@
+"""
+Protección frente a un OpenAI lento o saturado (compartida por hilos y corrutinas del proceso).
+
+- CircuitBreaker: si en la ventana reciente fallan (o tardan demasiado) muchas
+  llamadas, se abre y las siguientes fallan al instante en vez de esperar el
+  timeout. Pasado `open_seconds` deja pasar una llamada de prueba (semiabierto);
+  si sale bien se cierra, si no vuelve a abrirse.
+- AdaptiveLimiter: límite de llamadas en vuelo que sube de a poco mientras
+  OpenAI responde bien y se reduce a una fracción ante 429, 5xx, timeouts o
+  latencia alta (AIMD).
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """El circuito está abierto o el límite de concurrencia está lleno; `retry_after` en segundos."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        window: int = 20,
+        min_calls: int = 10,
+        failure_rate: float = 0.5,
+        slow_call_seconds: float = 30.0,
+        slow_call_rate: float = 0.8,
+        open_seconds: float = 30.0,
+        half_open_calls: int = 1,
+    ):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+
+        self._outcomes = deque(maxlen=window)  # (falló, lenta)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self._transitions: Dict[str, int] = {}
+        self._rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._move(HALF_OPEN)
+        return self._state
+
+    def _move(self, state: str) -> None:
+        name = f'{self._state}->{state}'
+        self._transitions[name] = self._transitions.get(name, 0) + 1
+        logger.warning(f"Circuito OpenAI: {name}")
+        self._state = state
+        self._probes = 0
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        elif state == CLOSED:
+            self._outcomes.clear()
+
+    def allow(self) -> None:
+        """Reserva el paso de una llamada o lanza CircuitOpenError."""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                return
+            self._rejected += 1
+            retry_after = max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+        raise CircuitOpenError("OpenAI no está disponible en este momento; intenta más tarde",
+                               retry_after=round(retry_after, 1) or 1.0)
+
+    def record(self, failed: bool, seconds: float) -> None:
+        slow = seconds >= self.slow_call_seconds
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN:
+                self._move(OPEN if failed or slow else CLOSED)
+                return
+            if state == OPEN:
+                return  # llamada que empezó antes de abrirse
+            self._outcomes.append((failed, slow))
+            n = len(self._outcomes)
+            if n < self.min_calls:
+                return
+            failures = sum(1 for f, _ in self._outcomes if f)
+            slows = sum(1 for _, s in self._outcomes if s)
+            if failures / n >= self.failure_rate or slows / n >= self.slow_call_rate:
+                self._move(OPEN)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            state = self._current_state()
+            n = len(self._outcomes)
+            return {
+                'state': state,
+                'window_calls': n,
+                'failure_rate': round(sum(1 for f, _ in self._outcomes if f) / n, 4) if n else 0.0,
+                'slow_rate': round(sum(1 for _, s in self._outcomes if s) / n, 4) if n else 0.0,
+                'rejected': self._rejected,
+                'transitions': dict(self._transitions),
+            }
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        initial: int = 10,
+        min_limit: int = 1,
+        max_limit: int = 100,
+        backoff: float = 0.7,
+        latency_target: float = 20.0,
+        queue_timeout: float = 5.0,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_target = latency_target
+        self.queue_timeout = queue_timeout
+
+        self._limit = float(max(min_limit, min(initial, max_limit)))
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        # corrutinas esperando un cupo: (loop, future); release() las despierta desde cualquier hilo
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._rejected = 0
+        self._decreases = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _try_acquire(self) -> bool:
+        if self._in_flight < int(self._limit):
+            self._in_flight += 1
+            return True
+        return False
+
+    def _reject(self) -> CircuitOpenError:
+        self._rejected += 1
+        return CircuitOpenError("Demasiados análisis en curso; intenta en unos segundos",
+                                retry_after=self.queue_timeout)
+
+    def _notify(self) -> None:
+        """Despierta a los hilos y corrutinas en espera (con el lock tomado); cada uno reintenta."""
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:  # loop ya cerrado
+                pass
+
+    def cancel(self) -> None:
+        """Devuelve un cupo sin llamada (el circuito la rechazó)."""
+        with self._cond:
+            self._in_flight -= 1
+            self._notify()
+
+    def acquire(self, timeout: Optional[float] = None) -> None:
+        timeout = self.queue_timeout if timeout is None else timeout
+        with self._cond:
+            if not self._cond.wait_for(self._try_acquire, timeout=timeout):
+                raise self._reject()
+
+    async def aacquire(self, timeout: Optional[float] = None) -> None:
+        # sin bloquear el event loop: espera a que release() o cancel() avisen, hasta el plazo
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + (self.queue_timeout if timeout is None else timeout)
+        while True:
+            with self._cond:
+                if self._try_acquire():
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._reject()
+                entry = (loop, loop.create_future())
+                self._async_waiters.append(entry)
+            try:
+                await asyncio.wait_for(entry[1], remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._cond:
+                    if entry in self._async_waiters:
+                        self._async_waiters.remove(entry)
+
+    def release(self, overloaded: bool, seconds: float) -> None:
+        """`overloaded`: 429, 5xx, timeout o error de conexión."""
+        with self._cond:
+            self._in_flight -= 1
+            if overloaded or seconds >= self.latency_target:
+                self._limit = max(float(self.min_limit), self._limit * self.backoff)
+                self._decreases += 1
+            else:
+                # +1 por cada `limit` llamadas exitosas
+                self._limit = min(float(self.max_limit), self._limit + 1.0 / self._limit)
+            self._notify()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'limit': int(self._limit),
+                'in_flight': self._in_flight,
+                'rejected': self._rejected,
+                'decreases': self._decreases,
+            }
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class UpstreamGuard:
+    """Circuito + límite adaptativo alrededor de cada llamada (ver openai_client)."""
+
+    def __init__(self, breaker: CircuitBreaker, limiter: AdaptiveLimiter):
+        self.breaker = breaker
+        self.limiter = limiter
+
+    def enter(self) -> None:
+        self.limiter.acquire()
+        self._allow()
+
+    async def aenter(self) -> None:
+        await self.limiter.aacquire()
+        self._allow()
+
+    def _allow(self) -> None:
+        try:
+            self.breaker.allow()
+        except CircuitOpenError:
+            self.limiter.cancel()
+            raise
+
+    def exit(self, failed: bool, overloaded: bool, seconds: float) -> None:
+        """`failed`: la llamada terminó en error de OpenAI; `overloaded`: algún intento recibió 429/5xx/timeout."""
+        self.limiter.release(overloaded or failed, seconds)
+        self.breaker.record(failed, seconds)
+
+    def stats(self) -> Dict:
+        return {'circuit': self.breaker.stats(), 'concurrency': self.limiter.stats()}
@@ -0,0 +1,52 @@
+"""
+Modo en dos etapas: una llamada corta (imagen en detail=low) pide solo la
+categoría y el análisis usa los ejemplos few-shot de esa categoría y sus
+vecinas, en vez de los de todas (ver build_analysis_prompt(categorias=...)).
+"""
+import json
+from typing import Optional, Tuple
+
+from .parsing import extract_json, normalize_category
+
+ROUTING_MAX_TOKENS = 20
+
+# Categorías cuyos ejemplos también sirven al analizar una foto de la categoría
+# (p. ej. las danzas de la base están en Leyendas y Tradiciones)
+CATEGORIAS_VECINAS = {
+    'GASTRONOMIA': ('FLORA_MEDICINAL', 'FESTIVIDADES'),
+    'PATRIMONIO_ARQUEOLOGICO': ('LEYENDAS_Y_TRADICIONES', 'NATURALEZA_CULTURAL'),
+    'FLORA_MEDICINAL': ('NATURALEZA_CULTURAL', 'GASTRONOMIA'),
+    'LEYENDAS_Y_TRADICIONES': ('FESTIVIDADES', 'DANZA', 'PATRIMONIO_ARQUEOLOGICO'),
+    'FESTIVIDADES': ('DANZA', 'MUSICA', 'LEYENDAS_Y_TRADICIONES', 'GASTRONOMIA'),
+    'DANZA': ('FESTIVIDADES', 'MUSICA', 'VESTIMENTA', 'LEYENDAS_Y_TRADICIONES'),
+    'MUSICA': ('DANZA', 'FESTIVIDADES', 'LEYENDAS_Y_TRADICIONES'),
+    'VESTIMENTA': ('DANZA', 'ARTE_POPULAR', 'FESTIVIDADES', 'LEYENDAS_Y_TRADICIONES'),
+    'ARTE_POPULAR': ('VESTIMENTA', 'LEYENDAS_Y_TRADICIONES', 'PATRIMONIO_ARQUEOLOGICO'),
+    'NATURALEZA_CULTURAL': ('FLORA_MEDICINAL', 'PATRIMONIO_ARQUEOLOGICO', 'LEYENDAS_Y_TRADICIONES'),
+}
+
+ROUTING_PROMPT = """
+Clasifica la imagen en UNA de estas categorías de elementos culturales de Huánuco, Perú:
+Gastronomía, Patrimonio Arqueológico, Festividades, Danza, Música, Vestimenta, Arte Popular,
+Naturaleza/Cultural, Flora Medicinal, Leyendas y Tradiciones, Otro.
+Devuelve solo este JSON: {"categoria": "..."}
+""".strip()
+
+
+def routed_categories(categoria: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """Categoría + vecinas, ordenadas; None (todas) si es OTRO o desconocida."""
+    if categoria not in CATEGORIAS_VECINAS:
+        return None
+    return tuple(sorted({categoria, *CATEGORIAS_VECINAS[categoria]}))
+
+
+def parse_routing_response(openai_response: dict) -> Optional[str]:
+    """Categoría normalizada de la respuesta de la primera etapa, o None si no se entiende."""
+    try:
+        content = openai_response['choices'][0]['message']['content']
+        categoria = json.loads(extract_json(content)).get('categoria')
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+        return None
+    if not isinstance(categoria, str):
+        return None
+    return normalize_category(categoria)
@@ -0,0 +1,104 @@
+"""
+Salida estructurada: JSON schema del análisis para response_format (OpenAI lo
+respeta en modo strict) y un validador precompilado para leer la respuesta sin
+el parser tolerante (ver parse_structured en analysis.parsing).
+
+El schema exige todos los campos que pide el prompt y la categoría como código
+de CulturalCategory; los códigos los pasa quien llama (el paquete no depende de
+Django).
+"""
+from functools import lru_cache
+from typing import Callable, Dict, Sequence, Tuple
+
+REQUIRED_FIELDS = ('titulo', 'categoria', 'confianza', 'descripcion', 'contexto_cultural',
+                   'periodo_historico', 'ubicacion', 'significado')
+
+SCHEMA_NAME = 'analisis_cultural'
+
+Validator = Callable[[object], None]
+
+
+def analysis_schema(categorias: Sequence[str]) -> Dict:
+    texto = {'type': 'string'}
+    lista = {'type': 'array', 'items': {'type': 'string'}}
+    properties = {
+        'titulo': texto,
+        'categoria': {'type': 'string', 'enum': list(categorias)},
+        'descripcion': texto,
+        'confianza': {'type': 'number', 'description': 'Entre 0 y 1'},
+        'es_de_huanuco': {'type': 'boolean'},
+        'razones': lista,
+        'dudas': lista,
+        'contexto_cultural': texto,
+        'periodo_historico': texto,
+        'ubicacion': texto,
+        'significado': texto,
+    }
+    # strict: todas las propiedades son obligatorias y no se admiten otras
+    return {
+        'type': 'object',
+        'properties': properties,
+        'required': list(properties),
+        'additionalProperties': False,
+    }
+
+
+def compile_validator(schema: Dict, path: str = '$') -> Validator:
+    """Función que lanza ValueError si el valor no cumple `schema` (el subconjunto que usa analysis_schema)."""
+    kind = schema.get('type')
+    if kind == 'object':
+        fields = tuple((name, compile_validator(sub, f'{path}.{name}')) for name, sub in schema['properties'].items())
+        names = frozenset(name for name, _ in fields)
+        required = frozenset(schema.get('required', ()))
+        closed = schema.get('additionalProperties') is False
+        exact = closed and required == names  # caso strict: una sola comparación de conjuntos
+
+        def validate(value):
+            if type(value) is not dict:
+                raise ValueError(f"{path}: se esperaba un objeto")
+            keys = value.keys()
+            if not (keys == names if exact else required <= keys and (not closed or keys <= names)):
+                missing, extra = sorted(required - keys), sorted(keys - names) if closed else []
+                raise ValueError(f"{path}: " + '; '.join(
+                    [f"faltan {missing}"] * bool(missing) + [f"no permitidos {extra}"] * bool(extra)))
+            for name, check in fields:
+                if name in value:
+                    check(value[name])
+        return validate
+
+    if kind == 'array':
+        check_item = compile_validator(schema['items'], f'{path}[]')
+
+        def validate(value):
+            if type(value) is not list:
+                raise ValueError(f"{path}: se esperaba una lista")
+            for item in value:
+                check_item(item)
+        return validate
+
+    if 'enum' in schema:  # de strings
+        allowed = frozenset(schema['enum'])
+
+        def validate(value):
+            if type(value) is not str or value not in allowed:
+                raise ValueError(f"{path}: valor no permitido {value!r}")
+        return validate
+
+    # type() exacto: json.loads solo produce estos tipos y así True no pasa por número
+    types = {'string': (str,), 'number': (int, float), 'integer': (int,), 'boolean': (bool,)}[kind]
+
+    def validate(value):
+        if type(value) not in types:
+            raise ValueError(f"{path}: se esperaba {kind}")
+    return validate
+
+
+@lru_cache(maxsize=8)
+def get_structured_output(categorias: Tuple[str, ...]) -> Tuple[Dict, Validator]:
+    """(response_format para la petición, validador de la respuesta); se arman una vez."""
+    schema = analysis_schema(categorias)
+    response_format = {
+        'type': 'json_schema',
+        'json_schema': {'name': SCHEMA_NAME, 'strict': True, 'schema': schema},
+    }
+    return response_format, compile_validator(schema)
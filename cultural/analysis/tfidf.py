@@ -0,0 +1,122 @@
+"""
+Matcher TF-IDF de n-gramas de caracteres sobre titulo, descripcion y contexto_cultural.
+
+La matriz se guarda por columnas (CSC) para que puntuar un análisis contra toda la
+base sea un solo producto matriz-vector disperso que solo toca las columnas de los
+n-gramas de la consulta. Las columnas demasiado frecuentes (MAX_DF) se descartan,
+como en sklearn, para que ninguna columna recorra casi toda la base.
+
+Los trigramas se codifican como enteros (3 code points de 21 bits) para construir
+el índice con operaciones vectorizadas en lugar de diccionarios de Python.
+"""
+import re
+from typing import Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+
+MAX_DF = 0.5  # n-gramas presentes en más de esta fracción de elementos no discriminan
+FIELD_WEIGHTS = {'titulo': 2.0, 'descripcion': 1.0, 'contexto_cultural': 1.0}
+
+_SPACES = re.compile(r"\s+")
+
+
+def _normalize(text) -> str:
+    return _SPACES.sub(" ", str(text or "").lower()).strip()
+
+
+def _trigram_keys(texts: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """(documento, trigrama codificado) para cada trigrama de cada texto con padding."""
+    padded = [f" {t} " if t else "" for t in texts]
+    lengths = np.fromiter((len(p) for p in padded), dtype=np.int64, count=len(padded))
+    codes = np.frombuffer("".join(padded).encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+    ngrams = np.maximum(lengths - 2, 0)
+    if not ngrams.sum():
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    pos = np.repeat(starts - np.concatenate(([0], np.cumsum(ngrams)[:-1])), ngrams) + np.arange(ngrams.sum())
+    keys = (codes[pos] << 42) | (codes[pos + 1] << 21) | codes[pos + 2]
+    docs = np.repeat(np.arange(len(texts), dtype=np.int64), ngrams)
+    return docs, keys
+
+
+def _weighted_trigrams(docs: Sequence[Mapping]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Trigramas ponderados por campo: arrays (documento, clave, peso) sin agrupar."""
+    doc_ids, keys, weights = [], [], []
+    for field, weight in FIELD_WEIGHTS.items():
+        d, k = _trigram_keys([_normalize(doc.get(field, '')) for doc in docs])
+        doc_ids.append(d)
+        keys.append(k)
+        weights.append(np.full(len(k), weight))
+    return np.concatenate(doc_ids), np.concatenate(keys), np.concatenate(weights)
+
+
+class TfidfIndex:
+    """Se construye una vez por versión de la base (ver KnowledgeSnapshot.derived)."""
+
+    def __init__(self, elementos: Sequence[Mapping]):
+        self.size = len(elementos)
+        docs, keys, weights = _weighted_trigrams(elementos)
+
+        # vocabulario = claves ordenadas; columna = posición en self._keys
+        self._keys, cols = np.unique(keys, return_inverse=True)
+        vocab = len(self._keys)
+        pairs, pair_ix = np.unique(docs * max(vocab, 1) + cols, return_inverse=True)
+        tf = np.bincount(pair_ix, weights=weights)
+        rows, cols = pairs // max(vocab, 1), pairs % max(vocab, 1)
+        vals = 1.0 + np.log(tf)  # tf sublineal
+
+        df = np.bincount(cols, minlength=vocab)
+        self._idf = np.log((1.0 + self.size) / (1.0 + df)) + 1.0
+        self._idf_oov = np.log(1.0 + self.size) + 1.0
+        if self.size >= 10:  # en bases muy pequeñas todo n-grama es "frecuente"
+            self._stop = df > MAX_DF * self.size
+            keep = ~self._stop[cols]
+            rows, cols, vals = rows[keep], cols[keep], vals[keep]
+        else:
+            self._stop = np.zeros(vocab, dtype=bool)
+        vals = vals * self._idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=vals * vals, minlength=self.size))
+        vals /= np.maximum(norms, 1e-12)[rows]
+
+        # `pairs` ya viene ordenado por documento; reordenar por columna (CSC)
+        order = np.argsort(cols, kind='stable')
+        self._rows = rows[order].astype(np.int32)
+        self._data = vals[order].astype(np.float32)
+        self._indptr = np.concatenate(([0], np.cumsum(np.bincount(cols, minlength=vocab))))
+
+    def scores(self, doc: Mapping) -> np.ndarray:
+        """Similitud coseno de `doc` contra todos los elementos."""
+        _, keys, weights = _weighted_trigrams([doc])
+        if not len(keys) or not len(self._keys):
+            return np.zeros(self.size)
+
+        qkeys, inv = np.unique(keys, return_inverse=True)
+        w = 1.0 + np.log(np.bincount(inv, weights=weights))
+        cols = np.minimum(np.searchsorted(self._keys, qkeys), len(self._keys) - 1)
+        known = self._keys[cols] == qkeys
+        known_cols = cols[known]
+        active = ~known
+        active[known] = ~self._stop[known_cols]
+        idf = np.full(len(qkeys), self._idf_oov)
+        idf[known] = self._idf[known_cols]
+        w = w * idf
+        norm = np.sqrt(np.sum(w[active] ** 2))
+
+        use = known & active
+        cols, w = cols[use], w[use]
+        if not len(cols) or norm == 0:
+            return np.zeros(self.size)
+
+        starts, lengths = self._indptr[cols], np.diff(self._indptr)[cols]
+        idx = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths) + np.arange(lengths.sum())
+        return np.bincount(self._rows[idx], weights=self._data[idx] * np.repeat(w / norm, lengths),
+                           minlength=self.size)
+
+    def best_match(self, doc: Mapping, elementos: Sequence[Mapping]) -> Tuple[Optional[Mapping], float]:
+        if not self.size:
+            return None, 0.0
+        s = self.scores(doc)
+        i = int(np.argmax(s))  # ante empate, el primero (igual que el recorrido lineal)
+        if s[i] <= 0:
+            return None, 0.0
+        return elementos[i], float(min(s[i], 1.0))
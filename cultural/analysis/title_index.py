@@ -0,0 +1,123 @@
+"""
+Índice de trigramas sobre los títulos de la base de conocimiento.
+
+Genera una lista corta de candidatos para `find_best_match` y luego usa cotas
+superiores exactas de `fuzzy_match_score` para descartar el resto sin perder
+ningún match: el resultado es idéntico al recorrido lineal.
+"""
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+SHORTLIST_SIZE = 32  # candidatos evaluados antes de podar por cota
+_EPS = 1e-9          # margen para errores de redondeo en la cota
+
+
+def _trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TitleIndex:
+    """Se construye una vez por versión de la base (ver KnowledgeSnapshot.derived)."""
+
+    def __init__(self, elementos: Sequence[Dict]):
+        titulos = [(e.get('titulo') or '').lower() for e in elementos]
+        self.size = len(titulos)
+
+        postings: Dict[str, List[int]] = {}
+        words: Dict[str, List[int]] = {}
+        alphabet: Dict[str, int] = {}
+        char_counts = []
+        self._nwords = np.zeros(self.size, dtype=np.int32)
+        for i, t in enumerate(titulos):
+            for g in _trigrams(t):
+                postings.setdefault(g, []).append(i)
+            ws = set(t.split())
+            self._nwords[i] = len(ws)
+            for w in ws:
+                words.setdefault(w, []).append(i)
+            counts = Counter(t)
+            for ch in counts:
+                alphabet.setdefault(ch, len(alphabet))
+            char_counts.append(counts)
+
+        self._postings = {g: np.asarray(ix, dtype=np.int32) for g, ix in postings.items()}
+        self._words = {w: np.asarray(ix, dtype=np.int32) for w, ix in words.items()}
+        self._alphabet = alphabet
+        self._lens = np.fromiter((len(t) for t in titulos), dtype=np.int64, count=self.size)
+        # histograma de caracteres por título (cota de SequenceMatcher.quick_ratio)
+        self._chars = np.zeros((self.size, max(len(alphabet), 1)), dtype=np.uint16)
+        for i, counts in enumerate(char_counts):
+            for ch, n in counts.items():
+                self._chars[i, alphabet[ch]] = n
+
+    def shortlist(self, titulo: str, k: int = SHORTLIST_SIZE) -> np.ndarray:
+        """Índices con más trigramas en común con `titulo` (como máximo k)."""
+        hits = [self._postings[g] for g in _trigrams(titulo.lower()) if g in self._postings]
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        counts = np.bincount(np.concatenate(hits), minlength=self.size)
+        nonzero = np.flatnonzero(counts)
+        if len(nonzero) <= k:
+            return nonzero
+        return nonzero[np.argpartition(-counts[nonzero], k)[:k]]
+
+    def upper_bounds(self, titulo: str) -> np.ndarray:
+        """Cota superior de fuzzy_match_score(titulo, elem) para cada elemento."""
+        t = titulo.lower()
+        q = np.zeros(self._chars.shape[1], dtype=np.uint16)
+        for ch, n in Counter(t).items():
+            j = self._alphabet.get(ch)
+            if j is not None:
+                q[j] = n
+        overlap = np.minimum(self._chars, q).sum(axis=1, dtype=np.int64)
+        total = self._lens + len(t)
+        seq_ub = np.where(total > 0, 2.0 * overlap / np.maximum(total, 1), 1.0)
+
+        qwords = set(t.split())
+        if not qwords:
+            return seq_ub + _EPS
+        shared = np.zeros(self.size, dtype=np.int64)
+        for w in qwords:
+            ix = self._words.get(w)
+            if ix is not None:
+                shared[ix] += 1
+        union = self._nwords + len(qwords) - shared
+        word_sim = np.where(union > 0, shared / np.maximum(union, 1), 0.0)
+        combined = seq_ub * 0.6 + word_sim * 0.4
+        return np.where(self._nwords > 0, combined, seq_ub) + _EPS
+
+    def best_match(self, titulo: str, elementos: Sequence[Dict], score_fn,
+                   min_score: float = 0.0) -> Tuple[Optional[Dict], float]:
+        """
+        Mismo resultado que el recorrido lineal: mayor score y, ante empate,
+        el elemento que aparece primero. Con `min_score` se podan además los
+        elementos que no pueden superarlo (el resultado solo es exacto si el
+        mejor score es mayor que `min_score`).
+        """
+        best_i, best_score = -1, 0.0
+        evaluated = set()
+
+        def consider(i: int):
+            nonlocal best_i, best_score
+            evaluated.add(i)
+            score = score_fn(titulo, elementos[i].get('titulo', ''))
+            if score > best_score or (score == best_score and best_i > i):
+                best_i, best_score = i, score
+
+        for i in self.shortlist(titulo).tolist():
+            consider(i)
+
+        ub = self.upper_bounds(titulo)
+        remaining = np.flatnonzero(ub >= max(best_score, min_score))
+        for i in remaining[np.argsort(-ub[remaining], kind='stable')].tolist():
+            if ub[i] < max(best_score, min_score):
+                break
+            if i not in evaluated:
+                consider(i)
+
+        if best_i < 0:
+            return None, 0.0
+        return elementos[best_i], best_score
@@ -0,0 +1,144 @@
+"""
+Conteo local de tokens (sin llamar a la API) para presupuestar el prompt y
+predecir usage.prompt_tokens.
+
+Con `tiktoken` instalado se usa el BPE del modelo (o200k_base en gpt-4o y
+gpt-4.1). Si no, un estimador que separa el texto como el pre-tokenizador de
+esos modelos (palabras, números de hasta 3 cifras, puntuación, espacios) y
+cuenta cada pieza según su largo (~4.5 letras por token en español).
+
+La predicción de cada llamada además se corrige con un factor que se ajusta
+con el usage.prompt_tokens real de las respuestas (TokenCounter.calibrate).
+El conteo que decide qué ejemplos entran en el prompt no usa ese factor: el
+prompt compilado debe ser igual en todos los workers.
+"""
+import logging
+import math
+import re
+import threading
+from functools import lru_cache
+from typing import Dict, Optional, Sequence
+
+try:
+    import tiktoken  # BPE exacto (opcional)
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+_PIECE = re.compile(r"[^\W\d_]+|\d{1,3}|[^\w\s]+|\s+", re.UNICODE)
+LETTERS_PER_TOKEN = 4.5      # palabras largas se parten en varios tokens
+SYMBOLS_PER_TOKEN = 2        # puntuación y símbolos (emojis, comillas tipográficas) suelen ir de a 1–2
+MESSAGE_OVERHEAD = 4         # tokens de formato por mensaje del chat (rol y separadores)
+REPLY_OVERHEAD = 3           # cebado de la respuesta del asistente
+CALIBRATION_ALPHA = 0.05     # peso de cada respuesta en el factor de corrección
+CALIBRATION_BOUNDS = (0.6, 1.6)
+
+_ENCODINGS = {'gpt-4o': 'o200k_base', 'gpt-4.1': 'o200k_base', 'gpt-4': 'cl100k_base'}
+
+
+@lru_cache(maxsize=256)
+def estimate_tokens(text: str) -> int:
+    """Tokens estimados sin tiktoken (los prompts compilados se repiten: se memoiza)."""
+    tokens = 0
+    for piece in _PIECE.findall(text):
+        c = piece[0]
+        if c.isspace():
+            # un salto de línea con la sangría siguiente suele ser un solo token
+            tokens += 1 if len(piece) <= 16 else 2
+        elif c.isalpha():
+            tokens += max(1, math.ceil(len(piece) / LETTERS_PER_TOKEN))
+        elif c.isdigit():
+            tokens += 1
+        else:
+            tokens += math.ceil(len(piece) / SYMBOLS_PER_TOKEN)
+    return tokens
+
+
+def _encoding_for(model: str):
+    if tiktoken is None:
+        return None
+    family = max((m for m in _ENCODINGS if model == m or model.startswith(m + '-')), key=len, default=None)
+    try:
+        return tiktoken.get_encoding(_ENCODINGS[family]) if family else tiktoken.encoding_for_model(model)
+    except Exception as e:  # modelo desconocido o sin acceso para descargar el BPE
+        logger.warning(f"tiktoken no disponible para {model}; se usa el estimador: {e}")
+        return None
+
+
+class TokenCounter:
+    def __init__(self, model: str):
+        self.model = model
+        self._encoding = _encoding_for(model)
+        self._lock = threading.Lock()
+        self.factor = 1.0
+        self.samples = 0
+        self._abs_error = 0.0  # media móvil de |predicho - real| / real
+
+    @property
+    def exact(self) -> bool:
+        return self._encoding is not None
+
+    def count(self, text: str) -> int:
+        """Tokens del texto (sin corrección; estable entre procesos)."""
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return estimate_tokens(text)
+
+    def _fixed(self, texts: Sequence[str], image_tokens: int) -> int:
+        return image_tokens + MESSAGE_OVERHEAD * len(texts) + REPLY_OVERHEAD
+
+    def predict_prompt_tokens(self, texts: Sequence[str], image_tokens: int = 0,
+                              text_tokens: Optional[int] = None) -> int:
+        """
+        usage.prompt_tokens esperado de una llamada con esos textos (sistema, usuario) e imagen.
+        `text_tokens`: count() de `texts` ya hecho (p. ej. prompt.count_prompt_tokens).
+        """
+        if text_tokens is None:
+            text_tokens = sum(self.count(t) for t in texts)
+        return round(text_tokens * self.factor) + self._fixed(texts, image_tokens)
+
+    def calibrate(self, texts: Sequence[str], image_tokens: int, actual: int,
+                  text_tokens: Optional[int] = None) -> None:
+        """Ajusta el factor con el usage.prompt_tokens real (solo con el estimador)."""
+        if actual <= 0:
+            return
+        if text_tokens is None:
+            text_tokens = sum(self.count(t) for t in texts)
+        predicted = self.predict_prompt_tokens(texts, image_tokens, text_tokens)
+        with self._lock:
+            self.samples += 1
+            error = abs(predicted - actual) / actual
+            if self.samples == 1:
+                self._abs_error = error
+            else:
+                self._abs_error += CALIBRATION_ALPHA * (error - self._abs_error)
+            if self.exact or not text_tokens:
+                return
+            ratio = (actual - self._fixed(texts, image_tokens)) / text_tokens
+            ratio = min(max(ratio, CALIBRATION_BOUNDS[0]), CALIBRATION_BOUNDS[1])
+            self.factor += CALIBRATION_ALPHA * (ratio - self.factor)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'model': self.model,
+                'exact': self.exact,
+                'factor': round(self.factor, 4),
+                'samples': self.samples,
+                'mean_abs_error': round(self._abs_error, 4),
+            }
+
+
+_counters: Dict[str, TokenCounter] = {}
+_counters_lock = threading.Lock()
+
+
+def get_token_counter(model: str) -> TokenCounter:
+    counter = _counters.get(model)
+    if counter is None:
+        with _counters_lock:
+            counter = _counters.get(model)
+            if counter is None:
+                counter = _counters[model] = TokenCounter(model)
+    return counter
@@ -2,8 +2,18 @@
 Validación mejorada con búsqueda semántica y ajuste dinámico de confianza
 """
 from difflib import SequenceMatcher
-from typing import Dict, List
-from .knowledge import load_verified_elements
+from typing import Dict, List, Optional
+from .knowledge import get_knowledge_snapshot
+from .title_index import TitleIndex
+from .tfidf import TfidfIndex
+from .embeddings import EmbeddingIndex
+
+MATCH_THRESHOLD = 0.60  # Umbral de match
+
+# Métodos de búsqueda del elemento de referencia (se reportan en validacion.metodo)
+METODO_TITULO = 'base_conocimiento_local_v2'  # fuzzy sobre el título
+METODO_TFIDF = 'tfidf_ngramas_v1'             # coseno TF-IDF sobre título, descripción y contexto
+METODO_EMBEDDINGS = 'embeddings_locales_v1'   # coseno sobre embeddings locales (sin API)
 
 def fuzzy_match_score(text1: str, text2: str) -> float:
     """Calcula similitud entre dos textos usando múltiples métricas"""
@@ -23,8 +33,16 @@ def fuzzy_match_score(text1: str, text2: str) -> float:
     # 3. Combinación ponderada
     return (seq_sim * 0.6) + (word_sim * 0.4)
 
-def find_best_match(titulo: str, elementos: List[Dict]) -> tuple:
-    """Encuentra el mejor match en la base de conocimiento"""
+def find_best_match(titulo: str, elementos: List[Dict], index: Optional[TitleIndex] = None,
+                    min_score: float = 0.0) -> tuple:
+    """
+    Encuentra el mejor match en la base de conocimiento.
+    Con `index` solo se evalúan los candidatos que pueden superar al mejor actual
+    (y a `min_score`, si el llamador ignora los matches por debajo de ese umbral).
+    """
+    if index is not None:
+        return index.best_match(titulo, elementos, fuzzy_match_score, min_score=min_score)
+
     best_elem = None
     best_score = 0.0
     
@@ -58,23 +76,55 @@ def adjust_confidence(
     else:
         return original_conf  # Sin cambio
 
-def validate_with_local_knowledge(analysis: dict) -> dict:
+def _match_by_title(analysis: dict, snapshot) -> tuple:
+    titulo = analysis.get('titulo', '')
+    if not titulo:
+        return None, 0.0
+    index = snapshot.derived('title_index', TitleIndex)
+    return find_best_match(titulo, snapshot.elementos, index=index, min_score=MATCH_THRESHOLD)
+
+def _match_by_tfidf(analysis: dict, snapshot) -> tuple:
+    index = snapshot.derived('tfidf_index', TfidfIndex)
+    return index.best_match(analysis, snapshot.elementos)
+
+def get_embedding_index(snapshot=None) -> EmbeddingIndex:
+    snapshot = snapshot or get_knowledge_snapshot()
+    return snapshot.derived('embedding_index', EmbeddingIndex.for_elements)
+
+def semantic_search(analysis: dict, k: int = 5, snapshot=None) -> List[tuple]:
+    """Top-k (elemento, similitud coseno) según los embeddings locales."""
+    snapshot = snapshot or get_knowledge_snapshot()
+    index = get_embedding_index(snapshot)
+    return [(snapshot.elementos[i], score) for i, score in index.top_k(analysis, k)]
+
+def _match_by_embeddings(analysis: dict, snapshot) -> tuple:
+    top = semantic_search(analysis, k=1, snapshot=snapshot)
+    if not top or top[0][1] <= 0:
+        return None, 0.0
+    return top[0]
+
+MATCHERS = {
+    METODO_TITULO: _match_by_title,
+    METODO_TFIDF: _match_by_tfidf,
+    METODO_EMBEDDINGS: _match_by_embeddings,
+}
+
+def validate_with_local_knowledge(analysis: dict, metodo: str = METODO_TITULO) -> dict:
     """
     Valida el análisis contra la base de conocimiento local
     y ajusta confianza/descripción si hay match
     """
-    elementos = load_verified_elements()
-    if not elementos or not analysis:
-        return analysis
+    if metodo not in MATCHERS:
+        raise ValueError(f"Método de validación desconocido: {metodo}")
 
-    titulo = analysis.get('titulo', '')
-    if not titulo:
+    snapshot = get_knowledge_snapshot()
+    if not snapshot.elementos or not analysis:
         return analysis
 
     # Buscar mejor match
-    best_elem, similarity = find_best_match(titulo, elementos)
+    best_elem, similarity = MATCHERS[metodo](analysis, snapshot)
     
-    if best_elem and similarity > 0.60:  # Umbral de match
+    if best_elem and similarity > MATCH_THRESHOLD:
         conf_orig = float(analysis.get('confianza', 0.5))
         conf_ref = float(best_elem.get('confianza', 0.8))
         conf_new = adjust_confidence(conf_orig, conf_ref, similarity)
@@ -84,7 +134,7 @@ def validate_with_local_knowledge(analysis: dict) -> dict:
         
         # Agregar metadata de validación
         analysis.setdefault('validacion', {}).update({
-            'metodo': 'base_conocimiento_local_v2',
+            'metodo': metodo,
             'elemento_referencia': best_elem.get('titulo'),
             'similitud': round(similarity, 3),
             'confianza_original': conf_orig,
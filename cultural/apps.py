@@ -1,6 +1,32 @@
+import logging
 from django.apps import AppConfig
 
+logger = logging.getLogger(__name__)
+
 
 class CulturalConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'cultural'
+
+    def ready(self):
+        # Precompilar el prompt para que la primera petición no pague el costo
+        from .analysis.prompt import warm_up_prompt_cache
+        try:
+            warm_up_prompt_cache()
+        except Exception as e:
+            logger.warning(f"No se pudo precompilar el prompt: {e}")
+
+        # Abrir (memory-map) los embeddings si la validación los usa
+        from django.conf import settings
+        from .analysis.validation import METODO_EMBEDDINGS, get_embedding_index
+        if getattr(settings, 'LOCAL_VALIDATION_METHOD', None) == METODO_EMBEDDINGS:
+            try:
+                get_embedding_index()
+            except Exception as e:
+                logger.warning(f"No se pudieron cargar los embeddings: {e}")
+
+        # Recuperar y purgar trabajos en segundo plano: el hilo arranca con la primera
+        # petición de cada proceso (sin consultas a la base de datos dentro de ready())
+        from django.core.signals import request_started
+        from .jobs import JOB_MAINTENANCE_UID, start_job_maintenance
+        request_started.connect(start_job_maintenance, dispatch_uid=JOB_MAINTENANCE_UID)
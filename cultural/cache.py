@@ -0,0 +1,286 @@
+# cultural/cache.py
+"""
+Caché de análisis en tres niveles:
+
+1. LRU en memoria del proceso (acotado, TTL corto): sin red ni serialización de red.
+2. Caché compartida entre workers (CACHES['analysis_shared']: Redis, memcached o
+   archivos); lo que analiza un worker lo reutilizan los demás.
+3. Base de datos (AnalysisRecord, ver cultural/records.py): sobrevive a reinicios
+   y despliegues.
+
+Cada valor se guarda como JSON comprimido con zlib, así que cada lectura devuelve
+un dict nuevo: quien lo modifica no altera lo guardado. Al encontrar un valor en
+un nivel inferior se copia a los superiores.
+"""
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+logger = logging.getLogger(__name__)
+
+SHARED_TIER = 'shared'  # nivel de CACHES['analysis_shared'] (entre workers)
+
+
+class AnalysisKey(NamedTuple):
+    """Todo lo que determina el resultado de un análisis."""
+    cache_format: int
+    model: str
+    prompt_version: str
+    validation_method: str
+    content_hash: str
+
+    def __str__(self) -> str:
+        return 'cultural_analysis:' + ':'.join(str(part) for part in self)
+
+
+def encode_value(value: Dict) -> bytes:
+    return zlib.compress(json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_value(blob: bytes) -> Dict:
+    return json.loads(zlib.decompress(blob))
+
+
+class LocalTier:
+    """LRU acotado por número de entradas, con TTL por entrada."""
+
+    def __init__(self, name: str, max_entries: int, ttl: int):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[AnalysisKey, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: AnalysisKey) -> Optional[bytes]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, blob = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return blob
+
+    def set(self, key: AnalysisKey, blob: bytes) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, blob)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: AnalysisKey) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    async def aget(self, key: AnalysisKey) -> Optional[bytes]:
+        return self.get(key)
+
+    async def aset(self, key: AnalysisKey, blob: bytes) -> None:
+        self.set(key, blob)
+
+    async def adelete(self, key: AnalysisKey) -> None:
+        self.delete(key)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class DjangoCacheTier:
+    """Un alias de CACHES; la expulsión la hace el backend (MAX_ENTRIES/CULL_FREQUENCY, maxmemory...)."""
+
+    def __init__(self, name: str, alias: str, ttl: int):
+        self.name = name
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    def get(self, key: AnalysisKey) -> Optional[bytes]:
+        return self.backend.get(str(key))
+
+    def set(self, key: AnalysisKey, blob: bytes) -> None:
+        self.backend.set(str(key), blob, timeout=self.ttl)
+
+    def delete(self, key: AnalysisKey) -> None:
+        self.backend.delete(str(key))
+
+    async def aget(self, key: AnalysisKey) -> Optional[bytes]:
+        return await self.backend.aget(str(key))
+
+    async def aset(self, key: AnalysisKey, blob: bytes) -> None:
+        await self.backend.aset(str(key), blob, timeout=self.ttl)
+
+    async def adelete(self, key: AnalysisKey) -> None:
+        await self.backend.adelete(str(key))
+
+
+class TieredCache:
+    def __init__(self, tiers: List):
+        self.tiers = tiers
+        self._stats = {t.name: {'hits': 0, 'misses': 0, 'errors': 0} for t in tiers}
+        self._lock = threading.Lock()
+
+    def _count(self, tier, field: str) -> None:
+        with self._lock:
+            self._stats[tier.name][field] += 1
+
+    def get(self, key: AnalysisKey) -> Tuple[Optional[Dict], Optional[str]]:
+        """(valor, nombre del nivel donde estaba) o (None, None)."""
+        for i, tier in enumerate(self.tiers):
+            try:
+                blob = tier.get(key)
+            except Exception as e:
+                self._count(tier, 'errors')
+                logger.warning(f"Error leyendo caché {tier.name}: {e}")
+                continue
+            if blob is None:
+                self._count(tier, 'misses')
+                continue
+            try:
+                value = decode_value(blob)
+            except Exception as e:
+                # entrada corrupta o de otro formato: cuenta como fallo y se borra
+                self._count(tier, 'errors')
+                logger.warning(f"Entrada ilegible en caché {tier.name}, se borra: {e}")
+                self._safe_delete(tier, key)
+                continue
+            self._count(tier, 'hits')
+            for upper in self.tiers[:i]:
+                self._safe_set(upper, key, blob)
+            return value, tier.name
+        return None, None
+
+    def peek(self, key: AnalysisKey, tier_name: str) -> Optional[Dict]:
+        """Valor en un solo nivel, sin estadísticas ni promoción (consultas repetidas de coalescing)."""
+        tier = self._tier(tier_name)
+        try:
+            blob = tier.get(key) if tier is not None else None
+            return decode_value(blob) if blob is not None else None
+        except Exception:
+            return None  # get() lo cuenta y lo resuelve en la búsqueda completa
+
+    async def apeek(self, key: AnalysisKey, tier_name: str) -> Optional[Dict]:
+        tier = self._tier(tier_name)
+        try:
+            blob = await tier.aget(key) if tier is not None else None
+            return decode_value(blob) if blob is not None else None
+        except Exception:
+            return None
+
+    def _tier(self, name: str):
+        return next((t for t in self.tiers if t.name == name), None)
+
+    def set(self, key: AnalysisKey, value: Dict) -> None:
+        blob = encode_value(value)
+        for tier in self.tiers:
+            self._safe_set(tier, key, blob)
+
+    def _safe_set(self, tier, key: AnalysisKey, blob: bytes) -> None:
+        try:
+            tier.set(key, blob)
+        except Exception as e:
+            self._count(tier, 'errors')
+            logger.warning(f"Error guardando en caché {tier.name}: {e}")
+
+    def _safe_delete(self, tier, key: AnalysisKey) -> None:
+        try:
+            tier.delete(key)
+        except Exception as e:
+            logger.warning(f"Error borrando de caché {tier.name}: {e}")
+
+    async def aget(self, key: AnalysisKey) -> Tuple[Optional[Dict], Optional[str]]:
+        for i, tier in enumerate(self.tiers):
+            try:
+                blob = await tier.aget(key)
+            except Exception as e:
+                self._count(tier, 'errors')
+                logger.warning(f"Error leyendo caché {tier.name}: {e}")
+                continue
+            if blob is None:
+                self._count(tier, 'misses')
+                continue
+            try:
+                value = decode_value(blob)
+            except Exception as e:
+                self._count(tier, 'errors')
+                logger.warning(f"Entrada ilegible en caché {tier.name}, se borra: {e}")
+                await self._asafe_delete(tier, key)
+                continue
+            self._count(tier, 'hits')
+            for upper in self.tiers[:i]:
+                await self._asafe_set(upper, key, blob)
+            return value, tier.name
+        return None, None
+
+    async def aset(self, key: AnalysisKey, value: Dict) -> None:
+        blob = encode_value(value)
+        for tier in self.tiers:
+            await self._asafe_set(tier, key, blob)
+
+    async def _asafe_set(self, tier, key: AnalysisKey, blob: bytes) -> None:
+        try:
+            await tier.aset(key, blob)
+        except Exception as e:
+            self._count(tier, 'errors')
+            logger.warning(f"Error guardando en caché {tier.name}: {e}")
+
+    async def _asafe_delete(self, tier, key: AnalysisKey) -> None:
+        try:
+            await tier.adelete(key)
+        except Exception as e:
+            logger.warning(f"Error borrando de caché {tier.name}: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = {name: dict(s) for name, s in self._stats.items()}
+        for s in stats.values():
+            lookups = s['hits'] + s['misses']
+            s['hit_ratio'] = round(s['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+
+def _build_analysis_cache() -> TieredCache:
+    from .records import RecordTier
+
+    tiers = [LocalTier(
+        'local',
+        max_entries=getattr(settings, 'ANALYSIS_CACHE_LOCAL_MAX_ENTRIES', 512),
+        ttl=getattr(settings, 'ANALYSIS_CACHE_LOCAL_TTL', 600),
+    )]
+    try:
+        caches['analysis_shared']
+        tiers.append(DjangoCacheTier(SHARED_TIER, 'analysis_shared',
+                                     ttl=getattr(settings, 'ANALYSIS_CACHE_SHARED_TTL', 86400)))
+    except InvalidCacheBackendError:
+        pass  # alias no configurado: se omite el nivel
+    tiers.append(RecordTier('db', ttl=getattr(settings, 'ANALYSIS_CACHE_DB_TTL', 30 * 86400)))
+    return TieredCache(tiers)
+
+
+_analysis_cache: Optional[TieredCache] = None
+_analysis_cache_lock = threading.Lock()
+
+
+def get_analysis_cache() -> TieredCache:
+    global _analysis_cache
+    if _analysis_cache is None:
+        with _analysis_cache_lock:
+            if _analysis_cache is None:
+                _analysis_cache = _build_analysis_cache()
+    return _analysis_cache
+
+
+def get_analysis_cache_stats() -> Dict:
+    return get_analysis_cache().stats()
@@ -0,0 +1,206 @@
+# cultural/coalescing.py
+"""
+Agrupa análisis simultáneos de la misma imagen (single-flight).
+
+La primera petición de una clave es la líder y llama a OpenAI; las que llegan
+mientras tanto esperan su resultado en vez de repetir la llamada.
+
+- Dentro del proceso, las seguidoras esperan un Future (sirve tanto a hilos
+  como a corrutinas).
+- Entre workers, la líder toma un candado en CACHES['analysis_shared'] con
+  add(), que solo escribe si la clave no existe. Las seguidoras de otros
+  procesos consultan solo la caché compartida (`poll`, barato y sin contar
+  aciertos ni fallos) hasta que aparece el resultado; la búsqueda completa
+  (`lookup`) se hace una vez, al tomar el candado.
+
+Si la líder falla, sus seguidoras del proceso reciben el mismo error. Si se
+abandona sin resultado (cancelada) o excede `wait_timeout` (su presupuesto
+completo: reintentos, esperas y la clasificación previa), una sola seguidora
+toma el relevo como nueva líder y las demás la esperan. Entre workers, el
+candado expira a los `lock_ttl` segundos (más que ese presupuesto) si la líder
+muere sin soltarlo, y la siguiente que lo toma hace la llamada.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+import uuid
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import InvalidCacheBackendError
+
+logger = logging.getLogger(__name__)
+
+# cómo se obtuvo el resultado
+LEADER = 'leader'            # esta petición hizo la llamada
+COALESCED = 'coalesced'      # esperó a la líder del mismo proceso
+REMOTE = 'remote'            # lo dejó en caché la líder de otro worker (visto con `poll`)
+CACHED = 'cached'            # ya estaba en caché al tomar el candado (visto con `lookup`)
+TIMEOUT = 'timeout'          # relevo de una líder abandonada o fuera de presupuesto
+
+
+class LeaderAbandoned(Exception):
+    """La líder se canceló o murió sin resultado ni error que compartir."""
+
+
+class SingleFlight:
+    POLL_INTERVAL = 0.1  # segundos entre consultas a la caché compartida
+
+    def __init__(self, lock_alias: Optional[str], wait_timeout: float, lock_ttl: int):
+        self.lock_alias = lock_alias
+        self.wait_timeout = wait_timeout
+        self.lock_ttl = lock_ttl
+        self._flights: Dict[Any, Future] = {}
+        self._lock = threading.Lock()
+        self._stats = {LEADER: 0, COALESCED: 0, REMOTE: 0, CACHED: 0, TIMEOUT: 0}
+
+    def _lock_backend(self):
+        if not self.lock_alias:
+            return None
+        try:
+            return caches[self.lock_alias]
+        except InvalidCacheBackendError:
+            return None
+
+    def _join(self, key, stale: Optional[Future] = None) -> Tuple[Future, bool]:
+        """(future del vuelo, True si esta petición es la líder). `stale`: vuelo vencido a reemplazar."""
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None and future is not stale:
+                return future, False
+            future = self._flights[key] = Future()
+            return future, True
+
+    def _land(self, key, future: Future, value=None, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            # una líder reemplazada por vencida no borra el vuelo de su relevo
+            if self._flights.get(key) is future:
+                del self._flights[key]
+        if error is None:
+            future.set_result(value)
+        elif isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            future.set_exception(LeaderAbandoned())
+
+    def _count(self, how: str) -> str:
+        with self._lock:
+            self._stats[how] += 1
+        return how
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._flights))
+
+    # === síncrono ===
+
+    def do(self, key, fn: Callable[[], Any], lookup: Callable[[], Any],
+           poll: Optional[Callable[[], Any]] = None) -> Tuple[Any, str]:
+        """
+        Ejecuta `fn` una sola vez por clave. `lookup` busca en la caché antes de
+        llamar; `poll` (por defecto `lookup`) se repite mientras otro worker
+        tiene el candado. Devuelve (resultado, cómo se obtuvo).
+        """
+        stale = None
+        while True:
+            future, leader = self._join(key, stale)
+            if leader:
+                break
+            try:
+                return future.result(timeout=self.wait_timeout), self._count(COALESCED)
+            except (FutureTimeoutError, LeaderAbandoned):
+                logger.warning(f"Análisis en curso de {key} sin respuesta; se vuelve a unir al vuelo")
+                stale = future
+        try:
+            value, how = self._lead(key, fn, lookup, poll or lookup)
+        except BaseException as e:
+            self._land(key, future, error=e)
+            raise
+        self._land(key, future, value)
+        return value, self._count(TIMEOUT if stale is not None and how == LEADER else how)
+
+    def _lead(self, key, fn, lookup, poll) -> Tuple[Any, str]:
+        backend = self._lock_backend()
+        if backend is None:
+            return fn(), LEADER
+        lock_key, token = f'{key}:lock', uuid.uuid4().hex
+        # add() falla mientras otro worker tenga el candado; si lo suelta sin dejar resultado
+        # (falló) o muere y el candado expira (lock_ttl), se toma y se hace la llamada
+        while not backend.add(lock_key, token, timeout=self.lock_ttl):
+            value = poll()
+            if value is not None:
+                return value, REMOTE
+            time.sleep(self.POLL_INTERVAL)
+        try:
+            # la líder anterior pudo soltar el candado justo después de guardar el resultado
+            value = lookup()
+            return (value, CACHED) if value is not None else (fn(), LEADER)
+        finally:
+            if backend.get(lock_key) == token:
+                backend.delete(lock_key)
+
+    # === async ===
+
+    async def ado(self, key, fn: Callable[[], Awaitable], lookup: Callable[[], Awaitable],
+                  poll: Optional[Callable[[], Awaitable]] = None) -> Tuple[Any, str]:
+        stale = None
+        while True:
+            future, leader = self._join(key, stale)
+            if leader:
+                break
+            try:
+                value = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.wait_timeout)
+                return value, self._count(COALESCED)
+            except (asyncio.TimeoutError, LeaderAbandoned):
+                logger.warning(f"Análisis en curso de {key} sin respuesta; se vuelve a unir al vuelo")
+                stale = future
+        try:
+            value, how = await self._alead(key, fn, lookup, poll or lookup)
+        except BaseException as e:
+            self._land(key, future, error=e)
+            raise
+        self._land(key, future, value)
+        return value, self._count(TIMEOUT if stale is not None and how == LEADER else how)
+
+    async def _alead(self, key, fn, lookup, poll) -> Tuple[Any, str]:
+        backend = self._lock_backend()
+        if backend is None:
+            return await fn(), LEADER
+        lock_key, token = f'{key}:lock', uuid.uuid4().hex
+        while not await backend.aadd(lock_key, token, timeout=self.lock_ttl):
+            value = await poll()
+            if value is not None:
+                return value, REMOTE
+            await asyncio.sleep(self.POLL_INTERVAL)
+        try:
+            value = await lookup()
+            return (value, CACHED) if value is not None else (await fn(), LEADER)
+        finally:
+            if await backend.aget(lock_key) == token:
+                await backend.adelete(lock_key)
+
+
+_analysis_flights: Optional[SingleFlight] = None
+_analysis_flights_lock = threading.Lock()
+
+
+def get_analysis_flights() -> SingleFlight:
+    global _analysis_flights
+    if _analysis_flights is None:
+        with _analysis_flights_lock:
+            if _analysis_flights is None:
+                from .services import CulturalAnalysisService
+                # por defecto, lo más que puede tardar la líder (0 en settings = derivado)
+                wait_timeout = getattr(settings, 'ANALYSIS_COALESCE_TIMEOUT', 0) or \
+                    CulturalAnalysisService.upstream_budget()
+                _analysis_flights = SingleFlight(
+                    lock_alias=getattr(settings, 'ANALYSIS_COALESCE_LOCK_ALIAS', 'analysis_shared'),
+                    wait_timeout=wait_timeout,
+                    # el candado expira solo si la líder muere sin soltarlo: nunca antes de su presupuesto
+                    lock_ttl=getattr(settings, 'ANALYSIS_COALESCE_LOCK_TTL', 0) or math.ceil(wait_timeout + 30),
+                )
+    return _analysis_flights
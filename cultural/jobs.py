@@ -0,0 +1,261 @@
+# cultural/jobs.py
+"""
+Cola de análisis en segundo plano.
+
+Los trabajos se guardan en la base de datos (AnalysisJob), así sobreviven a un
+reinicio: un hilo de mantenimiento por proceso (arranca con la primera petición,
+ver CulturalConfig.ready) reencola cada ANALYSIS_JOB_MAINTENANCE_INTERVAL
+segundos los pendientes y los que quedaron "procesando" más de lo que puede
+tardar un análisis (job_stale_after), y borra los resultados expirados; también
+lo hace `manage.py recover_analysis_jobs`. Un pool de hilos
+acotado (ANALYSIS_JOB_WORKERS) ejecuta CulturalAnalysisService.analyze_image y
+cada trabajo se reclama con un UPDATE condicional, por lo que varios procesos
+pueden compartir la misma tabla sin analizar dos veces la misma imagen.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Union
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F
+from django.utils import timezone
+
+from .analysis.images import SourceImage, as_source_image
+from .models import AnalysisJob, AnalysisJobStatus
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = getattr(settings, 'ANALYSIS_JOB_WORKERS', 4)
+JOB_MAX_QUEUE = getattr(settings, 'ANALYSIS_JOB_MAX_QUEUE', 100)
+JOB_RESULT_TTL = getattr(settings, 'ANALYSIS_JOB_RESULT_TTL', 3600)  # segundos
+JOB_STALE_AFTER = getattr(settings, 'ANALYSIS_JOB_STALE_AFTER', 0)  # segundos; 0 = derivado, ver job_stale_after
+JOB_STALE_MARGIN = 60  # segundos sobre el presupuesto de OpenAI (imagen, caché, registro)
+JOB_MAINTENANCE_INTERVAL = getattr(settings, 'ANALYSIS_JOB_MAINTENANCE_INTERVAL', 60)  # segundos; 0 = sin hilo
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BACKOFF = 2.0  # segundos antes del segundo intento; se duplica en cada uno
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class AnalysisJobRunner:
+    def __init__(self, workers: int = JOB_WORKERS, max_queue: int = JOB_MAX_QUEUE,
+                 maintenance_interval: float = JOB_MAINTENANCE_INTERVAL, retry_backoff: float = JOB_RETRY_BACKOFF):
+        self.max_queue = max_queue
+        self.maintenance_interval = maintenance_interval
+        self.retry_backoff = retry_backoff
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='analysis-job')
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queued = set()  # ids encolados en este proceso (o esperando su reintento)
+        self._last_recovery = None
+        self._maintenance = None
+
+    def submit(self, image: Union[str, SourceImage], user=None) -> AnalysisJob:
+        """
+        Crea el trabajo en la base de datos y lo encola; no espera a OpenAI. Guarda la
+        imagen ya reducida (cientos de KB, no la foto original) y el hash de la original.
+        """
+        from .services import CulturalAnalysisService
+
+        self.recover()
+        with self._lock:
+            if self._in_flight >= self.max_queue:
+                raise JobQueueFull("Demasiados análisis en cola, intenta nuevamente en unos segundos")
+            self._in_flight += 1
+        try:
+            source = as_source_image(image)
+            job = AnalysisJob.objects.create(
+                image_base64=CulturalAnalysisService().prepare_image(source).base64,
+                content_hash=source.content_hash,
+                created_by=user if user is not None and user.is_authenticated else None,
+            )
+        except Exception:
+            with self._lock:
+                self._in_flight -= 1
+            raise
+        with self._lock:
+            self._queued.add(job.id)
+        self._executor.submit(self._run, job.id)
+        return job
+
+    def recover(self, force: bool = False) -> int:
+        """
+        Purga expirados y reencola los trabajos huérfanos (pendientes o "procesando"
+        hace demasiado) que este proceso no tenga ya en cola. Sin `force`, a lo sumo
+        una vez cada maintenance_interval segundos. Devuelve cuántos reencoló.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_recovery is not None and \
+                    now - self._last_recovery < (self.maintenance_interval or job_stale_after()):
+                return 0
+            self._last_recovery = now
+            queued = set(self._queued)
+            free = self.max_queue - self._in_flight
+        try:
+            purge_expired_jobs()
+            reset_stale_jobs(exclude=queued)
+            pending = list(AnalysisJob.objects.filter(
+                status=AnalysisJobStatus.PENDIENTE
+            ).exclude(id__in=queued).order_by('created_at').values_list('id', flat=True)[:max(0, free)])
+        except Exception as e:
+            logger.warning(f"No se pudieron recuperar trabajos pendientes: {e}")
+            return 0
+        enqueued = sum(self._enqueue(job_id) for job_id in pending)
+        if enqueued:
+            logger.info(f"{enqueued} trabajos de análisis reencolados")
+        return enqueued
+
+    def _enqueue(self, job_id) -> bool:
+        with self._lock:
+            if job_id in self._queued:
+                return False
+            self._queued.add(job_id)
+            self._in_flight += 1
+        self._executor.submit(self._run, job_id)
+        return True
+
+    def _retry(self, job_id) -> None:
+        with self._lock:
+            self._queued.discard(job_id)
+        self._enqueue(job_id)
+
+    def start_maintenance(self) -> None:
+        """Hilo que recupera y purga ahora y luego cada maintenance_interval segundos (uno por proceso)."""
+        with self._lock:
+            if self._maintenance is not None or not self.maintenance_interval:
+                return
+            self._maintenance = threading.Thread(target=self._maintenance_loop, daemon=True,
+                                                 name='analysis-job-maintenance')
+        self._maintenance.start()
+
+    def _maintenance_loop(self) -> None:
+        while True:
+            self.recover(force=True)
+            close_old_connections()
+            time.sleep(self.maintenance_interval)
+
+    def wait_idle(self, timeout: float) -> bool:
+        """Espera a que no queden trabajos en cola en este proceso (comando de recuperación, pruebas)."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._queued:
+                    return True
+            time.sleep(0.05)
+        return False
+
+    def _run(self, job_id) -> None:
+        from .services import CulturalAnalysisService, OpenAIAnalysisError
+
+        close_old_connections()
+        retry_in = None
+        try:
+            # Reclamar el trabajo: solo un worker (de cualquier proceso) lo procesa
+            claimed = AnalysisJob.objects.filter(id=job_id, status=AnalysisJobStatus.PENDIENTE).update(
+                status=AnalysisJobStatus.PROCESANDO,
+                started_at=timezone.now(),
+                attempts=F('attempts') + 1,
+            )
+            if not claimed:
+                return
+            job = AnalysisJob.objects.get(id=job_id)
+
+            result, error = None, ''
+            try:
+                result = CulturalAnalysisService().analyze_image(job_image(job))
+            except OpenAIAnalysisError as e:
+                error = str(e)
+            except Exception as e:
+                if job.attempts < JOB_MAX_ATTEMPTS:
+                    # Error del servidor (no de OpenAI): se vuelve a encolar tras un backoff exponencial
+                    retry_in = self.retry_backoff * 2 ** (job.attempts - 1)
+                    logger.error(f"Error en trabajo {job_id} (reintento en {retry_in:.0f} s): {e}", exc_info=True)
+                    AnalysisJob.objects.filter(id=job_id).update(status=AnalysisJobStatus.PENDIENTE)
+                    return
+                error = f"Error al procesar la imagen: {e}"
+
+            now = timezone.now()
+            AnalysisJob.objects.filter(id=job_id).update(
+                status=AnalysisJobStatus.FALLIDO if error else AnalysisJobStatus.COMPLETADO,
+                result=result,
+                error=error,
+                image_base64='',
+                finished_at=now,
+                expires_at=now + timedelta(seconds=JOB_RESULT_TTL),
+            )
+        except Exception as e:
+            retry_in = None
+            logger.error(f"Error actualizando trabajo {job_id}: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                if retry_in is None:
+                    self._queued.discard(job_id)
+            close_old_connections()
+            if retry_in is not None:
+                # sigue en _queued mientras espera: la recuperación periódica no lo duplica
+                timer = threading.Timer(retry_in, self._retry, args=(job_id,))
+                timer.daemon = True
+                timer.start()
+
+
+def job_image(job: AnalysisJob) -> Union[str, SourceImage]:
+    """Imagen guardada del trabajo, con la clave de caché de la original."""
+    if not job.content_hash:
+        return job.image_base64  # trabajo anterior a guardar la imagen reducida: es la original
+    return SourceImage.from_base64(job.image_base64, content_hash=job.content_hash)
+
+
+def purge_expired_jobs() -> int:
+    deleted, _ = AnalysisJob.objects.filter(expires_at__lt=timezone.now()).delete()
+    return deleted
+
+
+def job_stale_after() -> float:
+    """
+    Segundos "procesando" tras los que un trabajo se da por huérfano. Por defecto,
+    lo más que puede tardar un análisis (las dos etapas con todos sus reintentos) más
+    JOB_STALE_MARGIN: no se reencola uno que sigue vivo.
+    """
+    if JOB_STALE_AFTER:
+        return JOB_STALE_AFTER
+    from .services import CulturalAnalysisService
+    return CulturalAnalysisService.upstream_budget() + JOB_STALE_MARGIN
+
+
+def reset_stale_jobs(exclude=()) -> int:
+    """Vuelve a PENDIENTE los trabajos "procesando" desde hace más de job_stale_after() (worker caído)."""
+    stale = timezone.now() - timedelta(seconds=job_stale_after())
+    return AnalysisJob.objects.filter(
+        status=AnalysisJobStatus.PROCESANDO, started_at__lt=stale
+    ).exclude(id__in=exclude).update(status=AnalysisJobStatus.PENDIENTE)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner() -> AnalysisJobRunner:
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                _runner = AnalysisJobRunner()
+    return _runner
+
+
+JOB_MAINTENANCE_UID = 'cultural.jobs.start_job_maintenance'
+
+
+def start_job_maintenance(**kwargs) -> None:
+    """Receptor de request_started: la primera petición del proceso arranca el mantenimiento."""
+    from django.core.signals import request_started
+    request_started.disconnect(dispatch_uid=JOB_MAINTENANCE_UID)
+    get_job_runner().start_maintenance()
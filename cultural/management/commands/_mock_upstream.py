@@ -0,0 +1,267 @@
+"""Servidor local que imita /v1/chat/completions para benchmarks y pruebas de carga sin gastar créditos."""
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional, Union
+
+from cultural.analysis.knowledge import get_knowledge_snapshot
+from cultural.analysis.parsing import normalize_category
+
+
+def canned_answer(rng: random.Random, confianza: float = 0.9) -> dict:
+    """Respuesta con un elemento real de elementos_huanuco.json (o de baja confianza si se pide)."""
+    elementos = get_knowledge_snapshot().elementos or [{'titulo': 'Pachamanca Huanuqueña', 'categoria': 'Gastronomía'}]
+    e = rng.choice(elementos)
+    analysis = {
+        'titulo': e.get('titulo', ''),
+        'categoria': e.get('categoria', 'Otro'),
+        'descripcion': e.get('descripcion', ''),
+        'confianza': confianza,
+        'es_de_huanuco': confianza >= 0.7,
+        'razones': ['respuesta simulada'],
+        'dudas': [],
+        'contexto_cultural': e.get('contexto_cultural', ''),
+        'periodo_historico': e.get('periodo_historico', ''),
+        'ubicacion': e.get('ubicacion', ''),
+        'significado': e.get('significado', ''),
+    }
+    return {
+        'choices': [{'message': {'role': 'assistant', 'content': json.dumps(analysis, ensure_ascii=False)}}],
+        'usage': {'prompt_tokens': 2500, 'completion_tokens': 300, 'total_tokens': 2800},
+    }
+
+
+PROMPT_CACHE_MIN_TOKENS = 1024  # como la caché de prefijos de OpenAI: desde 1024 tokens, de a 128
+PROMPT_CACHE_STEP_TOKENS = 128
+
+
+class PrefixCache:
+    """Prefijos de texto (hasta la primera imagen) ya vistos, en bloques de PROMPT_CACHE_STEP_TOKENS."""
+
+    def __init__(self):
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def cached_tokens(self, text: str) -> int:
+        """Tokens del prefijo más largo de `text` ya visto (y lo registra para las siguientes)."""
+        step = PROMPT_CACHE_STEP_TOKENS * MockUpstream.CHARS_PER_TOKEN
+        digests = [hashlib.sha1(text[:end].encode('utf-8')).digest()
+                   for end in range(step, len(text) + 1, step)]
+        with self._lock:
+            hit = 0
+            for i, digest in enumerate(digests, 1):
+                if digest not in self._seen:
+                    break
+                hit = i * PROMPT_CACHE_STEP_TOKENS
+            self._seen.update(digests)
+        return hit if hit >= PROMPT_CACHE_MIN_TOKENS else 0
+
+
+def simulated_usage(request: dict, content: str, prefix_cache: Optional[PrefixCache] = None) -> dict:
+    """
+    Tokens aproximados de la llamada (~4 caracteres por token; imagen: 85 en
+    detail=low, 765 si no), para que los benchmarks vean el efecto del prompt.
+    Con `prefix_cache`, cached_tokens del texto que precede a la primera imagen.
+    """
+    prompt_tokens, prefix, in_prefix = 0, [], True
+    for message in request.get('messages', []):
+        parts = message.get('content')
+        for part in parts if isinstance(parts, list) else [{'type': 'text', 'text': parts or ''}]:
+            if part.get('type') == 'image_url':
+                prompt_tokens += 85 if part['image_url'].get('detail') == 'low' else 765
+                in_prefix = False
+            else:
+                prompt_tokens += len(part.get('text', '')) // 4
+                if in_prefix:
+                    prefix.append(part.get('text', ''))
+    completion_tokens = len(content) // 4
+    usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+             'total_tokens': prompt_tokens + completion_tokens}
+    if prefix_cache is not None:
+        usage['prompt_tokens_details'] = {'cached_tokens': prefix_cache.cached_tokens('\n'.join(prefix))}
+    return usage
+
+
+def latency_sampler(spec: Union[float, str]) -> Callable[[random.Random], float]:
+    """
+    Segundos de latencia por llamada:
+      0.5                  fija
+      uniform:0.2,1.5      uniforme entre dos valores
+      lognormal:0.8,0.5    log-normal con mediana 0.8 s y sigma 0.5 (cola larga, como la API real)
+    """
+    if isinstance(spec, (int, float)):
+        return lambda rng: float(spec)
+    kind, _, args = str(spec).partition(':')
+    if not args:
+        value = float(kind)
+        return lambda rng: value
+    a, b = (float(x) for x in args.split(','))
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(a, b)
+    if kind == 'lognormal':
+        mu = math.log(a)
+        return lambda rng: rng.lognormvariate(mu, b)
+    raise ValueError(f"Distribución de latencia desconocida: {spec!r}")
+
+
+class MockUpstream:
+    """
+    Responde cada POST tras una latencia (fija o de una distribución, ver
+    latency_sampler), en un hilo por conexión.
+
+    - `status` distinto de 200: responde siempre ese error.
+    - `error_rate` / `rate_limit_rate`: fracción de llamadas que reciben un 5xx o
+      un 429 con Retry-After.
+    - `low_confidence_rate`: fracción de respuestas con confianza baja.
+    - `max_tokens` < 100 en la petición: responde solo {"categoria": ...}.
+    - response_format json_schema: la categoría como código (GASTRONOMIA, ...).
+    - usage.prompt_tokens_details.cached_tokens: el prefijo de texto (antes de la
+      imagen) ya enviado en llamadas anteriores, como la caché de prefijos real.
+    - `token_delay`: simula la generación; la respuesta tarda además esa
+      cantidad por token y, si la petición trae "stream": true, se envía token
+      a token (SSE).
+
+    GET a cualquier ruta devuelve los contadores (ver stats()).
+    """
+
+    CHARS_PER_TOKEN = 4
+
+    def __init__(
+        self,
+        latency: Union[float, str] = 0.5,
+        seed: int = 0,
+        status: int = 200,
+        token_delay: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        low_confidence_rate: float = 0.0,
+        retry_after: int = 1,
+        host: str = '127.0.0.1',
+        port: int = 0,
+    ):
+        self.latency = latency
+        self.status = status
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.low_confidence_rate = low_confidence_rate
+        self.retry_after = retry_after
+        self.calls = 0
+        self.prefix_cache = PrefixCache()
+        self.responses = Counter()  # status -> llamadas
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                body = json.dumps(upstream.stats()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                delay, status, answer = upstream._next_call()
+                if answer is not None and request.get('max_tokens', 1000) < 100:
+                    # llamada corta (primera etapa del modo en dos etapas): solo la categoría
+                    categoria = json.loads(answer['choices'][0]['message']['content'])['categoria']
+                    answer['choices'][0]['message']['content'] = json.dumps({'categoria': categoria}, ensure_ascii=False)
+                elif answer is not None and (request.get('response_format') or {}).get('type') == 'json_schema':
+                    # salida estructurada: la categoría como código del enum del schema
+                    message = answer['choices'][0]['message']
+                    analysis = json.loads(message['content'])
+                    analysis['categoria'] = normalize_category(analysis['categoria'])
+                    message['content'] = json.dumps(analysis, ensure_ascii=False)
+                if answer is not None and request.get('messages'):
+                    answer['usage'] = simulated_usage(request, answer['choices'][0]['message']['content'],
+                                                      upstream.prefix_cache)
+                time.sleep(delay)
+                if status == 200 and request.get('stream'):
+                    return self._stream(answer)
+                headers = {}
+                if status == 200:
+                    content = answer['choices'][0]['message']['content']
+                    time.sleep(upstream.token_delay * len(content) / upstream.CHARS_PER_TOKEN)
+                    body = json.dumps(answer).encode('utf-8')
+                else:
+                    body = json.dumps({'error': {'message': 'simulado', 'code': status}}).encode('utf-8')
+                    if status == 429:
+                        headers['Retry-After'] = str(upstream.retry_after)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, answer):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                content = answer['choices'][0]['message']['content']
+                step = upstream.CHARS_PER_TOKEN
+                for i in range(0, len(content), step):
+                    if i:
+                        time.sleep(upstream.token_delay)
+                    self._chunk({'choices': [{'index': 0, 'delta': {'content': content[i:i + step]}}]})
+                self._chunk({'choices': [], 'usage': answer['usage']})
+                self._chunk('[DONE]')
+                self.wfile.write(b'0\r\n\r\n')
+
+            def _chunk(self, event):
+                data = event if isinstance(event, str) else json.dumps(event, ensure_ascii=False)
+                payload = f"data: {data}\n\n".encode('utf-8')
+                self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b'\r\n')
+                self.wfile.flush()
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024
+
+        self.server = Server((host, port), Handler)
+        self.url = f"http://{host}:{self.server.server_port}/v1/chat/completions"
+
+    def _next_call(self):
+        """(latencia, status, respuesta) de la próxima llamada; el rng es compartido por los hilos."""
+        with self._lock:
+            rng = self._rng
+            self.calls += 1
+            delay = latency_sampler(self.latency)(rng)
+            status = self.status
+            if status == 200:
+                roll = rng.random()
+                if roll < self.rate_limit_rate:
+                    status = 429
+                elif roll < self.rate_limit_rate + self.error_rate:
+                    status = rng.choice([500, 502, 503])
+            confianza = 0.1 if rng.random() < self.low_confidence_rate else 0.9
+            answer = canned_answer(rng, confianza) if status == 200 else None
+            self.responses[status] += 1
+        return delay, status, answer
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'calls': self.calls, 'responses': {str(k): v for k, v in sorted(self.responses.items())}}
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,100 @@
+"""Datos sintéticos para los benchmarks: bases de conocimiento (derivadas de la real) e imágenes."""
+import base64
+import io
+import random
+
+import numpy as np
+from PIL import Image
+
+from cultural.analysis.knowledge import get_knowledge_snapshot
+
+_SILABAS = ['hua', 'nu', 'co', 'pa', 'cha', 'man', 'ca', 'ko', 'tosh', 'qui', 'lla', 'ri', 'ta', 'yu', 'pi', 'sa']
+
+
+def _palabra(rng: random.Random) -> str:
+    return ''.join(rng.choice(_SILABAS) for _ in range(rng.randint(2, 4)))
+
+
+def synthetic_elements(n: int, seed: int = 42) -> list:
+    """n elementos con el mismo esquema que elementos_huanuco.json."""
+    rng = random.Random(seed)
+    reales = list(get_knowledge_snapshot().elementos) or [{'titulo': 'Pachamanca Huanuqueña', 'categoria': 'Gastronomía'}]
+    vocab = sorted({w for e in reales for w in e.get('titulo', '').split()})
+    vocab_texto = sorted({w for e in reales for w in (e.get('descripcion', '') + ' ' + e.get('contexto_cultural', '')).split()})
+
+    def texto(a: int, b: int) -> str:
+        return ' '.join(rng.choice(vocab_texto) if rng.random() < 0.7 else _palabra(rng)
+                        for _ in range(rng.randint(a, b)))
+
+    elementos = []
+    for i in range(n):
+        base = dict(reales[i % len(reales)])
+        palabras = rng.sample(vocab, k=min(2, len(vocab))) + [_palabra(rng) for _ in range(rng.randint(1, 3))]
+        rng.shuffle(palabras)
+        base['titulo'] = ' '.join(palabras).capitalize()
+        base['descripcion'] = texto(15, 40)
+        base['contexto_cultural'] = texto(10, 25)
+        elementos.append(base)
+    return elementos
+
+
+def synthetic_queries(elementos: list, n: int, seed: int = 7) -> list:
+    """Títulos de consulta: variantes con ruido de títulos existentes y títulos inventados."""
+    rng = random.Random(seed)
+    queries = []
+    for i in range(n):
+        if i % 3 == 2 or not elementos:
+            queries.append(' '.join(_palabra(rng) for _ in range(3)))
+            continue
+        t = list(rng.choice(elementos).get('titulo', ''))
+        for _ in range(rng.randint(0, 3)):
+            if t:
+                t[rng.randrange(len(t))] = rng.choice('aeiounrst')
+        queries.append(''.join(t))
+    return queries
+
+
+def noisy_analyses(elementos: list, n: int, seed: int = 11) -> list:
+    """
+    Pares (análisis simulado, índice del elemento de origen): título con erratas y
+    descripción/contexto parciales, como los que devuelve el modelo.
+    """
+    rng = random.Random(seed)
+    casos = []
+    for _ in range(min(n, len(elementos))):
+        i = rng.randrange(len(elementos))
+        e = elementos[i]
+        titulo = list(e.get('titulo', ''))
+        for _ in range(rng.randint(0, 2)):
+            if titulo:
+                titulo[rng.randrange(len(titulo))] = rng.choice('aeiounrst')
+        desc = e.get('descripcion', '').split()
+        ctx = e.get('contexto_cultural', '').split()
+        casos.append(({
+            'titulo': ''.join(titulo),
+            'descripcion': ' '.join(desc[:max(1, len(desc) // 2)]),
+            'contexto_cultural': ' '.join(rng.sample(ctx, k=len(ctx) // 2)) if ctx else '',
+            'confianza': 0.7,
+        }, i))
+    return casos
+
+
+def synthetic_image_bytes(width: int, height: int, seed: int = 0, quality: int = 92,
+                          orientation: int = 1) -> bytes:
+    """JPEG con gradiente y ruido (comprime como una foto, no como un color plano)."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // max(width, 1), y * 255 // max(height, 1), (x + y) * 127 // max(width + height, 1)], axis=-1)
+    pixels = np.clip(base + rng.normal(0, 18, size=base.shape), 0, 255).astype(np.uint8)
+    img = Image.fromarray(pixels, 'RGB')
+    exif = Image.Exif()
+    if orientation != 1:
+        exif[0x0112] = orientation
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=quality, exif=exif)
+    return buf.getvalue()
+
+
+def synthetic_images(n: int, size: int = 64, seed: int = 0) -> list:
+    """n imágenes JPEG distintas en base64 (pequeñas, para pruebas de carga)."""
+    return [base64.b64encode(synthetic_image_bytes(size, size, seed=seed + i)).decode() for i in range(n)]
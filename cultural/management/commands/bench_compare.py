@@ -0,0 +1,51 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def load_stages(path: str) -> dict:
+    try:
+        return json.loads(Path(path).read_text(encoding='utf-8'))['stages']
+    except (OSError, ValueError, KeyError) as e:
+        raise CommandError(f"No se pudo leer {path}: {e}")
+
+
+class Command(BaseCommand):
+    help = ("Compara dos resultados de bench_pipeline (baseline vs. actual) y falla si alguna "
+            "etapa es más lenta que el umbral")
+
+    def add_arguments(self, parser):
+        parser.add_argument('baseline')
+        parser.add_argument('current')
+        parser.add_argument('--threshold', type=float, default=10.0,
+                            help="Porcentaje de aumento a partir del cual una etapa es una regresión")
+        parser.add_argument('--min-delta-us', type=float, default=1.0,
+                            help="Ignora diferencias absolutas menores (ruido en etapas de pocos µs)")
+        parser.add_argument('--metric', choices=['us', 'min_us'], default='us',
+                            help="us = mediana de las rondas, min_us = mejor ronda")
+
+    def handle(self, *args, **options):
+        baseline = load_stages(options['baseline'])
+        current = load_stages(options['current'])
+        metric = options['metric']
+
+        regresiones = []
+        for stage in sorted(baseline.keys() & current.keys()):
+            antes, ahora = baseline[stage][metric], current[stage][metric]
+            cambio = (ahora - antes) / antes * 100 if antes else 0.0
+            es_regresion = cambio > options['threshold'] and ahora - antes >= options['min_delta_us']
+            if es_regresion:
+                regresiones.append(stage)
+            marca = 'REGRESIÓN' if es_regresion else ('mejora' if cambio < -options['threshold'] else '')
+            self.stdout.write(f"  {stage:<62} {antes:12.2f} -> {ahora:12.2f} µs {cambio:+7.1f}%  {marca}")
+
+        for stage in sorted(baseline.keys() - current.keys()):
+            self.stdout.write(f"  {stage:<62} solo en la baseline")
+        for stage in sorted(current.keys() - baseline.keys()):
+            self.stdout.write(f"  {stage:<62} nueva (sin baseline)")
+
+        if regresiones:
+            raise CommandError(f"{len(regresiones)} etapa(s) con regresión mayor a {options['threshold']:g}%: "
+                               f"{', '.join(regresiones)}")
+        self.stdout.write(self.style.SUCCESS(f"Sin regresiones por encima de {options['threshold']:g}%"))
@@ -0,0 +1,113 @@
+import base64
+import hashlib
+import math
+import multiprocessing
+import resource
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from cultural.analysis.images import SourceImage, prepare_image
+from ._synthetic import synthetic_image_bytes
+
+
+def _legacy(image_base64: str) -> None:
+    """Recorrido anterior: el base64 se decodificaba al validar, al calcular la clave de caché y al preparar."""
+    if ';base64,' in image_base64:
+        _, imgstr = image_base64.split(';base64,')
+        base64.b64decode(imgstr)
+    else:
+        base64.b64decode(image_base64)
+    hashlib.sha256(base64.b64decode(image_base64.split(';base64,', 1)[-1])).hexdigest()
+    prepare_image(SourceImage(base64.b64decode(image_base64.split(';base64,', 1)[-1])))
+
+
+def _source_image(image_base64: str) -> None:
+    """Recorrido actual: el serializer decodifica una vez y el SourceImage llega a la caché y a prepare_image."""
+    from cultural.serializers import CulturalAnalysisSerializer
+    source = CulturalAnalysisSerializer().validate_image(image_base64)
+    source.content_hash
+    prepare_image(source)
+
+
+PATHS = {'antes': _legacy, 'SourceImage': _source_image}
+
+
+def _status_mb(field: str) -> float:
+    for line in Path('/proc/self/status').read_text().splitlines():
+        if line.startswith(field + ':'):
+            return int(line.split()[1]) / 1024  # kB
+    raise OSError(f"{field} no disponible")
+
+
+def _measure_peak(path: str, payload_file: str, queue) -> None:
+    """En un proceso nuevo: pico de RSS de un recorrido por encima del base64 ya cargado."""
+    import django
+    django.setup()
+    fn = PATHS[path]
+    image_base64 = Path(payload_file).read_text()
+    fn(base64.b64encode(synthetic_image_bytes(64, 48)).decode())  # imports y cachés de Pillow fuera de la medición
+    try:
+        # Linux: reiniciar el máximo (VmHWM) para no contar la carga del base64
+        Path('/proc/self/clear_refs').write_text('5')
+        baseline = _status_mb('VmRSS')
+        fn(image_base64)
+        queue.put(_status_mb('VmHWM') - baseline)
+    except OSError:
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        fn(image_base64)
+        queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 - baseline)
+
+
+class Command(BaseCommand):
+    help = ("Compara el recorrido de una imagen base64 grande (validación, clave de caché y preparación) "
+            "decodificándola en cada paso y decodificándola una sola vez (SourceImage): CPU y pico de RSS")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mb', type=float, default=10.0, help="Tamaño aproximado del JPEG")
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--data-url', action='store_true', help="Con prefijo data:image/jpeg;base64,")
+
+    def handle(self, *args, **options):
+        # ~0.65 bytes por píxel con el ruido de synthetic_image_bytes a calidad 95
+        width = int(math.sqrt(options['mb'] * 1e6 / 0.65 * 4 / 3))
+        raw = synthetic_image_bytes(width, width * 3 // 4, quality=95)
+        image_base64 = base64.b64encode(raw).decode('ascii')
+        if options['data_url']:
+            image_base64 = f'data:image/jpeg;base64,{image_base64}'
+        del raw
+        self.stdout.write(f"Imagen {width}x{width * 3 // 4}, {len(image_base64) * 3 / 4 / 1e6:.1f} MB "
+                          f"({len(image_base64) / 1e6:.1f} MB en base64)")
+
+        cpu = {}
+        for name, fn in PATHS.items():
+            fn(image_base64)  # calentamiento
+            samples = []
+            for _ in range(options['repeat']):
+                t0 = time.process_time()
+                fn(image_base64)
+                samples.append(time.process_time() - t0)
+            cpu[name] = statistics.median(samples)
+
+        # cada medición de RSS en un proceso limpio (ru_maxrss solo crece)
+        ctx = multiprocessing.get_context('spawn')
+        peak = {}
+        with tempfile.NamedTemporaryFile('w', suffix='.b64') as payload:
+            payload.write(image_base64)
+            payload.flush()
+            for name in PATHS:
+                queue = ctx.Queue()
+                proc = ctx.Process(target=_measure_peak, args=(name, payload.name, queue))
+                proc.start()
+                peak[name] = queue.get()
+                proc.join()
+
+        for name in PATHS:
+            self.stdout.write(f"  {name:<12} CPU {cpu[name] * 1000:8.1f} ms (mediana de {options['repeat']}) | "
+                              f"pico de RSS +{peak[name]:6.1f} MB")
+        old, new = 'antes', 'SourceImage'
+        self.stdout.write(f"SourceImage: {1 - cpu[new] / cpu[old]:.1%} menos CPU, "
+                          f"{peak[old] - peak[new]:.1f} MB menos de pico de RSS")
@@ -0,0 +1,40 @@
+import base64
+import time
+
+from django.core.management.base import BaseCommand
+
+from cultural.analysis.images import prepare_image, get_image_stats
+from ._synthetic import synthetic_image_bytes
+
+
+class Command(BaseCommand):
+    help = "Mide bytes y tokens ahorrados y el costo de preparar fotos de celular antes de enviarlas"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='4032x3024,3000x4000,1600x1200,640x480,400x300')
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--max-side', type=int, default=1024)
+        parser.add_argument('--format', default='JPEG')
+        parser.add_argument('--quality', type=int, default=85)
+
+    def handle(self, *args, **options):
+        for spec in options['sizes'].split(','):
+            w, h = (int(v) for v in spec.split('x'))
+            # las fotos verticales de celular suelen venir apaisadas con orientación EXIF 6
+            orientation = 6 if h > w else 1
+            raw = synthetic_image_bytes(*((h, w) if orientation == 6 else (w, h)), orientation=orientation)
+            image_base64 = base64.b64encode(raw).decode()
+
+            t0 = time.perf_counter()
+            for _ in range(options['repeat']):
+                prepared = prepare_image(image_base64, max_side=options['max_side'],
+                                         fmt=options['format'], quality=options['quality'])
+            elapsed = (time.perf_counter() - t0) / options['repeat']
+
+            m = prepared.metrics()
+            self.stdout.write(
+                f"{spec:>10}: {m['original_bytes'] / 1e6:6.2f} MB -> {m['sent_bytes'] / 1e3:7.1f} KB "
+                f"({m['size'][0]}x{m['size'][1]} {m['mime']}, detail={m['detail']}) | "
+                f"tokens {m['original_tokens']} -> {m['sent_tokens']} | {elapsed * 1000:.0f} ms"
+            )
+        self.stdout.write(f"Stats: {get_image_stats()}")
@@ -0,0 +1,52 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+from cultural.analysis.title_index import TitleIndex
+from cultural.analysis.validation import find_best_match, MATCH_THRESHOLD
+from ._synthetic import synthetic_elements, synthetic_queries
+
+
+class Command(BaseCommand):
+    help = "Compara find_best_match lineal vs. índice de trigramas y verifica que den el mismo resultado"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10_000, 100_000])
+        parser.add_argument('--queries', type=int, default=30)
+        parser.add_argument('--linear-queries', type=int, default=5,
+                            help="Consultas lineales en bases grandes (el recorrido lineal es lento)")
+
+    def handle(self, *args, **options):
+        for n in options['sizes']:
+            elementos = synthetic_elements(n)
+            queries = synthetic_queries(elementos, options['queries'])
+
+            t0 = time.perf_counter()
+            index = TitleIndex(elementos)
+            build = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            indexed = [find_best_match(q, elementos, index=index) for q in queries]
+            t_index = (time.perf_counter() - t0) / len(queries)
+
+            # como en validate_with_local_knowledge: solo importan matches > umbral
+            t0 = time.perf_counter()
+            for q in queries:
+                find_best_match(q, elementos, index=index, min_score=MATCH_THRESHOLD)
+            t_umbral = (time.perf_counter() - t0) / len(queries)
+
+            linear_q = queries if n <= 10_000 else queries[:options['linear_queries']]
+            t0 = time.perf_counter()
+            linear = [find_best_match(q, elementos) for q in linear_q]
+            t_linear = (time.perf_counter() - t0) / len(linear_q)
+
+            for q, a, b in zip(linear_q, linear, indexed):
+                if a[0] is not b[0] or a[1] != b[1]:
+                    raise CommandError(f"Resultado distinto para {q!r}: {a[1]} vs {b[1]}")
+
+            self.stdout.write(
+                f"N={n:>7}: construcción {build * 1e3:8.1f} ms | "
+                f"lineal {t_linear * 1e3:9.2f} ms/consulta | "
+                f"índice {t_index * 1e3:7.2f} ms/consulta | "
+                f"índice+umbral {t_umbral * 1e3:7.2f} ms/consulta | "
+                f"{t_linear / t_index:6.1f}x | {len(linear_q)} resultados idénticos"
+            )
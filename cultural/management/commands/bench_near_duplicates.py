@@ -0,0 +1,60 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cultural.analysis.phash import HammingIndex, HASH_BITS
+
+
+class Command(BaseCommand):
+    help = ("Mide la búsqueda de casi-duplicados por hash perceptual y la "
+            "verifica contra un recorrido en Python puro")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--distance', type=int, default=8)
+        parser.add_argument('--linear-queries', type=int, default=50)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        r = options['distance']
+        for n in options['sizes']:
+            hashes = list({rng.getrandbits(HASH_BITS) for _ in range(n)})
+            index = HammingIndex(max_entries=len(hashes) + 1)
+            t0 = time.perf_counter()
+            for i, h in enumerate(hashes):
+                index.add(h, i)
+            build = time.perf_counter() - t0
+
+            # mitad: variantes de hashes guardados (0..r+2 bits cambiados); mitad: hashes nuevos
+            queries = []
+            for q in range(options['queries']):
+                if q % 2:
+                    queries.append(rng.getrandbits(HASH_BITS))
+                else:
+                    h = rng.choice(hashes)
+                    for b in rng.sample(range(HASH_BITS), rng.randint(0, r + 2)):
+                        h ^= 1 << b
+                    queries.append(h)
+
+            t0 = time.perf_counter()
+            found = [index.nearest(q, r) for q in queries]
+            per_query = (time.perf_counter() - t0) / len(queries)
+
+            check = queries[:options['linear_queries']]
+            t0 = time.perf_counter()
+            linear = [min((q ^ h).bit_count() for h in hashes) for q in check]
+            per_linear = (time.perf_counter() - t0) / len(check)
+
+            for q, got, d in zip(queries, found, linear):
+                expected = d if d <= r else None
+                if (got[2] if got else None) != expected:
+                    raise CommandError(f"Resultado distinto al lineal para {q:016x}: {got} vs distancia {d}")
+
+            hits = sum(1 for f in found if f)
+            self.stdout.write(
+                f"{len(hashes):>7} hashes (build {build * 1000:.0f} ms): "
+                f"índice {per_query * 1e6:.1f} µs/consulta | lineal Python {per_linear * 1e6:.0f} µs | "
+                f"{hits}/{len(queries)} encontrados a <= {r} bits | resultados idénticos"
+            )
@@ -0,0 +1,158 @@
+import base64
+import json
+import platform
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+
+from cultural.analysis import prompt as prompt_module, validation as validation_module
+from cultural.analysis.constants import MAX_FEWSHOT_EJEMPLOS
+from cultural.analysis.embeddings import EmbeddingIndex
+from cultural.analysis.knowledge import DATA_DIR, KnowledgeSnapshot, get_knowledge_snapshot, load_cultural_examples
+from cultural.analysis.parsing import extract_json, normalize_category, parse_response, parse_structured
+from cultural.analysis.prompt import _compile_analysis_prompt, build_analysis_prompt
+from cultural.analysis.schema import get_structured_output
+from cultural.analysis.title_index import TitleIndex
+from cultural.analysis.validation import MATCHERS, find_best_match, validate_with_local_knowledge
+from cultural.models import CulturalCategory
+from cultural.serializers import CulturalAnalysisSerializer
+from ._synthetic import noisy_analyses, synthetic_elements, synthetic_image_bytes
+
+# respuestas de OpenAI grabadas (limpia, en ```json, con texto alrededor, categoría libre, baja confianza)
+RESPONSES_FILE = DATA_DIR / "bench" / "respuestas_openai.json"
+
+CATEGORIAS = ['Gastronomía', 'gastronomia', 'Patrimonio Arqueológico', 'Flora Medicinal', 'danza',
+              'Leyendas y Tradiciones', ' Festividad ', 'artesanía', 'Naturaleza/Cultural', 'categoría inventada']
+
+
+def measure(fn, inputs: list, repeat: int, min_time: float) -> dict:
+    """
+    µs por llamada de `fn` sobre `inputs` (como timeit): cada ronda recorre los
+    inputs las veces necesarias para durar al menos `min_time`; se reporta la
+    mediana y el mínimo de `repeat` rondas.
+    """
+    def ronda(loops: int) -> float:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            for x in inputs:
+                fn(x)
+        return time.perf_counter() - t0
+
+    loops = 1
+    while (elapsed := ronda(loops)) < min_time:  # también calienta cachés e índices
+        loops = max(loops * 2, int(loops * min_time / max(elapsed, 1e-9)) + 1)
+    calls = loops * len(inputs)
+    rondas = [ronda(loops) / calls * 1e6 for _ in range(repeat)]
+    return {'us': round(statistics.median(rondas), 3), 'min_us': round(min(rondas), 3), 'calls': calls}
+
+
+@contextmanager
+def using_snapshot(snapshot: KnowledgeSnapshot):
+    """Hace que el prompt y la validación lean `snapshot` en vez de elementos_huanuco.json."""
+    with mock.patch.object(prompt_module, 'get_knowledge_snapshot', return_value=snapshot), \
+            mock.patch.object(validation_module, 'get_knowledge_snapshot', return_value=snapshot):
+        yield
+
+
+class Command(BaseCommand):
+    help = ("Mide por separado cada etapa del pipeline de análisis (µs por llamada) con bases de "
+            "conocimiento sintéticas y respuestas grabadas; --output guarda el resultado como baseline "
+            "JSON para bench_compare")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[0, 1000, 10_000],
+                            help="0 = base real (elementos_huanuco.json)")
+        parser.add_argument('--queries', type=int, default=20, help="Análisis a validar por tamaño")
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--min-time', type=float, default=0.1, help="Segundos mínimos por ronda")
+        parser.add_argument('--output', help="Archivo JSON donde guardar los resultados")
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.results = {}
+
+        self.bench_parsing()
+        self.bench_image_validation()
+        with tempfile.TemporaryDirectory() as tmp:
+            for n in options['sizes']:
+                self.bench_knowledge(n, Path(tmp))
+
+        if options['output']:
+            report = {
+                'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'machine': f"{platform.system()} {platform.machine()}",
+                'repeat': options['repeat'],
+                'min_time': options['min_time'],
+                'stages': self.results,
+            }
+            Path(options['output']).write_text(json.dumps(report, indent=2, ensure_ascii=False) + '\n')
+            self.stdout.write(f"Resultados guardados en {options['output']}")
+
+    def run(self, stage: str, fn, inputs: list) -> None:
+        r = self.results[stage] = measure(fn, inputs, self.options['repeat'], self.options['min_time'])
+        self.stdout.write(f"  {stage:<62} {r['us']:12.2f} µs/llamada (mín {r['min_us']:.2f})")
+
+    # === etapas que no dependen de la base de conocimiento ===
+
+    def bench_parsing(self):
+        responses = list(json.loads(RESPONSES_FILE.read_text(encoding='utf-8')).values())
+        contents = [r['choices'][0]['message']['content'] for r in responses]
+        self.stdout.write(f"Respuestas grabadas: {len(responses)}")
+        self.run('extract_json', extract_json, contents)
+        self.run('parse_response', parse_response, responses)
+        # las mismas respuestas como llegarían con salida estructurada (JSON limpio, categoría como código)
+        _, validator = get_structured_output(tuple(CulturalCategory.values))
+        structured = [{'choices': [{'message': {'content': json.dumps(parse_response(r), ensure_ascii=False)}}]}
+                      for r in responses]
+        self.run('parse_structured', lambda r: parse_structured(r, validator), structured)
+        self.run('normalize_category', normalize_category, CATEGORIAS)
+
+    def bench_image_validation(self):
+        self.stdout.write("Validación base64 (CulturalAnalysisSerializer.validate_image)")
+        serializer = CulturalAnalysisSerializer()
+        for size in (64, 1024, 2048):
+            image = base64.b64encode(synthetic_image_bytes(size, size * 3 // 4)).decode()
+            self.run(f'validate_image[{size}px]', serializer.validate_image, [image])
+            if size == 1024:
+                self.run(f'validate_image[{size}px,data_url]', serializer.validate_image,
+                         [f'data:image/jpeg;base64,{image}'])
+
+    # === etapas que recorren la base de conocimiento ===
+
+    def bench_knowledge(self, n: int, tmp: Path):
+        elementos = tuple(synthetic_elements(n)) if n else get_knowledge_snapshot().elementos
+        snapshot = KnowledgeSnapshot(elementos, version=f"bench-{n}")
+        # los embeddings del benchmark no deben pisar los de cultural/data/embeddings/
+        snapshot.derived('embedding_index', lambda el: EmbeddingIndex.for_elements(
+            el, path=tmp / f"bench-{n}.npy", manifest_path=tmp / f"bench-{n}.json"))
+        analyses = [a for a, _ in noisy_analyses(list(elementos), self.options['queries'])]
+        titulos = [a['titulo'] for a in analyses]
+        base = 'real' if not n else str(n)
+        self.stdout.write(f"Base {'real' if not n else 'sintética'}: {len(elementos)} elementos")
+
+        self.run(f'load_cultural_examples@{base}',
+                 lambda k: load_cultural_examples(k, elementos=elementos), [MAX_FEWSHOT_EJEMPLOS])
+        self.run(f'compile_analysis_prompt@{base}',
+                 lambda k: _compile_analysis_prompt(elementos, k), [MAX_FEWSHOT_EJEMPLOS])
+        # selección por presupuesto de tokens (embeddings + MMR + conteo de cada ejemplo)
+        self.run(f'compile_analysis_prompt[presupuesto]@{base}',
+                 lambda b: _compile_analysis_prompt(elementos, MAX_FEWSHOT_EJEMPLOS, token_budget=b), [3000])
+        with using_snapshot(snapshot):
+            self.run(f'build_analysis_prompt@{base}', build_analysis_prompt, [MAX_FEWSHOT_EJEMPLOS])
+
+            index = snapshot.derived('title_index', TitleIndex)
+            # sin índice es O(n) con SequenceMatcher (~1 s por consulta con 10 000 elementos)
+            self.run(f'find_best_match@{base}', lambda t: find_best_match(t, elementos), titulos[:3])
+            self.run(f'find_best_match[indice]@{base}',
+                     lambda t: find_best_match(t, elementos, index=index), titulos)
+            for metodo in MATCHERS:
+                # copia: validate_with_local_knowledge modifica el análisis
+                self.run(f'validate_with_local_knowledge[{metodo}]@{base}',
+                         lambda a, m=metodo: validate_with_local_knowledge(dict(a), m), analyses)
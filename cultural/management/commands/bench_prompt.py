@@ -0,0 +1,36 @@
+import time
+from django.core.management.base import BaseCommand
+
+from cultural.analysis.knowledge import get_knowledge_snapshot
+from cultural.analysis.constants import MAX_FEWSHOT_EJEMPLOS
+from cultural.analysis.prompt import (
+    build_analysis_prompt, _compile_analysis_prompt, get_prompt_cache_stats,
+)
+
+
+class Command(BaseCommand):
+    help = "Compara el costo por petición del prompt compilado vs. recomponerlo cada vez"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        n = options['iterations']
+        elementos = get_knowledge_snapshot().elementos
+
+        t0 = time.perf_counter()
+        for _ in range(n):
+            _compile_analysis_prompt(elementos, MAX_FEWSHOT_EJEMPLOS)
+        sin_cache = (time.perf_counter() - t0) / n
+
+        build_analysis_prompt()  # calentar
+        t0 = time.perf_counter()
+        for _ in range(n):
+            build_analysis_prompt()
+        con_cache = (time.perf_counter() - t0) / n
+
+        self.stdout.write(f"Elementos en base de conocimiento: {len(elementos)}")
+        self.stdout.write(f"Sin caché: {sin_cache * 1e6:.1f} µs/petición")
+        self.stdout.write(f"Con caché: {con_cache * 1e6:.1f} µs/petición "
+                          f"({sin_cache / con_cache:.0f}x)")
+        self.stdout.write(f"Stats: {get_prompt_cache_stats()}")
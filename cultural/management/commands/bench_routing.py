@@ -0,0 +1,61 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cultural.services import CulturalAnalysisService, OpenAIAnalysisError
+from ._mock_upstream import MockUpstream
+from ._synthetic import synthetic_images
+
+
+class Command(BaseCommand):
+    help = ("Compara el análisis en una etapa con el modo en dos etapas (ANALYSIS_TWO_STAGE) contra un "
+            "OpenAI simulado: tokens de entrada y costo por análisis, y latencia total")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20)
+        parser.add_argument('--latency', default='0.3', help="Latencia por llamada simulada (ver mock_openai)")
+        parser.add_argument('--token-delay', type=float, default=0.0, help="Segundos por token generado")
+
+    def handle(self, *args, **options):
+        images = synthetic_images(options['requests'])
+        with MockUpstream(latency=options['latency'], token_delay=options['token_delay']) as upstream:
+            rows = {}
+            for two_stage in (False, True):
+                service = CulturalAnalysisService()
+                service.API_URL = upstream.url
+                service.TWO_STAGE = two_stage
+                rows[two_stage] = self.run(service, images)
+
+        for two_stage, (latencies, prompt_tokens, costs, saved, cached) in rows.items():
+            self.stdout.write(
+                f"{'Dos etapas' if two_stage else 'Una etapa':<11} "
+                f"tokens de entrada {statistics.mean(prompt_tokens):7.0f} "
+                f"({sum(cached) / sum(prompt_tokens):4.0%} en caché de prefijos) | "
+                f"costo {statistics.mean(costs) * 1000:6.3f} USD/1000 | "
+                f"latencia p50 {statistics.median(latencies) * 1000:6.0f} ms"
+                + (f" | ahorro estimado {statistics.mean(saved):5.0f} tokens" if two_stage else "")
+            )
+        single, routed = rows[False], rows[True]
+        self.stdout.write(
+            f"Dos etapas: {1 - statistics.mean(routed[1]) / statistics.mean(single[1]):.1%} menos tokens de entrada, "
+            f"{statistics.median(routed[0]) / statistics.median(single[0]):.2f}x la latencia "
+            f"({upstream.calls} llamadas simuladas)"
+        )
+
+    def run(self, service, images):
+        latencies, prompt_tokens, costs, saved, cached = [], [], [], [], []
+        for image in images:
+            t0 = time.perf_counter()
+            try:
+                analysis = service.analyze_image(image, use_cache=False)
+            except OpenAIAnalysisError as e:
+                raise CommandError(f"Error en el análisis: {e}")
+            latencies.append(time.perf_counter() - t0)
+            metadata = analysis['metadata']
+            prompt_tokens.append(metadata['usage']['prompt_tokens'])
+            cached.append(metadata['usage']['cached_tokens'])
+            costs.append(metadata['cost_usd'] or 0.0)
+            if 'routing' in metadata:
+                saved.append(metadata['routing']['prompt_tokens_saved_est'])
+        return latencies, prompt_tokens, costs, saved, cached
@@ -0,0 +1,51 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cultural.services import CulturalAnalysisService
+from ._mock_upstream import MockUpstream
+from ._synthetic import synthetic_images
+
+
+class Command(BaseCommand):
+    help = ("Compara el tiempo hasta el primer dato útil (titulo) y el total entre "
+            "el análisis normal y el streaming, contra un OpenAI simulado que genera token a token")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=10)
+        parser.add_argument('--latency', type=float, default=0.5, help="Hasta el primer token (s)")
+        parser.add_argument('--token-delay', type=float, default=0.01, help="Entre tokens (s)")
+
+    def handle(self, *args, **options):
+        images = synthetic_images(options['requests'])
+        with MockUpstream(latency=options['latency'], token_delay=options['token_delay']) as upstream:
+            service = CulturalAnalysisService()
+            service.API_URL = upstream.url
+
+            buffered = []
+            for image in images:
+                t0 = time.perf_counter()
+                service.analyze_image(image, use_cache=False)
+                # sin streaming el título llega con la respuesta completa
+                buffered.append(time.perf_counter() - t0)
+
+            first_field, streamed = [], []
+            for image in images:
+                t0 = time.perf_counter()
+                first = None
+                for event, data in service.stream_analysis(image, use_cache=False):
+                    if event == 'field' and first is None:
+                        first = time.perf_counter() - t0
+                        if data['name'] != 'titulo':
+                            raise CommandError(f"El primer campo fue {data['name']!r}, no 'titulo'")
+                    elif event == 'error':
+                        raise CommandError(f"Error en streaming: {data}")
+                first_field.append(first)
+                streamed.append(time.perf_counter() - t0)
+
+        ms = lambda xs: f"{statistics.median(xs) * 1000:7.0f} ms"
+        self.stdout.write(f"Normal:    titulo {ms(buffered)} | total {ms(buffered)}")
+        self.stdout.write(f"Streaming: titulo {ms(first_field)} | total {ms(streamed)}")
+        self.stdout.write(f"Primer dato útil {statistics.median(buffered) / statistics.median(first_field):.1f}x antes "
+                          f"({upstream.calls} llamadas simuladas)")
@@ -0,0 +1,51 @@
+import tempfile
+import time
+from pathlib import Path
+from django.core.management.base import BaseCommand
+
+from cultural.analysis.knowledge import get_knowledge_snapshot, KnowledgeSnapshot
+from cultural.analysis.embeddings import EmbeddingIndex
+from cultural.analysis.validation import MATCHERS, MATCH_THRESHOLD, METODO_EMBEDDINGS
+from ._synthetic import synthetic_elements, noisy_analyses
+
+
+class Command(BaseCommand):
+    help = "Compara precisión y latencia de los métodos de validación local (validacion.metodo)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[0, 1000, 10_000],
+                            help="0 = base real (elementos_huanuco.json)")
+        parser.add_argument('--queries', type=int, default=100)
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as tmp:
+            for n in options['sizes']:
+                self.bench(n, options['queries'], Path(tmp))
+
+    def bench(self, n, queries, tmp):
+        elementos = tuple(synthetic_elements(n)) if n else get_knowledge_snapshot().elementos
+        snapshot = KnowledgeSnapshot(elementos, version=f"bench-{n}")
+        casos = noisy_analyses(list(elementos), queries)
+        self.stdout.write(f"Base {'real' if not n else 'sintética'}: {len(elementos)} elementos, {len(casos)} consultas")
+
+        for metodo, match in MATCHERS.items():
+            t0 = time.perf_counter()
+            if metodo == METODO_EMBEDDINGS:
+                # los embeddings del benchmark no deben pisar los de cultural/data/embeddings/
+                snapshot.derived('embedding_index', lambda el: EmbeddingIndex.for_elements(
+                    el, path=tmp / f"bench-{n}.npy", manifest_path=tmp / f"bench-{n}.json"))
+            match(casos[0][0], snapshot)  # construye el índice
+            build = time.perf_counter() - t0
+
+            aciertos = sobre_umbral = 0
+            t0 = time.perf_counter()
+            for analysis, origen in casos:
+                elem, score = match(analysis, snapshot)
+                aciertos += elem is elementos[origen]
+                sobre_umbral += score > MATCH_THRESHOLD
+            latencia = (time.perf_counter() - t0) / len(casos)
+
+            self.stdout.write(
+                f"  {metodo:<28} índice {build * 1e3:8.1f} ms | {latencia * 1e3:7.2f} ms/consulta | "
+                f"acierto@1 {aciertos / len(casos):6.1%} | sobre umbral {sobre_umbral / len(casos):6.1%}"
+            )
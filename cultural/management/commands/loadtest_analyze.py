@@ -0,0 +1,212 @@
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_started
+from django.test import Client, override_settings
+from django.test.utils import setup_databases, teardown_databases
+
+from cultural import cache as analysis_cache, services
+from cultural.analysis.phash import HammingIndex
+from cultural.jobs import JOB_MAINTENANCE_UID
+from cultural.records import get_record_writer
+from cultural.services import CulturalAnalysisService
+from ._mock_upstream import MockUpstream
+from ._synthetic import synthetic_images
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """Percentil por rango más cercano (la lista ya ordenada)."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[k]
+
+
+@contextmanager
+def isolated_state():
+    """
+    Estado propio para la carga en este proceso: base de datos de prueba (como
+    manage.py test), cachés en memoria nuevas, sin volcar métricas ni hilo de
+    trabajos. Los análisis falsos no quedan como AnalysisRecord, en la caché
+    compartida ni en /metrics del servidor real.
+    """
+    request_started.disconnect(dispatch_uid=JOB_MAINTENANCE_UID)
+    prefix = f'loadtest-{uuid.uuid4().hex}'
+    caches = {alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f'{prefix}-{alias}'}
+              for alias in ('default', 'analysis_shared')}
+    saved = analysis_cache._analysis_cache, services._near_duplicates
+    with override_settings(CACHES=caches, METRICS_DIR=''):
+        old_config = setup_databases(verbosity=0, interactive=False)
+        analysis_cache._analysis_cache = None
+        services._near_duplicates = HammingIndex(max_entries=saved[1].max_entries)
+        try:
+            yield
+        finally:
+            get_record_writer().flush()
+            analysis_cache._analysis_cache, services._near_duplicates = saved
+            teardown_databases(old_config, verbosity=0)
+
+
+class Command(BaseCommand):
+    help = ("Prueba de carga de /api/cultural/analyze/ a un ritmo fijo (req/s) contra un OpenAI "
+            "simulado: latencia p50/p95/p99, throughput, aciertos de caché y llamadas a OpenAI")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rps', type=float, default=10, help="Peticiones por segundo objetivo")
+        parser.add_argument('--duration', type=float, default=20, help="Segundos de carga")
+        parser.add_argument('--unique', type=int, default=50,
+                            help="Imágenes distintas; las peticiones las repiten al azar (aciertos de caché)")
+        parser.add_argument('--endpoint', default='/api/cultural/analyze/')
+        parser.add_argument('--workers', type=int, default=64, help="Peticiones en curso como máximo")
+        parser.add_argument('--url', help="Servidor ya levantado (p. ej. http://localhost:8000); "
+                                          "por defecto se prueba la app en este proceso, con base de "
+                                          "datos de prueba y cachés en memoria propias")
+        parser.add_argument('--mock-url', help="Con --url: OpenAI simulado (mock_openai) del que leer contadores")
+        parser.add_argument('--seed', type=int, default=0)
+        # OpenAI simulado propio (sin --url)
+        parser.add_argument('--latency', default='lognormal:0.8,0.4')
+        parser.add_argument('--token-delay', type=float, default=0.0)
+        parser.add_argument('--error-rate', type=float, default=0.0)
+        parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+        parser.add_argument('--low-confidence-rate', type=float, default=0.0)
+
+    def handle(self, *args, **options):
+        if options['rps'] <= 0 or options['duration'] <= 0:
+            raise CommandError("--rps y --duration deben ser positivos")
+        images = synthetic_images(options['unique'], seed=options['seed'])
+
+        if options['url']:
+            send = self._remote_sender(options['url'].rstrip('/') + options['endpoint'], options['workers'])
+            before = self._mock_stats(options['mock_url'])
+            results, elapsed = self._run(send, images, options)
+            after = self._mock_stats(options['mock_url'])
+            upstream = self._stats_delta(before, after)
+        else:
+            with MockUpstream(
+                latency=options['latency'],
+                seed=options['seed'],
+                token_delay=options['token_delay'],
+                error_rate=options['error_rate'],
+                rate_limit_rate=options['rate_limit_rate'],
+                low_confidence_rate=options['low_confidence_rate'],
+            ) as mock, isolated_state():
+                original_url = CulturalAnalysisService.API_URL
+                CulturalAnalysisService.API_URL = mock.url
+                try:
+                    results, elapsed = self._run(self._local_sender(options['endpoint']), images, options)
+                finally:
+                    CulturalAnalysisService.API_URL = original_url
+                upstream = mock.stats()
+
+        self._report(results, elapsed, options, upstream)
+
+    # === envío ===
+
+    def _local_sender(self, endpoint: str):
+        local = threading.local()
+
+        def send(image: str):
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = Client(HTTP_HOST='localhost', raise_request_exception=False)
+            r = client.post(endpoint, data=json.dumps({'image': image}), content_type='application/json')
+            return r.status_code, r.content
+        return send
+
+    def _remote_sender(self, url: str, workers: int):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        def send(image: str):
+            r = session.post(url, json={'image': image}, timeout=120)
+            return r.status_code, r.content
+        return send
+
+    def _run(self, send, images: list, options: dict):
+        """
+        Carga en lazo abierto: la petición i se programa en t0 + i/rps aunque las
+        anteriores no hayan terminado, y su latencia se mide desde esa hora
+        programada (si los workers se saturan, la espera cuenta).
+        """
+        rng = random.Random(options['seed'])
+        total = int(options['rps'] * options['duration'])
+        results = []
+        lock = threading.Lock()
+
+        def one(scheduled: float, image: str):
+            try:
+                status, body = send(image)
+            except Exception as e:
+                status, body = f'error:{type(e).__name__}', b''
+            latency = time.perf_counter() - scheduled
+            with lock:
+                results.append((latency, status, self._cache_hit(body)))
+
+        self.stdout.write(f"{total} peticiones a {options['rps']:g} req/s durante {options['duration']:g} s...")
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='loadtest') as pool:
+            for i in range(total):
+                scheduled = t0 + i / options['rps']
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(one, scheduled, rng.choice(images))
+        return results, time.perf_counter() - t0
+
+    @staticmethod
+    def _cache_hit(body: bytes):
+        try:
+            data = json.loads(body).get('data') or {}
+            return (data.get('metadata') or {}).get('cache_hit') or 'upstream'
+        except (ValueError, AttributeError):
+            return None
+
+    # === contadores del OpenAI simulado ===
+
+    @staticmethod
+    def _mock_stats(mock_url):
+        if not mock_url:
+            return None
+        try:
+            return requests.get(mock_url, timeout=5).json()
+        except (requests.RequestException, ValueError):
+            return None
+
+    @staticmethod
+    def _stats_delta(before, after):
+        if before is None or after is None:
+            return None
+        responses = {k: v - before['responses'].get(k, 0) for k, v in after['responses'].items()}
+        return {'calls': after['calls'] - before['calls'], 'responses': {k: v for k, v in responses.items() if v}}
+
+    # === reporte ===
+
+    def _report(self, results: list, elapsed: float, options: dict, upstream):
+        latencies = sorted(r[0] for r in results)
+        statuses = Counter(r[1] for r in results)
+        hits = Counter(r[2] for r in results if r[2] is not None)
+        answered = sum(hits.values())
+        cached = answered - hits.get('upstream', 0)
+        ms = lambda p: f"{percentile(latencies, p) * 1000:.0f} ms"
+
+        self.stdout.write(f"Peticiones: {len(results)} en {elapsed:.1f} s "
+                          f"({len(results) / elapsed:.1f} req/s; objetivo {options['rps']:g})")
+        self.stdout.write(f"Latencia: p50 {ms(50)} | p95 {ms(95)} | p99 {ms(99)} | máx {ms(100)}")
+        self.stdout.write(f"Estados HTTP: {dict(sorted(statuses.items(), key=str))}")
+        if answered:
+            detail = ', '.join(f"{k} {v}" for k, v in sorted(hits.items()) if k != 'upstream')
+            self.stdout.write(f"Caché: {cached / answered:.1%} de los análisis ({detail or 'sin aciertos'})")
+        if upstream is not None:
+            self.stdout.write(f"Llamadas a OpenAI (simulado): {upstream['calls']} {upstream['responses']}")
+        else:
+            self.stdout.write("Llamadas a OpenAI: sin datos (usa --mock-url con el servidor de mock_openai)")
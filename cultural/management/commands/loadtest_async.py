@@ -0,0 +1,50 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from cultural.analysis.openai_client import aclose_async_session
+from cultural.services import CulturalAnalysisService
+from ._mock_upstream import MockUpstream
+from ._synthetic import synthetic_images
+
+
+class Command(BaseCommand):
+    help = ("Compara análisis concurrentes con un pool de hilos (como workers WSGI) "
+            "vs. el servicio async, contra un OpenAI simulado local")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--latency', type=float, default=0.5, help="Latencia simulada de OpenAI (s)")
+        parser.add_argument('--threads', type=int, default=8, help="Hilos del modo sync")
+
+    def handle(self, *args, **options):
+        n, threads = options['requests'], options['threads']
+        images = synthetic_images(n)
+
+        with MockUpstream(latency=options['latency']) as upstream:
+            service = CulturalAnalysisService()
+            service.API_URL = upstream.url
+            service.POOL_SIZE = threads
+            service.ASYNC_POOL_SIZE = max(n, 1)
+
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                list(pool.map(lambda img: service.analyze_image(img, use_cache=False), images))
+            sync_wall = time.perf_counter() - t0
+
+            async def run_async():
+                try:
+                    return await asyncio.gather(*(service.aanalyze_image(img, use_cache=False) for img in images))
+                finally:
+                    await aclose_async_session()
+
+            t0 = time.perf_counter()
+            asyncio.run(run_async())
+            async_wall = time.perf_counter() - t0
+
+        self.stdout.write(f"{n} análisis, latencia simulada {options['latency']:.2f} s, {upstream.calls} llamadas upstream")
+        self.stdout.write(f"  sync  ({threads} hilos): {sync_wall:6.2f} s | {n / sync_wall:7.1f} análisis/s")
+        self.stdout.write(f"  async (1 hilo):    {async_wall:6.2f} s | {n / async_wall:7.1f} análisis/s "
+                          f"({sync_wall / async_wall:.1f}x)")
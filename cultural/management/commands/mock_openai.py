@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from ._mock_upstream import MockUpstream
+
+
+class Command(BaseCommand):
+    help = ("Levanta un OpenAI simulado (chat/completions) para pruebas de carga sin conexión; "
+            "apunta OPENAI_API_URL a la URL que imprime")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', default='lognormal:0.8,0.4',
+                            help="Segundos: 0.5 | uniform:0.2,1.5 | lognormal:mediana,sigma")
+        parser.add_argument('--token-delay', type=float, default=0.0, help="Segundos por token generado")
+        parser.add_argument('--error-rate', type=float, default=0.0, help="Fracción de respuestas 5xx")
+        parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Fracción de respuestas 429")
+        parser.add_argument('--low-confidence-rate', type=float, default=0.0)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        upstream = MockUpstream(
+            latency=options['latency'],
+            seed=options['seed'],
+            token_delay=options['token_delay'],
+            error_rate=options['error_rate'],
+            rate_limit_rate=options['rate_limit_rate'],
+            low_confidence_rate=options['low_confidence_rate'],
+            host=options['host'],
+            port=options['port'],
+        )
+        self.stdout.write(f"OpenAI simulado en {upstream.url} (contadores: GET /stats). Ctrl+C para terminar.")
+        try:
+            upstream.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            upstream.server.server_close()
+            self.stdout.write(f"\n{upstream.stats()}")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from cultural.jobs import get_job_runner, purge_expired_jobs, reset_stale_jobs
+
+
+class Command(BaseCommand):
+    help = ("Purga los trabajos de análisis expirados y devuelve a la cola los que quedaron a medias "
+            "(para el arranque del despliegue o un cron); con --run los procesa en este proceso")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--run', action='store_true',
+                            help="Procesar aquí los pendientes y esperar a que terminen")
+        parser.add_argument('--timeout', type=float, default=600.0, help="Segundos máximos de espera con --run")
+
+    def handle(self, *args, **options):
+        if options['run']:
+            runner = get_job_runner()
+            enqueued = runner.recover(force=True)
+            self.stdout.write(f"{enqueued} trabajos reencolados")
+            if not runner.wait_idle(options['timeout']):
+                self.stderr.write("Tiempo de espera agotado con trabajos aún en cola")
+            return
+        purged = purge_expired_jobs()
+        reset = reset_stale_jobs()
+        self.stdout.write(f"{purged} trabajos expirados borrados, {reset} trabajos colgados devueltos a pendiente")
@@ -0,0 +1,407 @@
+# cultural/metrics.py
+"""
+Contadores e histogramas en formato de texto de Prometheus (ver /metrics).
+
+Cada proceso acumula sus valores en memoria y un hilo los vuelca cada
+METRICS_FLUSH_INTERVAL segundos a METRICS_DIR/<pid>-<inicio>.json (el inicio
+del proceso distingue un pid reutilizado). /metrics suma los archivos de todos
+los workers, así que el resultado no depende del worker que atienda el scrape
+(los demás pueden ir hasta un intervalo atrasados).
+
+Como en el modo multiproceso de prometheus_client, lo de los workers terminados
+no se pierde: /metrics junta sus archivos en dead.json, así los contadores no
+retroceden y el directorio no crece con cada worker reciclado. Al arrancar un
+master nuevo (el primer worker que escribe ve que el master anotado en el
+directorio ya no existe) se vacía el directorio. Con METRICS_DIR vacío solo se
+reportan los valores del proceso que responde.
+"""
+import atexit
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from django.conf import settings
+
+try:
+    import fcntl  # candado entre procesos (POSIX)
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# segundos; cubre desde un acierto de caché local hasta una llamada lenta a OpenAI
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+DEAD_FILE = 'dead.json'      # suma de los workers terminados
+MASTER_FILE = 'master'       # master que llenó el directorio
+LOCK_FILE = '.lock'
+MERGED = '__merged__'        # en dead.json: procesos ya sumados (por si se cae antes de borrar sus archivos)
+
+
+def _process_start(pid: int) -> Optional[str]:
+    """Inicio del proceso en ticks desde el arranque del sistema (Linux); None sin /proc o si no existe."""
+    try:
+        stat = Path(f'/proc/{pid}/stat').read_text()
+    except OSError:
+        return None
+    return stat.rsplit(')', 1)[1].split()[19]
+
+
+def _process_id(pid: int) -> str:
+    start = _process_start(pid)
+    if start is None:  # sin /proc: la hora a la que este proceso empezó a registrar
+        start = str(int(time.time() * 1000))
+    return f'{pid}-{start}'
+
+
+def _is_dead(process_id: str) -> bool:
+    """Sin /proc no se puede saber: se lo da por vivo (no se junta, pero tampoco se pierde)."""
+    pid, _, start = process_id.partition('-')
+    if not pid.isdigit() or not Path('/proc/self').exists():
+        return False
+    return _process_start(int(pid)) != start
+
+
+@contextmanager
+def _dir_lock(directory: Path):
+    directory.mkdir(parents=True, exist_ok=True)
+    if fcntl is None:
+        yield
+        return
+    with open(directory / LOCK_FILE, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_json(path: Path) -> Optional[Dict]:
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Archivo de métricas ilegible {path.name}: {e}")
+        return None
+
+
+def _write_json(path: Path, data: Dict) -> None:
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(data))
+    os.replace(tmp, path)  # el lector nunca ve un archivo a medias
+
+
+def clear_metrics_dir(directory: Optional[Path] = None) -> None:
+    """Borra los valores guardados (arranque de un master nuevo, pruebas)."""
+    directory = directory or metrics_dir()
+    if directory is None or not directory.is_dir():
+        return
+    for path in directory.iterdir():
+        if path.name != LOCK_FILE:
+            path.unlink(missing_ok=True)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, 'Metric'] = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._process = _process_id(self._pid)
+        self._claimed = False
+        self._flusher: Optional[threading.Thread] = None
+        self._dirty = False
+
+    def register(self, metric: 'Metric') -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"Métrica duplicada: {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def _check_fork(self) -> None:
+        if self._pid != os.getpid():
+            # proceso hijo (fork): lo heredado ya está en el archivo del padre
+            self._pid = os.getpid()
+            self._process = _process_id(self._pid)
+            self._claimed = False
+            self._flusher = None
+            for metric in self._metrics.values():
+                metric.values.clear()
+
+    def _before_update(self) -> None:
+        """Se llama con el candado tomado antes de cada actualización."""
+        self._check_fork()
+        self._dirty = True
+        if self._flusher is None and metrics_dir():
+            self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+            self._flusher.start()
+            atexit.register(self._safe_flush)  # lo del último intervalo
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            self._check_fork()
+            return {name: m.dump() for name, m in self._metrics.items()}
+
+    # === entre procesos ===
+
+    def flush(self) -> None:
+        directory = metrics_dir()
+        if not directory:
+            return
+        with self._lock:
+            self._dirty = False
+        data = self.snapshot()
+        if not self._claimed:
+            self._claim(directory)
+        _write_json(directory / f'{self._process}.json', data)
+
+    def _claim(self, directory: Path) -> None:
+        """Antes de la primera escritura del proceso: si el master anotado ya no existe, es un arranque nuevo."""
+        master = _process_id(os.getppid()) if _process_start(os.getppid()) else None
+        with _dir_lock(directory):
+            marker = directory / MASTER_FILE
+            previous = marker.read_text() if marker.exists() else None
+            if master is not None and previous != master and (previous is None or _is_dead(previous)):
+                clear_metrics_dir(directory)
+                marker.write_text(master)
+        self._claimed = True
+
+    def _safe_flush(self) -> None:
+        try:
+            self.flush()
+        except OSError as e:
+            logger.warning(f"No se pudieron guardar las métricas: {e}")
+
+    def _flush_loop(self) -> None:
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(getattr(settings, 'METRICS_FLUSH_INTERVAL', 5))
+            if self._dirty:
+                self._safe_flush()
+
+    def collect(self) -> Dict:
+        """Valores sumados de todos los procesos (o solo de este si no hay METRICS_DIR)."""
+        directory = metrics_dir()
+        if not directory:
+            return self.snapshot()
+        self._safe_flush()
+        totals = {name: {} for name in self._metrics}
+        try:
+            # con el candado: otro scrape no junta archivos mientras se leen
+            with _dir_lock(directory):
+                self._compact(directory)
+                for path in directory.glob('*.json'):
+                    self._merge(totals, _read_json(path))
+        except OSError as e:
+            logger.warning(f"No se pudieron leer las métricas de los workers: {e}")
+            return self.snapshot()
+        return totals
+
+    def _merge(self, totals: Dict, data: Optional[Dict]) -> None:
+        for name, samples in (data or {}).items():
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric.merge(totals[name], samples)
+
+    def _compact(self, directory: Path) -> None:
+        """Suma en dead.json los archivos de procesos terminados y los borra (con el candado tomado)."""
+        dead = [path for path in directory.glob('*-*.json') if _is_dead(path.stem)]
+        if not dead:
+            return
+        data = _read_json(directory / DEAD_FILE) or {}
+        merged = {p for p in data.pop(MERGED, []) if (directory / f'{p}.json').exists()}
+        totals = {name: {} for name in self._metrics}
+        self._merge(totals, data)
+        for path in dead:
+            if path.stem not in merged:
+                self._merge(totals, _read_json(path))
+                merged.add(path.stem)
+        compacted = {name: metric.dump(totals[name]) for name, metric in self._metrics.items()}
+        compacted[MERGED] = sorted(merged)
+        _write_json(directory / DEAD_FILE, compacted)
+        for path in dead:
+            path.unlink(missing_ok=True)
+
+    def render(self) -> str:
+        values = self.collect()
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            lines.extend(metric.render(values.get(name, {})))
+        return '\n'.join(lines) + '\n'
+
+
+def metrics_dir() -> Optional[Path]:
+    directory = getattr(settings, 'METRICS_DIR', '')
+    return Path(directory) if directory else None
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Tuple[str, str] = None) -> str:
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 registry: Optional[Registry] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry or REGISTRY
+        self.values: Dict[Tuple[str, ...], object] = {}  # valores de etiquetas -> valor
+        self.registry.register(self)
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} espera las etiquetas {self.labelnames}, no {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def dump(self, values: Optional[Dict] = None) -> list:
+        """[[valores de etiquetas, valor], ...] serializable a JSON (con el candado tomado), o de `values` sumados."""
+        return [[list(k), v] for k, v in (self.values if values is None else values).items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self.registry._lock:
+            self.registry._before_update()
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def merge(self, totals: Dict, samples: list) -> None:
+        for key, value in samples:
+            key = tuple(key)
+            totals[key] = totals.get(key, 0.0) + value
+
+    def render(self, totals: Dict) -> list:
+        if not totals and not self.labelnames:
+            return [f'{self.name} 0.0']
+        return [f'{self.name}{_labels(self.labelnames, k)} {_number(v)}' for k, v in sorted(totals.items())]
+
+
+class Histogram(Metric):
+    """Por combinación de etiquetas guarda [conteos por bucket (no acumulados) + el de +Inf, suma]."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: Optional[Registry] = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)  # primer bucket con value <= le
+        with self.registry._lock:
+            self.registry._before_update()
+            data = self.values.get(key)
+            if data is None:
+                data = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            data[0][i] += 1
+            data[1] += value
+
+    def dump(self, values: Optional[Dict] = None) -> list:
+        return [[list(k), {'buckets': list(self.buckets), 'counts': list(c), 'sum': s}]
+                for k, (c, s) in (self.values if values is None else values).items()]
+
+    def merge(self, totals: Dict, samples: list) -> None:
+        for key, data in samples:
+            if tuple(data['buckets']) != self.buckets:
+                continue  # archivo de una versión con otros buckets
+            key = tuple(key)
+            counts, total = totals.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            totals[key] = ([a + b for a, b in zip(counts, data['counts'])], total + data['sum'])
+
+    def render(self, totals: Dict) -> list:
+        lines = []
+        for key, (counts, total) in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = ('le', '+Inf' if math.isinf(bound) else repr(float(bound)))
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+REGISTRY = Registry()
+
+
+# === métricas de la API ===
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', "Latencia de las peticiones por vista (nombre de la URL)",
+    ['view', 'method', 'status'],
+)
+ANALYSIS_STAGE_SECONDS = Histogram(
+    'analysis_stage_duration_seconds', "Duración de cada etapa del análisis (prepare, routing, upstream, postprocess, total)",
+    ['stage'],
+)
+ANALYSIS_CACHE_HITS = Counter(
+    'analysis_cache_hits_total', "Análisis servidos sin llamar a OpenAI", ['kind', 'tier'],
+)
+ANALYSIS_UPSTREAM_CALLS = Counter(
+    'analysis_upstream_calls_total',
+    "Llamadas a OpenAI de análisis sin resultado en caché, por etapa: routing (primera del modo en dos etapas) o upstream",
+    ['stage'],
+)
+ANALYSIS_TOKENS = Counter(
+    'analysis_tokens_total', "Tokens consumidos en OpenAI", ['type'],
+)
+ANALYSIS_PARSE_FAILURES = Counter(
+    'analysis_parse_failures_total', "Respuestas de OpenAI que no se pudieron interpretar",
+)
+ANALYSIS_PARSE_PATH = Counter(
+    'analysis_parse_path_total',
+    "Respuestas interpretadas por camino: strict (schema respetado), fallback (no lo respetó) o tolerant (sin schema)",
+    ['path'],
+)
+ANALYSIS_LOW_CONFIDENCE = Counter(
+    'analysis_low_confidence_rejections_total', "Análisis rechazados por confianza bajo el umbral",
+)
+ANALYSIS_ROUTING = Counter(
+    'analysis_routing_total', "Categoría elegida por la primera etapa del modo en dos etapas", ['categoria'],
+)
+ANALYSIS_PROMPT_CACHE_RATIO = Histogram(
+    'analysis_prompt_cache_ratio', "Fracción de los tokens de entrada servidos desde la caché de prefijos de OpenAI",
+    buckets=(0, 0.25, 0.5, 0.6, 0.7, 0.8, 0.9, 1),
+)
+ANALYSIS_UPSTREAM_SECONDS = Histogram(
+    'analysis_upstream_duration_seconds', "Duración de la llamada principal a OpenAI según la caché de prefijos",
+    ['prompt_cache'],
+)
+ANALYSIS_PROMPT_TOKENS_ERROR = Histogram(
+    'analysis_prompt_tokens_error_ratio',
+    "Error relativo del conteo local de tokens de entrada: (predicho - real) / real",
+    buckets=(-0.5, -0.2, -0.1, -0.05, -0.02, 0, 0.02, 0.05, 0.1, 0.2, 0.5),
+)
+ANALYSIS_ERRORS = Counter(
+    'analysis_errors_total', "Análisis fallidos por motivo", ['reason'],
+)
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
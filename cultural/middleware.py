@@ -0,0 +1,42 @@
+# cultural/middleware.py
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+
+from .metrics import HTTP_REQUEST_SECONDS
+
+_METHODS = {'GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'HEAD', 'OPTIONS'}
+
+
+def _observe(request, response, t0: float) -> None:
+    # nombre de la URL (cultural/urls.py, authentication/urls.py, admin:...): cardinalidad acotada
+    match = getattr(request, 'resolver_match', None)
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - t0,
+        view=match.view_name if match else 'sin_ruta',
+        method=request.method if request.method in _METHODS else 'OTRO',
+        status=response.status_code,
+    )
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Latencia de cada petición por vista en http_request_duration_seconds.
+    En respuestas en streaming (SSE) mide hasta que se envían las cabeceras.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            t0 = time.perf_counter()
+            response = await get_response(request)
+            _observe(request, response, t0)
+            return response
+        return markcoroutinefunction(middleware)
+
+    def middleware(request):
+        t0 = time.perf_counter()
+        response = get_response(request)
+        _observe(request, response, t0)
+        return response
+    return middleware
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-18 09:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cultural', '0005_analysisjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('model', models.CharField(max_length=100)),
+                ('prompt_version', models.CharField(max_length=20)),
+                ('validation_method', models.CharField(max_length=50)),
+                ('success', models.BooleanField(default=True)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+                ('prompt_tokens', models.PositiveIntegerField(default=0)),
+                ('completion_tokens', models.PositiveIntegerField(default=0)),
+                ('total_tokens', models.PositiveIntegerField(default=0)),
+                ('api_cost', models.DecimalField(blank=True, decimal_places=6, max_digits=10, null=True)),
+                ('processing_time', models.FloatField(default=0)),
+                ('timings', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Registro de Análisis',
+                'verbose_name_plural': 'Registros de Análisis',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['content_hash', 'model', 'prompt_version', 'validation_method'], name='analysis_record_lookup')],
+            },
+        ),
+    ]
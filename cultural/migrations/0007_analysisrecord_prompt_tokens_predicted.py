@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cultural', '0006_analysisrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisrecord',
+            name='prompt_tokens_predicted',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
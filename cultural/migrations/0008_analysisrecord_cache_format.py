@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-18 10:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cultural', '0007_analysisrecord_prompt_tokens_predicted'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='analysisrecord',
+            name='analysis_record_lookup',
+        ),
+        migrations.AddField(
+            model_name='analysisrecord',
+            name='cache_format',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='analysisrecord',
+            index=models.Index(fields=['content_hash', 'model', 'prompt_version', 'validation_method', 'cache_format'], name='analysis_record_lookup'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 # cultural/models.py
+import uuid
 from django.db import models
 from django.contrib.auth import get_user_model
 
@@ -139,4 +140,83 @@ class CulturalReport(models.Model):
         verbose_name_plural = 'Reportes Culturales'
     
     def __str__(self):
-        return f"Reporte #{self.id} - {self.titulo} ({self.get_status_display()})"
\ No newline at end of file
+        return f"Reporte #{self.id} - {self.titulo} ({self.get_status_display()})"
+
+class AnalysisJobStatus(models.TextChoices):
+    PENDIENTE = 'PENDIENTE', 'Pendiente'
+    PROCESANDO = 'PROCESANDO', 'Procesando'
+    COMPLETADO = 'COMPLETADO', 'Completado'
+    FALLIDO = 'FALLIDO', 'Fallido'
+
+
+class AnalysisJob(models.Model):
+    """Análisis en segundo plano: el cliente lo encola y consulta el resultado después"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(
+        max_length=20,
+        choices=AnalysisJobStatus.choices,
+        default=AnalysisJobStatus.PENDIENTE,
+        db_index=True
+    )
+    # La imagen ya reducida (la que se envía a OpenAI), no la original; se vacía al
+    # terminar el trabajo para no guardarla más de lo necesario
+    image_base64 = models.TextField(blank=True)
+    # sha256 de la original: el trabajo usa la misma clave de caché que /analyze/
+    content_hash = models.CharField(max_length=64, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='analysis_jobs')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = 'Trabajo de Análisis'
+        verbose_name_plural = 'Trabajos de Análisis'
+
+    def __str__(self):
+        return f"Trabajo {self.id} ({self.get_status_display()})"
+
+
+class AnalysisRecord(models.Model):
+    """
+    Cada análisis hecho con OpenAI (exitoso o no): resultado, tokens, costo y tiempos.
+    Los exitosos son además el nivel persistente de la caché de análisis.
+    """
+    content_hash = models.CharField(max_length=64)  # sha256 de los bytes de la imagen
+    model = models.CharField(max_length=100)
+    prompt_version = models.CharField(max_length=20)
+    validation_method = models.CharField(max_length=50)
+    # AnalysisKey.cache_format del resultado; 0 en filas anteriores (no se sirven desde caché)
+    cache_format = models.PositiveSmallIntegerField(default=0)
+
+    success = models.BooleanField(default=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    prompt_tokens = models.PositiveIntegerField(default=0)
+    prompt_tokens_predicted = models.PositiveIntegerField(null=True, blank=True)  # conteo local (analysis.tokens)
+    completion_tokens = models.PositiveIntegerField(default=0)
+    total_tokens = models.PositiveIntegerField(default=0)
+    api_cost = models.DecimalField(max_digits=10, decimal_places=6, null=True, blank=True)
+    processing_time = models.FloatField(default=0)  # en segundos
+    timings = models.JSONField(default=dict, blank=True)  # ms por etapa
+
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['content_hash', 'model', 'prompt_version', 'validation_method', 'cache_format'],
+                         name='analysis_record_lookup'),
+        ]
+        verbose_name = 'Registro de Análisis'
+        verbose_name_plural = 'Registros de Análisis'
+
+    def __str__(self):
+        estado = 'OK' if self.success else 'Error'
+        return f"Análisis {self.content_hash[:12]} ({self.model}, {estado})"
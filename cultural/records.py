@@ -0,0 +1,168 @@
+# cultural/records.py
+"""
+Registro persistente de análisis (AnalysisRecord).
+
+Las filas se escriben en un hilo aparte, en lotes, para no sumar el INSERT a la
+latencia de la petición. Si la cola se llena (base de datos caída o lenta) los
+registros se descartan con un warning: el análisis ya se respondió al cliente.
+"""
+import atexit
+import copy
+import logging
+import queue
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .analysis.pricing import estimate_cost, usage_tokens
+from .cache import AnalysisKey, encode_value
+from .models import AnalysisRecord
+
+logger = logging.getLogger(__name__)
+
+RECORD_MAX_QUEUE = getattr(settings, 'ANALYSIS_RECORD_MAX_QUEUE', 1000)
+RECORD_BATCH_SIZE = 50
+
+
+def build_record(key: AnalysisKey, result: Optional[Dict] = None, error: str = '',
+                 usage: Optional[Dict] = None, timings: Optional[Dict] = None,
+                 prompt_tokens_predicted: Optional[int] = None) -> AnalysisRecord:
+    tokens = usage_tokens(usage)
+    cost = estimate_cost(key.model, usage) if usage else None
+    timings = timings or {}
+    return AnalysisRecord(
+        content_hash=key.content_hash,
+        model=key.model,
+        prompt_version=key.prompt_version,
+        validation_method=key.validation_method,
+        cache_format=key.cache_format,
+        success=result is not None,
+        result=result,
+        error=error,
+        prompt_tokens=tokens['prompt_tokens'],
+        prompt_tokens_predicted=prompt_tokens_predicted,
+        completion_tokens=tokens['completion_tokens'],
+        total_tokens=tokens['total_tokens'],
+        api_cost=cost,
+        processing_time=round(timings.get('total_ms', 0.0) / 1000, 4),
+        timings=timings,
+    )
+
+
+class AnalysisRecordWriter:
+    def __init__(self, max_queue: int = RECORD_MAX_QUEUE, batch_size: int = RECORD_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue: "queue.Queue[AnalysisRecord]" = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+
+    def submit(self, record: AnalysisRecord) -> None:
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Cola de registros de análisis llena; se descarta un registro")
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Espera a que se escriba lo encolado (comandos, pruebas y salida del proceso)."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='analysis-records', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            close_old_connections()
+            try:
+                AnalysisRecord.objects.bulk_create(batch)
+                self.written += len(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                logger.error(f"No se pudieron guardar {len(batch)} registros de análisis: {e}")
+            finally:
+                close_old_connections()
+                for _ in batch:
+                    self._queue.task_done()
+
+
+_writer = AnalysisRecordWriter()
+atexit.register(_writer.flush)
+
+
+def get_record_writer() -> AnalysisRecordWriter:
+    return _writer
+
+
+def record_analysis(key: AnalysisKey, result: Optional[Dict] = None, error: str = '',
+                    usage: Optional[Dict] = None, timings: Optional[Dict] = None,
+                    prompt_tokens_predicted: Optional[int] = None) -> None:
+    """Encola el registro de un análisis (exitoso si `result` no es None)."""
+    try:
+        # copia: el hilo escritor serializa `result` después, cuando quien llama ya pudo modificarlo
+        _writer.submit(build_record(key, copy.deepcopy(result), error, usage, timings, prompt_tokens_predicted))
+    except Exception as e:
+        logger.warning(f"Error registrando análisis: {e}")
+
+
+class RecordTier:
+    """
+    Nivel persistente de la caché: el análisis exitoso más reciente con la misma
+    imagen, modelo, versión de prompt, método de validación y formato. Las filas las
+    escribe record_analysis (con tokens y costo), así que set() no hace nada.
+    """
+
+    def __init__(self, name: str, ttl: int):
+        self.name = name
+        self.ttl = ttl
+
+    def get(self, key: AnalysisKey) -> Optional[bytes]:
+        result = AnalysisRecord.objects.filter(
+            content_hash=key.content_hash,
+            model=key.model,
+            prompt_version=key.prompt_version,
+            validation_method=key.validation_method,
+            cache_format=key.cache_format,
+            success=True,
+            created_at__gte=timezone.now() - timedelta(seconds=self.ttl),
+        ).values_list('result', flat=True).first()
+        return encode_value(result) if result is not None else None
+
+    def set(self, key: AnalysisKey, blob: bytes) -> None:
+        pass
+
+    def delete(self, key: AnalysisKey) -> None:
+        pass  # las filas son el historial de análisis: no se borran desde la caché
+
+    async def aget(self, key: AnalysisKey) -> Optional[bytes]:
+        return await sync_to_async(self.get)(key)
+
+    async def aset(self, key: AnalysisKey, blob: bytes) -> None:
+        pass
+
+    async def adelete(self, key: AnalysisKey) -> None:
+        pass
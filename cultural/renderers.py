@@ -0,0 +1,35 @@
+# cultural/renderers.py
+"""
+Renderers de las vistas que responden en streaming. La respuesta exitosa es un
+StreamingHttpResponse que DRF no renderiza; estos renderers existen para que la
+negociación de contenido acepte el Accept del cliente (si no, 406 antes de
+llegar a la vista) y para dar a los errores previos al stream (400) el mismo
+formato que el stream.
+"""
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class EventStreamRenderer(BaseRenderer):
+    """text/event-stream (EventSource); un error de validación sale como evento "error"."""
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return b'' if data is None else sse_event('error', data).encode('utf-8')
+
+
+class NDJSONRenderer(BaseRenderer):
+    """application/x-ndjson (/analyze/batch en streaming); un error de validación sale como una línea."""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return b'' if data is None else (json.dumps(data, ensure_ascii=False) + '\n').encode('utf-8')
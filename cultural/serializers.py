@@ -1,8 +1,63 @@
 # cultural/serializers.py
 from rest_framework import serializers
-from .models import CulturalItem, CulturalCategory, CulturalReport, ReportStatus, ReportType
-import base64
+from .models import AnalysisJob, CulturalItem, CulturalCategory, CulturalReport, ReportStatus, ReportType
+from .analysis.images import ImagePreparationError, SourceImage
+from .uploads import source_from_upload
+import os
+from django.conf import settings
 from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import UploadedFile
+
+
+class ImageInputField(serializers.Field):
+    """Imagen como string base64 (JSON) o como archivo (multipart/form-data); validate_image la convierte en SourceImage."""
+    default_error_messages = {
+        'invalid': 'Se esperaba un string base64 o un archivo de imagen.',
+    }
+
+    def to_internal_value(self, data):
+        if not isinstance(data, (str, UploadedFile)):
+            self.fail('invalid')
+        return data
+
+    def to_representation(self, value):
+        return None
+
+
+def validate_uploaded_image(file):
+    """Archivo subido: no vacío y dentro de IMAGE_UPLOAD_MAX_BYTES."""
+    max_bytes = getattr(settings, 'IMAGE_UPLOAD_MAX_BYTES', 20 * 1024 * 1024)
+    if not file.size:
+        raise serializers.ValidationError("El archivo de imagen está vacío")
+    if file.size > max_bytes:
+        raise serializers.ValidationError(f"La imagen supera el máximo de {max_bytes // (1024 * 1024)} MB")
+    return file
+
+
+def validate_source_image(value: str) -> SourceImage:
+    """Decodifica el base64 una sola vez; el SourceImage sigue hasta el análisis o el guardado."""
+    try:
+        return SourceImage.from_base64(value)
+    except ImagePreparationError as e:
+        raise serializers.ValidationError(str(e))
+
+
+def save_uploaded_image(instance, file, prefix: str) -> None:
+    """Guarda el archivo subido en instance.imagen como <prefix>_<id>.<ext> (el temporal se mueve, no se copia)."""
+    ext = os.path.splitext(file.name or '')[1].lstrip('.').lower() or 'jpg'
+    try:
+        instance.imagen.save(f'{prefix}_{instance.id}.{ext}', file, save=True)
+    except Exception as e:
+        print(f"Error guardando imagen subida: {e}")
+
+
+def save_source_image(instance, source: SourceImage, prefix: str) -> None:
+    """Guarda los bytes ya decodificados al validar; la extensión sale del MIME detectado."""
+    try:
+        instance.imagen.save(f'{prefix}_{instance.id}.{source.extension}', ContentFile(source.read()), save=True)
+    except Exception as e:
+        print(f"Error guardando imagen base64: {e}")
+
 
 class CulturalItemSerializer(serializers.ModelSerializer):
     categoria_display = serializers.CharField(source='get_categoria_display', read_only=True)
@@ -21,27 +76,25 @@ class CulturalItemSerializer(serializers.ModelSerializer):
             'is_validated', 'created_at', 'updated_at'
         ]
         extra_kwargs = {
-            'imagen': {'read_only': True},
+            # escribible solo como archivo (multipart); en JSON se usa imagen_base64
+            'imagen': {'required': False, 'allow_null': True},
             'created_by': {'read_only': True},
         }
     
+    def validate_imagen(self, value):
+        """Archivo subido (multipart): mismo límite de tamaño que en el análisis"""
+        return validate_uploaded_image(value) if value else value
+
     def validate_imagen_base64(self, value):
-        """Validar que el campo imagen_base64 sea base64 válido si se proporciona"""
+        """Validar que el campo imagen_base64 sea base64 válido si se proporciona (queda decodificado)"""
         if value and value.strip():
-            try:
-                # Remover el prefijo data:image/...;base64, si existe
-                if ';base64,' in value:
-                    format_part, imgstr = value.split(';base64,')
-                    base64.b64decode(imgstr)
-                else:
-                    base64.b64decode(value)
-            except Exception as e:
-                raise serializers.ValidationError(f"Formato de imagen base64 inválido: {str(e)}")
-        return value
+            return validate_source_image(value)
+        return None
     
     def create(self, validated_data):
-        # Extraer imagen_base64 antes de crear el objeto
+        # Extraer imagen_base64 (o el archivo subido) antes de crear el objeto
         imagen_base64 = validated_data.pop('imagen_base64', None)
+        imagen = validated_data.pop('imagen', None)
         
         # Establecer el usuario
         request = self.context.get('request')
@@ -51,87 +104,89 @@ class CulturalItemSerializer(serializers.ModelSerializer):
         # Crear el objeto sin imagen_base64
         cultural_item = super().create(validated_data)
         
-        # Si hay imagen base64, convertirla y guardarla
-        if imagen_base64 and imagen_base64.strip():
-            try:
-                # Remover el prefijo data:image/...;base64, si existe
-                if ';base64,' in imagen_base64:
-                    format_part, imgstr = imagen_base64.split(';base64,')
-                    ext = format_part.split('/')[-1] if '/' in format_part else 'jpg'
-                else:
-                    imgstr = imagen_base64
-                    ext = 'jpg'
-                
-                # Decodificar y crear archivo
-                data = ContentFile(
-                    base64.b64decode(imgstr), 
-                    name=f'cultural_{cultural_item.id}.{ext}'
-                )
-                cultural_item.imagen = data
-                cultural_item.save()
-            except Exception as e:
-                # Si falla, continuar sin imagen
-                print(f"Error procesando imagen base64: {e}")
+        if imagen:
+            save_uploaded_image(cultural_item, imagen, 'cultural')
+        # Si hay imagen base64 (ya decodificada al validar), guardarla
+        elif imagen_base64:
+            save_source_image(cultural_item, imagen_base64, 'cultural')
         
         return cultural_item
     
     def update(self, instance, validated_data):
-        # Extraer imagen_base64 antes de actualizar el objeto
+        # Extraer imagen_base64 (o el archivo subido) antes de actualizar el objeto
         imagen_base64 = validated_data.pop('imagen_base64', None)
+        imagen = validated_data.pop('imagen', None)
         
         # Actualizar el objeto sin imagen_base64
         cultural_item = super().update(instance, validated_data)
         
-        # Si hay nueva imagen base64, convertirla y guardarla
-        if imagen_base64 and imagen_base64.strip():
-            try:
-                # Remover el prefijo data:image/...;base64, si existe
-                if ';base64,' in imagen_base64:
-                    format_part, imgstr = imagen_base64.split(';base64,')
-                    ext = format_part.split('/')[-1] if '/' in format_part else 'jpg'
-                else:
-                    imgstr = imagen_base64
-                    ext = 'jpg'
-                
-                # Decodificar y crear archivo
-                data = ContentFile(
-                    base64.b64decode(imgstr), 
-                    name=f'cultural_{cultural_item.id}.{ext}'
-                )
-                cultural_item.imagen = data
-                cultural_item.save()
-            except Exception as e:
-                print(f"Error procesando imagen base64 en actualización: {e}")
+        if imagen:
+            save_uploaded_image(cultural_item, imagen, 'cultural')
+        # Si hay nueva imagen base64, guardarla
+        elif imagen_base64:
+            save_source_image(cultural_item, imagen_base64, 'cultural')
         
         return cultural_item
 
 
 class CulturalAnalysisSerializer(serializers.Serializer):
-    image = serializers.CharField(required=True)
+    image = ImageInputField(required=True)
     ubicacion = serializers.CharField(default="Huánuco, Perú", required=False)
     
     def validate_image(self, value):
-        """Validar que el campo image no esté vacío y sea base64 válido"""
+        """Validar que el campo image no esté vacío; devuelve el SourceImage (base64 decodificado una vez o archivo subido)"""
+        if isinstance(value, SourceImage):
+            return value
+        if isinstance(value, UploadedFile):
+            return source_from_upload(validate_uploaded_image(value))
         if not value or value.strip() == "":
             raise serializers.ValidationError("El campo image no puede estar vacío")
-        
-        try:
-            # Validar formato base64
-            if ';base64,' in value:
-                format_part, imgstr = value.split(';base64,')
-                base64.b64decode(imgstr)
-            else:
-                base64.b64decode(value)
-        except Exception as e:
-            raise serializers.ValidationError(f"Formato de imagen base64 inválido: {str(e)}")
-        
-        return value
+        return validate_source_image(value)
     
     def validate(self, data):
         """Validaciones adicionales a nivel del objeto completo"""
         # Puedes agregar validaciones que involucren múltiples campos aquí
         return data
 
+class BatchImageField(serializers.JSONField):
+    """Elemento del lote: JSON (string u objeto) o archivo subido."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, UploadedFile):
+            return data
+        return super().to_internal_value(data)
+
+
+class CulturalBatchAnalysisSerializer(serializers.Serializer):
+    """
+    Lote de imágenes para /analyze/batch. Cada elemento de `images` es un string
+    base64 o un objeto {"id": ..., "image": ...}; el id se devuelve con su resultado.
+    En multipart/form-data, una parte `images` por archivo (id = posición).
+    """
+    images = serializers.ListField(child=BatchImageField(), allow_empty=False)
+    stream = serializers.BooleanField(default=False, required=False)
+
+    def validate_images(self, value):
+        max_images = getattr(settings, 'ANALYSIS_BATCH_MAX_IMAGES', 50)
+        if len(value) > max_images:
+            raise serializers.ValidationError(f"Máximo {max_images} imágenes por lote")
+
+        items = []
+        for i, item in enumerate(value):
+            if isinstance(item, dict):
+                item_id, image = item.get('id', i), item.get('image')
+            else:
+                item_id, image = i, item
+            if not isinstance(image, (str, UploadedFile)):
+                raise serializers.ValidationError(f"Imagen {item_id}: se esperaba un string base64 o un archivo")
+            try:
+                image = CulturalAnalysisSerializer().validate_image(image)
+            except serializers.ValidationError as e:
+                raise serializers.ValidationError(f"Imagen {item_id}: {e.detail[0]}")
+            items.append({'id': item_id, 'image': image})
+        return items
+
+
 class CulturalReportSerializer(serializers.ModelSerializer):
     """Serializer para crear reportes de usuario"""
     categoria_display = serializers.CharField(source='get_categoria_display', read_only=True)
@@ -155,27 +210,27 @@ class CulturalReportSerializer(serializers.ModelSerializer):
             'admin_notes', 'created_cultural_item'
         ]
         read_only_fields = [
-            'id', 'status', 'created_at', 'updated_at', 'imagen',
+            'id', 'status', 'created_at', 'updated_at',
             'reviewed_by_email', 'reviewed_at', 'admin_notes',
             'created_cultural_item'
         ]
+        # escribible solo como archivo (multipart); en JSON se usa imagen_base64
+        extra_kwargs = {'imagen': {'required': False, 'allow_null': True}}
     
+    def validate_imagen(self, value):
+        """Archivo subido (multipart): mismo límite de tamaño que en el análisis"""
+        return validate_uploaded_image(value) if value else value
+
     def validate_imagen_base64(self, value):
-        """Validar que el campo imagen_base64 sea base64 válido si se proporciona"""
+        """Validar que el campo imagen_base64 sea base64 válido si se proporciona (queda decodificado)"""
         if value and value.strip():
-            try:
-                if ';base64,' in value:
-                    format_part, imgstr = value.split(';base64,')
-                    base64.b64decode(imgstr)
-                else:
-                    base64.b64decode(value)
-            except Exception as e:
-                raise serializers.ValidationError(f"Formato de imagen base64 inválido: {str(e)}")
-        return value
+            return validate_source_image(value)
+        return None
     
     def create(self, validated_data):
-        # Extraer imagen_base64 antes de crear el objeto
+        # Extraer imagen_base64 (o el archivo subido) antes de crear el objeto
         imagen_base64 = validated_data.pop('imagen_base64', None)
+        imagen = validated_data.pop('imagen', None)
         
         # Establecer el usuario que reporta
         request = self.context.get('request')
@@ -185,24 +240,11 @@ class CulturalReportSerializer(serializers.ModelSerializer):
         # Crear el reporte
         report = super().create(validated_data)
         
-        # Si hay imagen base64, convertirla y guardarla
-        if imagen_base64 and imagen_base64.strip():
-            try:
-                if ';base64,' in imagen_base64:
-                    format_part, imgstr = imagen_base64.split(';base64,')
-                    ext = format_part.split('/')[-1] if '/' in format_part else 'jpg'
-                else:
-                    imgstr = imagen_base64
-                    ext = 'jpg'
-                
-                data = ContentFile(
-                    base64.b64decode(imgstr), 
-                    name=f'report_{report.id}.{ext}'
-                )
-                report.imagen = data
-                report.save()
-            except Exception as e:
-                print(f"Error procesando imagen base64 del reporte: {e}")
+        if imagen:
+            save_uploaded_image(report, imagen, 'report')
+        # Si hay imagen base64 (ya decodificada al validar), guardarla
+        elif imagen_base64:
+            save_source_image(report, imagen_base64, 'report')
         
         return report
 
@@ -235,4 +277,14 @@ class ApproveReportSerializer(serializers.Serializer):
             raise serializers.ValidationError({
                 'admin_notes': 'Las notas del administrador son requeridas al rechazar un reporte.'
             })
-        return data
\ No newline at end of file
+        return data
+
+
+class AnalysisJobSerializer(serializers.ModelSerializer):
+    """Estado de un trabajo de análisis (sin la imagen)"""
+    job_id = serializers.UUIDField(source='id', read_only=True)
+    status_display = serializers.CharField(source='get_status_display', read_only=True)
+
+    class Meta:
+        model = AnalysisJob
+        fields = ['job_id', 'status', 'status_display', 'created_at', 'started_at', 'finished_at', 'expires_at']
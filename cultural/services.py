@@ -1,102 +1,654 @@
-import json, hashlib, logging
-from typing import Dict, Optional
+import asyncio, copy, json, hashlib, logging, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 from django.conf import settings
-from django.core.cache import cache
 
-from .analysis.constants import PROMPT_VERSION, MIN_CONFIDENCE_THRESHOLD
-from .analysis.prompt import build_analysis_prompt
-from .analysis.parsing import parse_response
-from .analysis.validation import validate_with_local_knowledge
-from .analysis.openai_client import call_openai_api, OpenAIClientError
+from .analysis.constants import PROMPT_VERSION, MIN_CONFIDENCE_THRESHOLD, SYSTEM_MESSAGE
+from .analysis.prompt import build_analysis_prompt, count_prompt_tokens
+from .analysis.parsing import IncrementalJSONParser, normalize_category, parse_response, parse_structured
+from .analysis.validation import validate_with_local_knowledge, METODO_TITULO
+from .analysis.openai_client import (
+    call_openai_api, acall_openai_api, stream_openai_api, max_call_seconds, OpenAIClientError,
+    UpstreamUnavailableError,
+)
+from .analysis.resilience import AdaptiveLimiter, CircuitBreaker, UpstreamGuard
+from .analysis.images import as_source_image, prepare_image, ImagePreparationError, PreparedImage, SourceImage
+from .analysis.phash import HammingIndex
+from .analysis.pricing import add_usage, estimate_cost, usage_tokens
+from .analysis.routing import ROUTING_MAX_TOKENS, ROUTING_PROMPT, parse_routing_response, routed_categories
+from .analysis.schema import get_structured_output
+from .analysis.tokens import get_token_counter
+from .cache import SHARED_TIER, AnalysisKey, get_analysis_cache
+from .coalescing import COALESCED, REMOTE, get_analysis_flights
+from .metrics import (
+    ANALYSIS_CACHE_HITS, ANALYSIS_ERRORS, ANALYSIS_LOW_CONFIDENCE, ANALYSIS_PARSE_FAILURES, ANALYSIS_PARSE_PATH,
+    ANALYSIS_PROMPT_CACHE_RATIO, ANALYSIS_PROMPT_TOKENS_ERROR, ANALYSIS_ROUTING, ANALYSIS_STAGE_SECONDS,
+    ANALYSIS_TOKENS, ANALYSIS_UPSTREAM_CALLS, ANALYSIS_UPSTREAM_SECONDS,
+)
+from .models import CulturalCategory
+from .records import record_analysis
 
 logger = logging.getLogger(__name__)
 
-class OpenAIAnalysisError(Exception): pass
+ImageInput = Union[str, SourceImage]  # base64 o la imagen ya decodificada por el serializer
+
+
+class OpenAIAnalysisError(Exception):
+    """`code`/`retry_after` solo cuando no se llamó a OpenAI (circuito abierto o saturado)."""
+
+    def __init__(self, message: str = '', code: Optional[str] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.code = code
+        self.retry_after = retry_after
+
+
+def _ms_since(t0: float) -> float:
+    return round((time.perf_counter() - t0) * 1000, 1)
+
+# hash perceptual -> clave de caché del análisis (por proceso)
+_near_duplicates = HammingIndex(max_entries=getattr(settings, 'ANALYSIS_NEAR_DUPLICATE_MAX_ENTRIES', 10000))
+
+# circuito (uno por proceso) + límite adaptativo de llamadas a OpenAI en vuelo. Hilos (vistas
+# sync, lotes, trabajos) y corrutinas (vista async) tienen límites separados: cada uno arranca
+# en el tamaño de su pool, así la vista async no queda acotada por el de la sync.
+_upstream_breaker = CircuitBreaker(
+    failure_rate=getattr(settings, 'OPENAI_CIRCUIT_FAILURE_RATE', 0.5),
+    slow_call_seconds=getattr(settings, 'OPENAI_CIRCUIT_SLOW_CALL_SECONDS', 20),
+    open_seconds=getattr(settings, 'OPENAI_CIRCUIT_OPEN_SECONDS', 30),
+)
+
+
+def _limiter(initial: int) -> AdaptiveLimiter:
+    return AdaptiveLimiter(
+        initial=initial,
+        max_limit=max(initial, getattr(settings, 'OPENAI_MAX_IN_FLIGHT', 200)),
+        latency_target=getattr(settings, 'OPENAI_LATENCY_TARGET_SECONDS', 15),
+        queue_timeout=getattr(settings, 'OPENAI_QUEUE_TIMEOUT', 5),
+    )
+
+
+_upstream_guard = UpstreamGuard(_upstream_breaker, _limiter(getattr(settings, 'OPENAI_POOL_SIZE', 10)))
+_async_upstream_guard = UpstreamGuard(_upstream_breaker, _limiter(getattr(settings, 'OPENAI_ASYNC_POOL_SIZE', 200)))
+
+
+def get_upstream_stats() -> Dict:
+    return {**_upstream_guard.stats(), 'async_concurrency': _async_upstream_guard.limiter.stats()}
+
+
+def get_token_stats() -> Dict:
+    """Conteo local de tokens de entrada: exacto (tiktoken) o estimado, y su error frente al usage real."""
+    return get_token_counter(CulturalAnalysisService.MODEL).stats()
+
+
+def _observe_timings(timings: Dict) -> None:
+    """Etapas de `timings` (ms) en analysis_stage_duration_seconds."""
+    for stage in ('prepare', 'postprocess', 'total'):
+        if f'{stage}_ms' in timings:
+            ANALYSIS_STAGE_SECONDS.observe(timings[f'{stage}_ms'] / 1000, stage=stage)
+    for stage in ('routing', 'upstream'):
+        upstream_ms = timings.get(stage, {}).get('total_ms')
+        if upstream_ms is not None:
+            ANALYSIS_STAGE_SECONDS.observe(upstream_ms / 1000, stage=stage)
+
+
+def _observe_prompt_cache(usage: Optional[Dict], timings: Dict) -> None:
+    """Tokens de la llamada principal servidos desde la caché de prefijos y su latencia con y sin ella."""
+    tokens = usage_tokens(usage)
+    if not tokens['prompt_tokens']:
+        return
+    ANALYSIS_PROMPT_CACHE_RATIO.observe(tokens['cached_tokens'] / tokens['prompt_tokens'])
+    upstream_ms = timings.get('upstream', {}).get('total_ms')
+    if upstream_ms is not None:
+        ANALYSIS_UPSTREAM_SECONDS.observe(upstream_ms / 1000, prompt_cache='hit' if tokens['cached_tokens'] else 'miss')
+
 
 class CulturalAnalysisService:
-    API_URL = "https://api.openai.com/v1/chat/completions"
+    API_URL = getattr(settings, 'OPENAI_API_URL', "https://api.openai.com/v1/chat/completions")
     MODEL = getattr(settings, 'OPENAI_MODEL', 'gpt-4o')
     MAX_TOKENS = getattr(settings, 'OPENAI_MAX_TOKENS', 1000)
     # ! tiempo para llamadas a OpenAI(Aunmentar según necesidad)
     TIMEOUT = getattr(settings, 'OPENAI_TIMEOUT', 60)
+    # conexiones keep-alive por proceso y reintentos ante 429/5xx
+    POOL_SIZE = getattr(settings, 'OPENAI_POOL_SIZE', 10)
+    MAX_RETRIES = getattr(settings, 'OPENAI_MAX_RETRIES', 2)
+    # la vista async mantiene muchas llamadas en vuelo por proceso
+    ASYNC_POOL_SIZE = getattr(settings, 'OPENAI_ASYNC_POOL_SIZE', 200)
     MIN_CONFIDENCE_THRESHOLD = getattr(settings, 'MIN_CONFIDENCE_THRESHOLD', MIN_CONFIDENCE_THRESHOLD)
+    # preparación de la imagen antes de enviarla (orientación EXIF, tamaño, recompresión)
+    IMAGE_MAX_SIDE = getattr(settings, 'ANALYSIS_IMAGE_MAX_SIDE', 1024)
+    IMAGE_FORMAT = getattr(settings, 'ANALYSIS_IMAGE_FORMAT', 'JPEG')
+    IMAGE_QUALITY = getattr(settings, 'ANALYSIS_IMAGE_QUALITY', 85)
+    IMAGE_LOW_DETAIL_MAX_SIDE = getattr(settings, 'ANALYSIS_IMAGE_LOW_DETAIL_MAX_SIDE', 512)
+    # bits de diferencia (de 64) para reutilizar el análisis de una foto casi igual; -1 lo desactiva
+    NEAR_DUPLICATE_DISTANCE = getattr(settings, 'ANALYSIS_NEAR_DUPLICATE_DISTANCE', 8)
+    # análisis simultáneos de un mismo lote (/analyze/batch); no debería superar POOL_SIZE
+    BATCH_CONCURRENCY = getattr(settings, 'ANALYSIS_BATCH_CONCURRENCY', 8)
+    # 'base_conocimiento_local_v2' (título), 'tfidf_ngramas_v1' o 'embeddings_locales_v1'
+    LOCAL_VALIDATION_METHOD = getattr(settings, 'LOCAL_VALIDATION_METHOD', METODO_TITULO)
+    # dos etapas: primero solo la categoría (detail=low) y luego el análisis con los
+    # ejemplos de esa categoría y sus vecinas (ver analysis.routing)
+    TWO_STAGE = getattr(settings, 'ANALYSIS_TWO_STAGE', False)
+    # tokens (mensaje de sistema + prompt) para elegir los ejemplos few-shot; 0 = número fijo
+    PROMPT_TOKEN_BUDGET = getattr(settings, 'ANALYSIS_PROMPT_TOKEN_BUDGET', 0)
+    # response_format con el JSON schema del análisis (analysis.schema); requiere un modelo que lo soporte
+    STRUCTURED_OUTPUT = getattr(settings, 'ANALYSIS_STRUCTURED_OUTPUT', False)
+
+    @classmethod
+    def upstream_budget(cls) -> float:
+        """
+        Segundos que puede tardar en el peor caso un análisis sin caché: cada llamada
+        (clasificación previa y principal) con la espera por un cupo, todos sus
+        reintentos y las pausas entre ellos. De aquí sale cuánto esperan las
+        peticiones agrupadas (coalescing) a la líder.
+        """
+        calls = 2 if cls.TWO_STAGE else 1
+        queue_timeout = getattr(settings, 'OPENAI_QUEUE_TIMEOUT', 5)
+        return calls * (queue_timeout + max_call_seconds(cls.TIMEOUT, cls.MAX_RETRIES))
 
     def __init__(self):
         self.api_key = settings.OPENAI_API_KEY
         if not self.api_key or self.api_key == 'your_api_key_here':
             raise ValueError("OPENAI_API_KEY no está configurada")
 
-    def analyze_image(self, image_base64: str, use_cache: bool = True) -> Dict:
+    def analyze_image(self, image: ImageInput, use_cache: bool = True) -> Dict:
+        """`image`: SourceImage del serializer (ya decodificada) o base64."""
+        t_start = time.perf_counter()
+        source = self._source_image(image, t_start)
+        key = self._cache_key(source)
+        if not use_cache:
+            return self._analyze_uncached(source, key, use_cache, t_start)
+
+        cached = self._get_cached_analysis(key)
+        if cached:
+            logger.info("Análisis desde caché")
+            return cached
+        # peticiones simultáneas de la misma imagen: una sola llamada a OpenAI
+        analysis, how = get_analysis_flights().do(
+            key,
+            lambda: self._analyze_uncached(source, key, use_cache, t_start),
+            lambda: self._get_cached_analysis(key),
+            lambda: get_analysis_cache().peek(key, SHARED_TIER),
+        )
+        return self._flight_result(analysis, how)
+
+    def _analyze_uncached(self, source: SourceImage, key: AnalysisKey, use_cache: bool, t_start: float) -> Dict:
+        timings = {}
         try:
-            # caché
+            t0 = time.perf_counter()
+            image = self._prepare_image(source)
+            timings['prepare_ms'] = _ms_since(t0)
             if use_cache:
-                cached = self._get_cached_analysis(image_base64)
-                if cached:
-                    logger.info("Análisis desde caché")
-                    return cached
-
-            prompt = build_analysis_prompt()
-            raw = call_openai_api(
-                api_url=self.API_URL,
-                api_key=self.api_key,
-                model=self.MODEL,
-                max_tokens=self.MAX_TOKENS,
-                timeout=self.TIMEOUT,
-                prompt=prompt,
-                image_base64=image_base64,
-            )
+                near = self._get_near_duplicate(image)
+                if near:
+                    logger.info("Análisis desde caché (casi duplicado)")
+                    return near
 
-            analysis = parse_response(raw)
-            analysis = validate_with_local_knowledge(analysis)
+            routing = self._route(image, timings)
+            timings['upstream'] = {}
+            raw = call_openai_api(**self._upstream_kwargs(image, timings['upstream'], routing=routing))
+            analysis = self._finalize_analysis(raw, key, timings, image, t_start, routing)
 
-            if analysis.get('confianza', 0.0) < self.MIN_CONFIDENCE_THRESHOLD:
-                raise OpenAIAnalysisError(
-                    f"Confianza insuficiente ({analysis['confianza']:.2f}). " +
-                    analysis.get('descripcion', 'No se pudo identificar como elemento cultural de Huánuco')
-                )
+            if use_cache:
+                self._cache_analysis(key, analysis, image)
 
-            analysis['metadata'] = {
-                'model': self.MODEL,
-                'prompt_version': PROMPT_VERSION,
-                'tokens_used': raw.get('usage', {}).get('total_tokens', 0),
-                'cached': False
-            }
+            logger.info(f"Análisis OK: {analysis['titulo']} (confianza: {analysis['confianza']:.2f})")
+            return analysis
+
+        except Exception as e:
+            raise self._analysis_error(e, key, timings, t_start)
+
+    async def aanalyze_image(self, image: ImageInput, use_cache: bool = True) -> Dict:
+        """Igual que analyze_image, pero sin bloquear un hilo durante la llamada a OpenAI."""
+        t_start = time.perf_counter()
+        source = self._source_image(image, t_start)
+        key = self._cache_key(source)
+        if not use_cache:
+            return await self._aanalyze_uncached(source, key, use_cache, t_start)
+
+        cached = await self._aget_cached_analysis(key)
+        if cached:
+            logger.info("Análisis desde caché")
+            return cached
+        analysis, how = await get_analysis_flights().ado(
+            key,
+            lambda: self._aanalyze_uncached(source, key, use_cache, t_start),
+            lambda: self._aget_cached_analysis(key),
+            lambda: get_analysis_cache().apeek(key, SHARED_TIER),
+        )
+        return self._flight_result(analysis, how)
+
+    async def _aanalyze_uncached(self, source: SourceImage, key: AnalysisKey, use_cache: bool,
+                                 t_start: float) -> Dict:
+        timings = {}
+        try:
+            # Pillow trabaja fuera del event loop
+            t0 = time.perf_counter()
+            image = await asyncio.to_thread(self._prepare_image, source)
+            timings['prepare_ms'] = _ms_since(t0)
+            if use_cache:
+                near = await self._aget_near_duplicate(image)
+                if near:
+                    logger.info("Análisis desde caché (casi duplicado)")
+                    return near
+
+            routing = await self._aroute(image, timings)
+            timings['upstream'] = {}
+            raw = await acall_openai_api(**self._upstream_kwargs(image, timings['upstream'], routing=routing,
+                                                                 asynchronous=True))
+            # parseo, validación local (embeddings) y conteo de tokens: fuera del event loop
+            analysis = await asyncio.to_thread(self._finalize_analysis, raw, key, timings, image, t_start, routing)
 
             if use_cache:
-                self._cache_analysis(image_base64, analysis)
+                await self._acache_analysis(key, analysis, image)
 
             logger.info(f"Análisis OK: {analysis['titulo']} (confianza: {analysis['confianza']:.2f})")
             return analysis
 
-        except OpenAIClientError as e:
-            logger.error(f"Error OpenAI: {e}")
-            raise OpenAIAnalysisError(str(e))
         except Exception as e:
-            logger.error(f"Error inesperado: {e}", exc_info=True)
-            raise OpenAIAnalysisError(f"Error al procesar la imagen: {str(e)}")
+            raise self._analysis_error(e, key, timings, t_start)
 
-    # === caché (igual que ya tenías) ===
-    def _get_cached_analysis(self, image_base64: str) -> Optional[Dict]:
+    def stream_analysis(self, image: ImageInput, use_cache: bool = True) -> Iterator[Tuple[str, object]]:
+        """
+        Análisis con la respuesta de OpenAI en streaming. Produce ('field', {'name', 'value'})
+        por cada campo del JSON en cuanto se completa (titulo y categoria primero, por el orden
+        del prompt) y al final ('result', análisis validado) o ('error', OpenAIAnalysisError).
+        No se agrupa con peticiones simultáneas: cada stream hace su propia llamada.
+        """
+        t_start = time.perf_counter()
+        key, timings = None, {}
         try:
-            h = hashlib.md5(image_base64.encode()).hexdigest()
-            key = f'cultural_analysis:{h}'
-            cached = cache.get(key)
+            source = as_source_image(image)
+            key = self._cache_key(source)
+            cached = self._get_cached_analysis(key) if use_cache else None
+            if not cached:
+                t0 = time.perf_counter()
+                image = self._prepare_image(source)
+                timings['prepare_ms'] = _ms_since(t0)
+                cached = self._get_near_duplicate(image) if use_cache else None
             if cached:
-                cached['metadata']['cached'] = True
-            return cached
+                for name, value in cached.items():
+                    if name != 'metadata':
+                        yield 'field', {'name': name, 'value': value}
+                yield 'result', cached
+                return
+
+            routing = self._route(image, timings)
+            timings['upstream'], usage = {}, {}
+            parser = IncrementalJSONParser()
+            for text in stream_openai_api(**self._upstream_kwargs(image, timings['upstream'], routing=routing),
+                                          usage=usage):
+                for name, value in parser.feed(text):
+                    timings.setdefault('first_field_ms', _ms_since(t_start))
+                    if name == 'categoria' and isinstance(value, str):
+                        value = normalize_category(value)
+                    yield 'field', {'name': name, 'value': value}
+
+            raw = {'choices': [{'message': {'content': parser.text}}], 'usage': usage}
+            analysis = self._finalize_analysis(raw, key, timings, image, t_start, routing)
+            if use_cache:
+                self._cache_analysis(key, analysis, image)
+            logger.info(f"Análisis (stream) OK: {analysis['titulo']} (confianza: {analysis['confianza']:.2f})")
+            yield 'result', analysis
+
         except Exception as e:
-            logger.warning(f"Error obteniendo caché: {str(e)}")
+            yield 'error', self._analysis_error(e, key, timings, t_start)
+
+    def _source_image(self, image: ImageInput, t_start: float) -> SourceImage:
+        try:
+            return as_source_image(image)
+        except ImagePreparationError as e:
+            raise self._analysis_error(e, None, {}, t_start)
+
+    def _analysis_error(self, e: Exception, key: Optional[AnalysisKey], timings: Dict, t_start: float) -> OpenAIAnalysisError:
+        """Traduce cualquier fallo a OpenAIAnalysisError (y lo registra si no se registró antes)."""
+        if isinstance(e, OpenAIAnalysisError):
+            return e
+        if isinstance(e, ImagePreparationError):
+            logger.warning(f"Imagen rechazada: {e}")
+            ANALYSIS_ERRORS.inc(reason='image')
+            return OpenAIAnalysisError(str(e))
+        if isinstance(e, UpstreamUnavailableError):
+            logger.warning(f"OpenAI no disponible: {e}")  # no hubo llamada: no se registra
+            ANALYSIS_ERRORS.inc(reason=e.code)
+            return OpenAIAnalysisError(str(e), code=e.code, retry_after=e.retry_after)
+        if isinstance(e, OpenAIClientError):
+            logger.error(f"Error OpenAI: {e}")
+            ANALYSIS_ERRORS.inc(reason='upstream')
+            self._record_failure(key, str(e), timings, t_start)
+            return OpenAIAnalysisError(str(e))
+        logger.error(f"Error inesperado: {e}", exc_info=e)
+        ANALYSIS_ERRORS.inc(reason='unexpected')
+        self._record_failure(key, str(e), timings, t_start)
+        return OpenAIAnalysisError(f"Error al procesar la imagen: {str(e)}")
+
+    def _flight_result(self, analysis: Dict, how: str) -> Dict:
+        if how == REMOTE:
+            # la líder de otro worker lo dejó en la caché compartida (valor recién decodificado)
+            logger.info("Análisis compartido con una petición simultánea de otro worker")
+            return self._cache_hit(analysis, SHARED_TIER, COALESCED)
+        if how != COALESCED:
+            return analysis
+        logger.info("Análisis compartido con una petición simultánea")
+        # la líder devuelve el mismo dict a su cliente: copia propia
+        return self._cache_hit(copy.deepcopy(analysis), None, COALESCED)
+
+    def prepare_image(self, image: ImageInput) -> PreparedImage:
+        """La imagen tal como se enviaría a OpenAI (p. ej. para guardarla en un trabajo)."""
+        return self._prepare_image(as_source_image(image))
+
+    def _prepare_image(self, source: SourceImage) -> PreparedImage:
+        return prepare_image(
+            source,
+            max_side=self.IMAGE_MAX_SIDE,
+            fmt=self.IMAGE_FORMAT,
+            quality=self.IMAGE_QUALITY,
+            low_detail_max_side=self.IMAGE_LOW_DETAIL_MAX_SIDE,
+        )
+
+    def _upstream_kwargs(self, image: PreparedImage, timing: Dict, asynchronous: bool = False,
+                         routing: Optional[Dict] = None) -> Dict:
+        ANALYSIS_UPSTREAM_CALLS.inc(stage='upstream')
+        return dict(
+            api_url=self.API_URL,
+            api_key=self.api_key,
+            model=self.MODEL,
+            max_tokens=self.MAX_TOKENS,
+            timeout=self.TIMEOUT,
+            prompt=self._prompt(routing['categorias'] if routing else None),
+            image_base64=image.base64,
+            image_mime=image.mime,
+            image_detail=image.detail,
+            max_retries=self.MAX_RETRIES,
+            pool_size=self.ASYNC_POOL_SIZE if asynchronous else self.POOL_SIZE,
+            timing=timing,
+            guard=_async_upstream_guard if asynchronous else _upstream_guard,
+            response_format=self._structured_output()[0] if self.STRUCTURED_OUTPUT else None,
+        )
+
+    @staticmethod
+    def _structured_output():
+        return get_structured_output(tuple(CulturalCategory.values))
+
+    def _parse(self, raw: Dict) -> Dict:
+        """Con salida estructurada, validador precompilado; si el modelo no respetó el schema, parser tolerante."""
+        if self.STRUCTURED_OUTPUT:
+            try:
+                analysis = parse_structured(raw, self._structured_output()[1])
+                ANALYSIS_PARSE_PATH.inc(path='strict')
+                return analysis
+            except ValueError as e:
+                logger.warning(f"Respuesta fuera del schema, se usa el parser tolerante: {e}")
+        try:
+            analysis = parse_response(raw)
+        except ValueError:
+            ANALYSIS_PARSE_FAILURES.inc()
+            raise
+        ANALYSIS_PARSE_PATH.inc(path='fallback' if self.STRUCTURED_OUTPUT else 'tolerant')
+        return analysis
+
+    def _prompt(self, categorias: Optional[Tuple[str, ...]] = None) -> str:
+        return build_analysis_prompt(categorias=categorias, token_budget=self.PROMPT_TOKEN_BUDGET or None,
+                                     model=self.MODEL)
+
+    def _prompt_tokens(self, categorias: Optional[Tuple[str, ...]] = None) -> int:
+        """Tokens de sistema + prompt, contados una vez por prompt compilado."""
+        return count_prompt_tokens(categorias=categorias, token_budget=self.PROMPT_TOKEN_BUDGET or None,
+                                   model=self.MODEL)
+
+    def _predict_prompt_tokens(self, raw: Dict, image: PreparedImage, routing: Optional[Dict]) -> Dict:
+        """usage.prompt_tokens predicho localmente frente al real de la llamada principal (y calibración)."""
+        counter = get_token_counter(self.MODEL)
+        categorias = routing['categorias'] if routing else None
+        texts = (SYSTEM_MESSAGE, self._prompt(categorias))
+        text_tokens = self._prompt_tokens(categorias)
+        predicted = counter.predict_prompt_tokens(texts, image.sent_tokens, text_tokens)
+        actual = usage_tokens(raw.get('usage'))['prompt_tokens']
+        if actual:
+            ANALYSIS_PROMPT_TOKENS_ERROR.observe((predicted - actual) / actual)
+            counter.calibrate(texts, image.sent_tokens, actual, text_tokens)
+        return {'predicted': predicted, 'actual': actual}
+
+    # === modo en dos etapas (ver analysis.routing) ===
+
+    def _routing_kwargs(self, image: PreparedImage, timing: Dict, asynchronous: bool = False) -> Dict:
+        ANALYSIS_UPSTREAM_CALLS.inc(stage='routing')
+        return dict(
+            api_url=self.API_URL,
+            api_key=self.api_key,
+            model=self.MODEL,
+            max_tokens=ROUTING_MAX_TOKENS,
+            timeout=self.TIMEOUT,
+            prompt=ROUTING_PROMPT,
+            image_base64=image.base64,
+            image_mime=image.mime,
+            image_detail='low',  # la categoría no necesita detalle: tokens de imagen fijos y mínimos
+            max_retries=self.MAX_RETRIES,
+            pool_size=self.ASYNC_POOL_SIZE if asynchronous else self.POOL_SIZE,
+            timing=timing,
+            guard=_async_upstream_guard if asynchronous else _upstream_guard,
+        )
+
+    def _route(self, image: PreparedImage, timings: Dict) -> Optional[Dict]:
+        """Primera etapa: categoría de la imagen. None si el modo está desactivado."""
+        if not self.TWO_STAGE:
             return None
+        timings['routing'] = {}
+        try:
+            raw = call_openai_api(**self._routing_kwargs(image, timings['routing']))
+        except UpstreamUnavailableError:
+            raise
+        except OpenAIClientError as e:
+            raw = None
+            logger.warning(f"Falló la clasificación previa; se usan todos los ejemplos: {e}")
+        return self._routing_result(raw)
 
-    def _cache_analysis(self, image_base64: str, analysis: Dict) -> None:
+    async def _aroute(self, image: PreparedImage, timings: Dict) -> Optional[Dict]:
+        if not self.TWO_STAGE:
+            return None
+        timings['routing'] = {}
         try:
-            h = hashlib.md5(image_base64.encode()).hexdigest()
-            key = f'cultural_analysis:{h}'
-            cache.set(key, analysis, timeout=86400)
-        except Exception as e:
-            logger.warning(f"Error guardando en caché: {str(e)}")
+            raw = await acall_openai_api(**self._routing_kwargs(image, timings['routing'], asynchronous=True))
+        except UpstreamUnavailableError:
+            raise
+        except OpenAIClientError as e:
+            raw = None
+            logger.warning(f"Falló la clasificación previa; se usan todos los ejemplos: {e}")
+        return self._routing_result(raw)
+
+    @staticmethod
+    def _routing_result(raw: Optional[Dict]) -> Dict:
+        categoria = parse_routing_response(raw) if raw else None
+        categorias = routed_categories(categoria)
+        ANALYSIS_ROUTING.inc(categoria=categoria if categorias else 'todas')
+        return {'categoria': categoria, 'categorias': categorias, 'usage': (raw or {}).get('usage') or {}}
+
+    def _routing_metadata(self, routing: Dict, timings: Dict) -> Dict:
+        """Categoría elegida, costo de la primera etapa y tokens de prompt ahorrados (estimados)."""
+        usage = usage_tokens(routing['usage'])
+        saved = 0
+        if routing['categorias']:
+            saved = self._prompt_tokens() - self._prompt_tokens(routing['categorias'])
+        return {
+            'categoria': routing['categoria'],
+            'categorias': list(routing['categorias'] or []),
+            'usage': usage,
+            'upstream': timings.get('routing', {}),
+            'prompt_tokens_saved_est': saved - usage['prompt_tokens'],
+        }
+
+    def _finalize_analysis(self, raw: Dict, key: AnalysisKey, timings: Dict, image: PreparedImage,
+                           t_start: float, routing: Optional[Dict] = None) -> Dict:
+        """Parseo, validación local, umbral de confianza, metadata y registro (común a sync/async)."""
+        t0 = time.perf_counter()
+        prompt_tokens = self._predict_prompt_tokens(raw, image, routing)
+        _observe_prompt_cache(raw.get('usage'), timings)
+        usage = raw.get('usage') or {}
+        if routing is not None:
+            usage = add_usage(routing['usage'], usage)  # costo de las dos etapas
+        for kind, n in usage_tokens(usage).items():
+            if kind != 'total_tokens':
+                ANALYSIS_TOKENS.inc(n, type=kind.replace('_tokens', ''))
+        analysis = self._parse(raw)
+        analysis = validate_with_local_knowledge(analysis, metodo=self.LOCAL_VALIDATION_METHOD)
+        timings['postprocess_ms'] = _ms_since(t0)
+        timings['total_ms'] = _ms_since(t_start)
+        _observe_timings(timings)
+
+        if analysis.get('confianza', 0.0) < self.MIN_CONFIDENCE_THRESHOLD:
+            ANALYSIS_LOW_CONFIDENCE.inc()
+            message = (
+                f"Confianza insuficiente ({analysis['confianza']:.2f}). " +
+                analysis.get('descripcion', 'No se pudo identificar como elemento cultural de Huánuco')
+            )
+            record_analysis(key, error=message, usage=usage, timings=timings,
+                            prompt_tokens_predicted=prompt_tokens['predicted'])
+            raise OpenAIAnalysisError(message)
+
+        analysis['metadata'] = {
+            'model': self.MODEL,
+            'prompt_version': self._prompt_version(),
+            'tokens_used': usage.get('total_tokens', 0),
+            'usage': usage_tokens(usage),
+            'prompt_tokens': prompt_tokens,  # de la llamada principal: predicción local y real
+            'cost_usd': estimate_cost(self.MODEL, usage),
+            'cached': False,
+            'cache_hit': None,  # 'exact', 'near_duplicate' o 'coalesced' (petición simultánea)
+            'cache_tier': None,  # 'local', 'shared' o 'db'
+            'upstream': timings.get('upstream', {}),
+            'timings': {k: v for k, v in timings.items() if k not in ('upstream', 'routing')},
+            'image': image.metrics(),
+        }
+        if routing is not None:
+            analysis['metadata']['routing'] = self._routing_metadata(routing, timings)
+        record_analysis(key, result=analysis, usage=usage, timings=timings,
+                        prompt_tokens_predicted=prompt_tokens['predicted'])
+        return analysis
+
+    @staticmethod
+    def _record_failure(key: AnalysisKey, error: str, timings: Dict, t_start: float) -> None:
+        timings['total_ms'] = _ms_since(t_start)
+        if 'postprocess_ms' not in timings:  # si no, ya se midió en _finalize_analysis
+            _observe_timings(timings)
+        record_analysis(key, error=error, timings=timings)
+
+    # === caché (ver cultural/cache.py) ===
+    CACHE_FORMAT = 2  # cambiarlo invalida todas las entradas guardadas
+
+    def _cache_key(self, source: SourceImage) -> AnalysisKey:
+        """Contenido de la imagen (sha256 del SourceImage) + todo lo que cambia el resultado (modelo, prompt, validación)."""
+        return AnalysisKey(self.CACHE_FORMAT, self.MODEL, self._prompt_version(),
+                           self.LOCAL_VALIDATION_METHOD, source.content_hash)
+
+    def _prompt_version(self) -> str:
+        # dos etapas, presupuesto de tokens y salida estructurada cambian la llamada: no comparten resultados
+        version = f'{PROMPT_VERSION}+ruta' if self.TWO_STAGE else PROMPT_VERSION
+        if self.PROMPT_TOKEN_BUDGET:
+            version += f'+t{self.PROMPT_TOKEN_BUDGET}'
+        return f'{version}+js' if self.STRUCTURED_OUTPUT else version
+
+    @staticmethod
+    def _cache_hit(cached: Dict, tier: Optional[str], kind: str, **extra) -> Dict:
+        ANALYSIS_CACHE_HITS.inc(kind=kind, tier=tier or 'none')
+        return {**cached, 'metadata': {
+            **cached.get('metadata', {}), 'cached': True, 'cache_hit': kind, 'cache_tier': tier, **extra,
+        }}
+
+    def _get_cached_analysis(self, key: AnalysisKey) -> Optional[Dict]:
+        cached, tier = get_analysis_cache().get(key)
+        return self._cache_hit(cached, tier, 'exact') if cached else None
+
+    def _cache_analysis(self, key: AnalysisKey, analysis: Dict, image: Optional[PreparedImage] = None) -> None:
+        get_analysis_cache().set(key, analysis)
+        if image is not None:
+            _near_duplicates.add(image.phash, key)
+
+    def _find_near_duplicate(self, image: PreparedImage):
+        if self.NEAR_DUPLICATE_DISTANCE < 0:
+            return None
+        return _near_duplicates.nearest(image.phash, self.NEAR_DUPLICATE_DISTANCE)
+
+    def _near_duplicate_result(self, found, cached: Optional[Dict], tier: Optional[str]) -> Optional[Dict]:
+        phash, _, distance = found
+        if not cached:
+            _near_duplicates.remove(phash)  # expiró en la caché
+            return None
+        return self._cache_hit(cached, tier, 'near_duplicate', hamming_distance=distance)
+
+    def _get_near_duplicate(self, image: PreparedImage) -> Optional[Dict]:
+        """Análisis en caché de una foto perceptualmente igual (recomprimida, reescalada, recortada)."""
+        found = self._find_near_duplicate(image)
+        return self._near_duplicate_result(found, *get_analysis_cache().get(found[1])) if found else None
+
+    async def _aget_cached_analysis(self, key: AnalysisKey) -> Optional[Dict]:
+        cached, tier = await get_analysis_cache().aget(key)
+        return self._cache_hit(cached, tier, 'exact') if cached else None
+
+    async def _acache_analysis(self, key: AnalysisKey, analysis: Dict, image: Optional[PreparedImage] = None) -> None:
+        await get_analysis_cache().aset(key, analysis)
+        if image is not None:
+            _near_duplicates.add(image.phash, key)
+
+    async def _aget_near_duplicate(self, image: PreparedImage) -> Optional[Dict]:
+        found = self._find_near_duplicate(image)
+        return self._near_duplicate_result(found, *(await get_analysis_cache().aget(found[1]))) if found else None
 
 # Helper público (no cambia)
-def analyze_cultural_image(image_base64: str, use_cache: bool = True) -> Dict:
+def analyze_cultural_image(image: ImageInput, use_cache: bool = True) -> Dict:
+    service = CulturalAnalysisService()
+    return service.analyze_image(image, use_cache=use_cache)
+
+
+async def aanalyze_cultural_image(image: ImageInput, use_cache: bool = True) -> Dict:
+    service = CulturalAnalysisService()
+    return await service.aanalyze_image(image, use_cache=use_cache)
+
+
+def stream_cultural_analysis(image: ImageInput, use_cache: bool = True) -> Iterator[Tuple[str, object]]:
     service = CulturalAnalysisService()
-    return service.analyze_image(image_base64, use_cache=use_cache)
+    return service.stream_analysis(image, use_cache=use_cache)
+
+
+def image_content_hash(image: ImageInput) -> str:
+    """sha256 de los bytes de la imagen (ignora el prefijo data:...;base64, y saltos de línea)."""
+    try:
+        return as_source_image(image).content_hash
+    except ImagePreparationError:
+        return hashlib.sha256(image.encode()).hexdigest()
+
+
+def iter_batch_analysis(
+    images: List[ImageInput],
+    max_concurrency: Optional[int] = None,
+    use_cache: bool = True,
+) -> Iterator[Tuple[str, Optional[Dict], Optional[OpenAIAnalysisError]]]:
+    """
+    Analiza un lote con como máximo `max_concurrency` llamadas a OpenAI a la vez.
+    Las imágenes con el mismo contenido se analizan una sola vez. Los análisis
+    arrancan al llamar a la función; el iterador produce (hash, análisis, error)
+    a medida que cada imagen única termina.
+    """
+    service = CulturalAnalysisService()
+    unique: Dict[str, ImageInput] = {}
+    for image in images:
+        try:
+            image = as_source_image(image)
+        except ImagePreparationError:
+            pass  # analyze_image devuelve el error de esa imagen
+        unique.setdefault(image_content_hash(image), image)
+
+    workers = max(1, min(max_concurrency or service.BATCH_CONCURRENCY, len(unique)))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='analysis-batch')
+    futures = {executor.submit(service.analyze_image, image, use_cache): h for h, image in unique.items()}
+    return _iter_completed(executor, futures)
+
+
+def _iter_completed(executor: ThreadPoolExecutor, futures: Dict) -> Iterator:
+    try:
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except OpenAIAnalysisError as e:
+                yield futures[future], None, e
+    finally:
+        # si el cliente corta el stream, no seguir llamando a OpenAI por imágenes pendientes
+        executor.shutdown(wait=False, cancel_futures=True)
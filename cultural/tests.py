@@ -1,3 +1,1194 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.signals import request_started
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+
+from .analysis import knowledge
+from .analysis.embeddings import EMBEDDING_DIM, EmbeddingIndex, embed
+from .analysis.images import PreparedImage, SourceImage
+from .analysis.openai_client import (
+    OpenAIClientError, _retry_after_seconds, aclose_async_session, call_openai_api, stream_openai_api,
+)
+from .analysis.parsing import IncrementalJSONParser, parse_structured
+from .analysis.phash import HammingIndex
+from .analysis.prompt import count_prompt_tokens
+from .analysis.resilience import (
+    CLOSED, HALF_OPEN, OPEN, AdaptiveLimiter, CircuitBreaker, CircuitOpenError,
+)
+from .analysis.schema import compile_validator, get_structured_output
+from .analysis.tokens import TokenCounter
+from .cache import AnalysisKey, LocalTier, TieredCache, decode_value, encode_value
+from .coalescing import CACHED, COALESCED, LEADER, REMOTE, TIMEOUT, SingleFlight
+from .jobs import JOB_MAINTENANCE_UID, JOB_MAX_ATTEMPTS, AnalysisJobRunner, job_stale_after, reset_stale_jobs
+from .management.commands._mock_upstream import MockUpstream
+from .management.commands._synthetic import synthetic_image_bytes
+from .metrics import ANALYSIS_UPSTREAM_CALLS, DEAD_FILE, MASTER_FILE, Counter, Histogram, Registry
+from .models import AnalysisJob, AnalysisJobStatus
+from .records import RecordTier, build_record, record_analysis
+from .serializers import CulturalAnalysisSerializer, CulturalItemSerializer, CulturalReportSerializer
+from .uploads import HashingTemporaryFileUploadHandler, source_from_upload, upload_content_hash
+
+
+def setUpModule():
+    # sin hilo de mantenimiento de trabajos: las pruebas crean sus propios AnalysisJobRunner
+    request_started.disconnect(dispatch_uid=JOB_MAINTENANCE_UID)
+
+
+class ScriptedUpstream:
+    """Servidor local que responde los POST con `responses` en orden: (status, headers, cuerpo)."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, headers, body = upstream.responses[min(upstream.calls, len(upstream.responses) - 1)]
+                upstream.calls += 1
+                body = body.encode('utf-8')
+                self.send_response(status)
+                for name, value in {'Content-Length': str(len(body)), **headers}.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1/chat/completions"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def sse_body(*chunks) -> str:
+    return ''.join(f"data: {c if isinstance(c, str) else json.dumps(c)}\n\n" for c in chunks)
+
+
+def delta(text: str) -> dict:
+    return {'choices': [{'index': 0, 'delta': {'content': text}}]}
+
+
+def api_kwargs(url: str, **extra) -> dict:
+    return {'api_url': url, 'api_key': 'sk-test', 'model': 'gpt-4o', 'max_tokens': 100, 'timeout': 5,
+            'prompt': 'p', 'image_base64': 'aGVsbG8=', **extra}
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def breaker(self, **kwargs):
+        return CircuitBreaker(**{'window': 4, 'min_calls': 4, 'open_seconds': 0.05, **kwargs})
+
+    def test_abre_con_la_tasa_de_fallos(self):
+        breaker = self.breaker()
+        for failed in (False, False, True):
+            breaker.record(failed, 0.1)
+        self.assertEqual(breaker.state, CLOSED)  # menos de min_calls
+        breaker.record(True, 0.1)
+        self.assertEqual(breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError) as ctx:
+            breaker.allow()
+        self.assertGreater(ctx.exception.retry_after, 0)
+
+    def test_abre_con_llamadas_lentas(self):
+        breaker = self.breaker(slow_call_seconds=1.0, slow_call_rate=0.75)
+        for seconds in (2.0, 2.0, 2.0, 0.1):
+            breaker.record(False, seconds)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_semiabierto_deja_pasar_una_prueba_y_se_cierra(self):
+        breaker = self.breaker()
+        for _ in range(4):
+            breaker.record(True, 0.1)
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        breaker.allow()
+        with self.assertRaises(CircuitOpenError):
+            breaker.allow()  # solo una llamada de prueba
+        breaker.record(False, 0.1)
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.allow()
+        self.assertEqual(breaker.stats()['transitions'],
+                         {'closed->open': 1, 'open->half_open': 1, 'half_open->closed': 1})
+
+    def test_prueba_fallida_vuelve_a_abrir(self):
+        breaker = self.breaker()
+        for _ in range(4):
+            breaker.record(True, 0.1)
+        time.sleep(0.06)
+        breaker.allow()
+        breaker.record(True, 0.1)
+        self.assertEqual(breaker.state, OPEN)
+
+
+class AdaptiveLimiterTests(SimpleTestCase):
+    def test_sube_uno_cada_limit_exitos(self):
+        limiter = AdaptiveLimiter(initial=4, max_limit=5)
+        for _ in range(4):
+            limiter.acquire()
+            limiter.release(False, 0.1)
+        self.assertEqual(limiter.limit, 4)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(False, 0.1)
+        self.assertEqual(limiter.limit, 5)  # tope max_limit
+
+    def test_baja_ante_sobrecarga_o_latencia_alta(self):
+        limiter = AdaptiveLimiter(initial=10, backoff=0.5, latency_target=1.0, min_limit=2)
+        limiter.acquire()
+        limiter.release(True, 0.1)
+        self.assertEqual(limiter.limit, 5)
+        limiter.acquire()
+        limiter.release(False, 3.0)
+        self.assertEqual(limiter.limit, 2)
+        limiter.acquire()
+        limiter.release(True, 0.1)
+        self.assertEqual(limiter.limit, 2)  # no baja de min_limit
+        self.assertEqual(limiter.stats()['decreases'], 3)
+
+    def test_lleno_rechaza_al_vencer_la_espera(self):
+        limiter = AdaptiveLimiter(initial=1)
+        limiter.acquire()
+        with self.assertRaises(CircuitOpenError):
+            limiter.acquire(timeout=0.05)
+        self.assertEqual(limiter.stats()['rejected'], 1)
+
+    def test_espera_async_despierta_con_release_de_otro_hilo(self):
+        limiter = AdaptiveLimiter(initial=1)
+        limiter.acquire()
+
+        async def main():
+            threading.Timer(0.05, limiter.release, args=(False, 0.1)).start()
+            t0 = time.monotonic()
+            await limiter.aacquire(timeout=5)
+            return time.monotonic() - t0
+
+        self.assertLess(asyncio.run(main()), 1.0)
+        self.assertEqual(limiter.stats()['in_flight'], 1)
+
+    def test_espera_async_rechaza_al_vencer(self):
+        limiter = AdaptiveLimiter(initial=1)
+        limiter.acquire()
+        with self.assertRaises(CircuitOpenError):
+            asyncio.run(limiter.aacquire(timeout=0.05))
+        self.assertEqual(limiter._async_waiters, [])
+
+    def test_vista_async_con_limite_propio(self):
+        from .services import CulturalAnalysisService, _async_upstream_guard, _upstream_guard
+        self.assertIs(_async_upstream_guard.breaker, _upstream_guard.breaker)
+        self.assertEqual(_async_upstream_guard.limiter.limit, CulturalAnalysisService.ASYNC_POOL_SIZE)
+        self.assertEqual(_upstream_guard.limiter.limit, CulturalAnalysisService.POOL_SIZE)
+
+
+class IncrementalJSONParserTests(SimpleTestCase):
+    ANALYSIS = {
+        'titulo': 'Danza de los "Negritos"',
+        'categoria': 'Danza',
+        'confianza': 0.91,
+        'razones': ['vestimenta {típica}', 'máscara, cascabeles'],
+        'ubicacion': {'ciudad': 'Huánuco', 'coordenadas': [-9.93, -76.24]},
+        'descripcion': 'Barra \\ y salto\nde línea',
+    }
+
+    def fields(self, chunks):
+        parser = IncrementalJSONParser()
+        fields = [f for chunk in chunks for f in parser.feed(chunk)]
+        return parser, fields
+
+    def test_tokens_partidos_en_cualquier_punto(self):
+        text = '```json\n' + json.dumps(self.ANALYSIS, ensure_ascii=False) + '\n```'
+        for size in (1, 2, 3, 7):
+            parser, fields = self.fields([text[i:i + size] for i in range(0, len(text), size)])
+            self.assertEqual(dict(fields), self.ANALYSIS, size)
+            self.assertEqual([k for k, _ in fields], list(self.ANALYSIS))
+            self.assertTrue(parser.done)
+
+    def test_comillas_escapadas_y_llaves_dentro_de_strings(self):
+        _, fields = self.fields(['{"titulo": "a \\"}\\" b", ', '"categoria": "Danza"}'])
+        self.assertEqual(fields, [('titulo', 'a "}" b'), ('categoria', 'Danza')])
+
+    def test_objetos_anidados_se_emiten_completos(self):
+        _, fields = self.fields(['{"ubicacion": {"a": {"b": [1, ', '2]}, "c": "x,y"}, "fin": true}'])
+        self.assertEqual(fields, [('ubicacion', {'a': {'b': [1, 2]}, 'c': 'x,y'}), ('fin', True)])
+
+    def test_campo_incompleto_no_se_emite(self):
+        parser, fields = self.fields(['{"titulo": "Pacha', 'manca"'])
+        self.assertEqual(fields, [])
+        self.assertFalse(parser.done)
+
+    def test_ignora_lo_que_sigue_al_cierre(self):
+        _, fields = self.fields(['{"a": 1} {"b": 2}'])
+        self.assertEqual(fields, [('a', 1)])
+
+
+class CallOpenAIApiRetryTests(SimpleTestCase):
+    OK = (200, {'Content-Type': 'application/json'}, json.dumps({'choices': [{'message': {'content': '{}'}}]}))
+
+    def call(self, upstream, **extra):
+        timing = {}
+        result = call_openai_api(**api_kwargs(upstream.url, backoff_base=0.01, timing=timing, **extra))
+        return result, timing
+
+    def test_reintenta_5xx_y_429(self):
+        with ScriptedUpstream([(503, {}, 'caído'), (429, {}, 'límite'), self.OK]) as upstream:
+            result, timing = self.call(upstream)
+        self.assertEqual(result['choices'][0]['message']['content'], '{}')
+        self.assertEqual((upstream.calls, timing['attempts']), (3, 3))
+
+    def test_respeta_retry_after_en_segundos_y_fecha(self):
+        past = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        with ScriptedUpstream([(429, {'Retry-After': '0.2'}, ''), (503, {'Retry-After': past}, ''),
+                               self.OK]) as upstream:
+            t0 = time.monotonic()
+            self.call(upstream)
+        self.assertEqual(upstream.calls, 3)
+        self.assertGreaterEqual(time.monotonic() - t0, 0.2)
+
+    def test_retry_after_invalido_usa_backoff(self):
+        self.assertIsNone(_retry_after_seconds({'Retry-After': 'mañana'}))
+        self.assertIsNone(_retry_after_seconds({'Retry-After': 'Mon, 99 Foo 2024 99:99:99 GMT'}))
+        with ScriptedUpstream([(503, {'Retry-After': 'mañana'}, ''), self.OK]) as upstream:
+            self.call(upstream)
+        self.assertEqual(upstream.calls, 2)
+
+    def test_retry_after_demasiado_largo_no_reintenta(self):
+        with ScriptedUpstream([(429, {'Retry-After': '3600'}, ''), self.OK]) as upstream:
+            with self.assertRaisesMessage(OpenAIClientError, 'Límite de uso'):
+                self.call(upstream)
+        self.assertEqual(upstream.calls, 1)
+
+    def test_se_rinde_al_agotar_los_reintentos(self):
+        with ScriptedUpstream([(502, {}, 'bad gateway')]) as upstream:
+            with self.assertRaisesMessage(OpenAIClientError, '502'):
+                self.call(upstream, max_retries=2)
+        self.assertEqual(upstream.calls, 3)
+
+    def test_errores_definitivos_no_se_reintentan(self):
+        with ScriptedUpstream([(401, {}, 'no'), self.OK]) as upstream:
+            with self.assertRaisesMessage(OpenAIClientError, 'autenticación'):
+                self.call(upstream)
+        self.assertEqual(upstream.calls, 1)
+
+
+class StreamOpenAIApiTests(SimpleTestCase):
+    def test_trozo_mal_formado_corta_con_error(self):
+        body = sse_body(delta('{"titulo": '), '{no es json', delta('"x"}'), '[DONE]')
+        with ScriptedUpstream([(200, {'Content-Type': 'text/event-stream'}, body)]) as upstream:
+            texts = []
+            with self.assertLogs('cultural.analysis.openai_client', 'WARNING'):
+                with self.assertRaises(OpenAIClientError):
+                    for text in stream_openai_api(**api_kwargs(upstream.url)):
+                        texts.append(text)
+        self.assertEqual(texts, ['{"titulo": '])
+
+    def test_lineas_vacias_y_keep_alive_se_ignoran(self):
+        body = ': keep-alive\n\ndata:\n\n' + sse_body(delta('{"a": 1}'), {'choices': [], 'usage': {'prompt_tokens': 7}},
+                                                      '[DONE]')
+        usage = {}
+        with ScriptedUpstream([(200, {'Content-Type': 'text/event-stream'}, body)]) as upstream:
+            texts = list(stream_openai_api(**api_kwargs(upstream.url), usage=usage))
+        self.assertEqual(texts, ['{"a": 1}'])
+        self.assertEqual(usage, {'prompt_tokens': 7})
+
+
+class MockUpstreamMixin:
+    """Las vistas llaman a un MockUpstream local en vez de a OpenAI."""
+
+    def setUp(self):
+        from .services import CulturalAnalysisService, _async_upstream_guard, _upstream_guard
+        super().setUp()
+        for guard in (_upstream_guard, _async_upstream_guard):
+            # el límite adaptativo crece con cada respuesta rápida del mock: no pasa al test siguiente
+            self.addCleanup(setattr, guard.limiter, '_limit', guard.limiter._limit)
+        self.upstream = MockUpstream(latency=0.0)
+        threading.Thread(target=self.upstream.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.upstream.server.server_close)
+        self.addCleanup(self.upstream.server.shutdown)
+        original = CulturalAnalysisService.API_URL
+        CulturalAnalysisService.API_URL = self.upstream.url
+        self.addCleanup(setattr, CulturalAnalysisService, 'API_URL', original)
+        # imágenes nuevas en cada test: las cachés de análisis sobreviven entre tests
+        self.image = self.new_image()
+
+    @staticmethod
+    def new_image() -> str:
+        return base64.b64encode(synthetic_image_bytes(64, 48, seed=random.randrange(1 << 30))).decode()
+
+
+class ImageUploadTests(TestCase):
+    """Imagen como archivo (multipart): mismo hash y mismo análisis que en base64."""
+    ITEM = {'titulo': 'Kotosh', 'categoria': 'PATRIMONIO_ARQUEOLOGICO', 'confianza': 0.9, 'descripcion': 'd',
+            'contexto_cultural': 'c', 'periodo_historico': 'p', 'ubicacion': 'u', 'significado': 's'}
+
+    def setUp(self):
+        self.data = synthetic_image_bytes(64, 48, seed=random.randrange(1 << 30))
+        media = override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def upload(self, name='imagen'):
+        return SimpleUploadedFile(f'{name}.jpg', self.data, content_type='image/jpeg')
+
+    def test_hash_del_handler_igual_al_del_base64(self):
+        handler = HashingTemporaryFileUploadHandler()
+        handler.new_file('image', 'foto.jpg', 'image/jpeg', len(self.data))
+        for start in range(0, len(self.data), 1000):  # en trozos, como llega por la red
+            handler.receive_data_chunk(self.data[start:start + 1000], start)
+        file = handler.file_complete(len(self.data))
+        expected = SourceImage.from_base64(base64.b64encode(self.data).decode()).content_hash
+        self.assertEqual(file.content_hash, expected)
+        self.assertEqual(source_from_upload(file).content_hash, expected)
+        self.assertEqual(upload_content_hash(self.upload()), expected)  # otro handler: se calcula leyendo
+
+    def test_serializers_guardan_el_archivo_subido(self):
+        item = CulturalItemSerializer(data={**self.ITEM, 'imagen': self.upload()})
+        self.assertTrue(item.is_valid(), item.errors)
+        item = item.save()
+        self.assertRegex(item.imagen.name, rf'^cultural_items/cultural_{item.id}(_\w+)?\.jpg$')
+        self.assertEqual(item.imagen.read(), self.data)
+
+        user = get_user_model().objects.create_user(username='reporta', email='reporta@example.com', password='x')
+        request = mock.Mock(user=user)
+        report = CulturalReportSerializer(data={**self.ITEM, 'motivo': 'm', 'report_type': 'NUEVO_ELEMENTO',
+                                                'imagen': self.upload()}, context={'request': request})
+        self.assertTrue(report.is_valid(), report.errors)
+        report = report.save()
+        self.assertIn(f'report_{report.id}', report.imagen.name)
+
+    @override_settings(IMAGE_UPLOAD_MAX_BYTES=10)
+    def test_archivo_demasiado_grande(self):
+        serializer = CulturalItemSerializer(data={**self.ITEM, 'imagen': self.upload()})
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('imagen', serializer.errors)
+
+
+@override_settings(FILE_UPLOAD_HANDLERS=['cultural.uploads.HashingTemporaryFileUploadHandler'])
+class AnalyzeUploadViewTests(MockUpstreamMixin, TestCase):
+    URL = '/api/cultural/analyze/'
+
+    def assertCacheHit(self, first, second):
+        self.assertEqual(first.status_code, 200, first.content)
+        self.assertEqual(second.status_code, 200, second.content)
+        self.assertIsNone(first.json()['data']['metadata']['cache_hit'])
+        self.assertEqual(second.json()['data']['metadata']['cache_hit'], 'exact')
+        self.assertEqual(self.upstream.calls, 1)
+
+    def post_file(self):
+        image = SimpleUploadedFile('foto.jpg', base64.b64decode(self.image), content_type='image/jpeg')
+        return self.client.post(self.URL, {'image': image})  # multipart/form-data
+
+    def post_base64(self):
+        return self.client.post(self.URL, {'image': self.image}, content_type='application/json')
+
+    def test_archivo_y_luego_base64_es_acierto_de_cache(self):
+        self.assertCacheHit(self.post_file(), self.post_base64())
+
+    def test_base64_y_luego_archivo_es_acierto_de_cache(self):
+        self.assertCacheHit(self.post_base64(), self.post_file())
+
+
+class HammingIndexTests(SimpleTestCase):
+    def assertConsistent(self, index):
+        size = len(index._by_slot)
+        self.assertEqual(size, len(index))
+        self.assertEqual(set(index._by_slot), set(index._values))
+        for h, slot in index._slots.items():
+            self.assertEqual((index._by_slot[slot], int(index._hashes[slot])), (h, h))
+
+    def test_quitar_compacta_los_slots(self):
+        index = HammingIndex(max_entries=4)
+        for h in (0b0001, 0b0011, 0b0111, 0b1111):
+            index.add(h, f'v{h}')
+        index.remove(0b0011)  # el último pasa a su slot
+        self.assertEqual(index._slots[0b1111], 1)
+        self.assertConsistent(index)
+        index.remove(0b1111)  # quitar el que está al final no mueve nada
+        index.remove(0b1010)  # inexistente
+        self.assertEqual(index._by_slot, [0b0001, 0b0111])
+        self.assertConsistent(index)
+        self.assertEqual(index.nearest(0b0110, 1), (0b0111, 'v7', 1))
+
+    def test_al_llenarse_descarta_el_menos_usado(self):
+        index = HammingIndex(max_entries=3)
+        for h in (1, 2, 4):
+            index.add(h, h)
+        index.nearest(1, 0)  # usar 1 y 2: el menos usado pasa a ser 4
+        index.add(2, 'nuevo')
+        index.add(8, 8)
+        self.assertEqual(list(index._values), [1, 2, 8])
+        self.assertEqual(index._values[2], 'nuevo')
+        self.assertConsistent(index)
+        self.assertIsNone(index.nearest(4, 0))
+
+    def test_nearest_respeta_el_umbral(self):
+        index = HammingIndex()
+        self.assertIsNone(index.nearest(0, 64))
+        index.add(0, 'cero')
+        index.add(0xFF, 'ocho')
+        self.assertIsNone(index.nearest(0b111 << 20, 2))
+        self.assertEqual(index.nearest(0b111 << 20, 3), (0, 'cero', 3))
+        self.assertEqual(index.nearest(0x7F, 8), (0xFF, 'ocho', 1))  # el más cercano, no el primero
+        self.assertEqual(index.nearest(0, 0), (0, 'cero', 0))
+        self.assertIsNone(index.nearest(0, -1))  # -1 desactiva la búsqueda
+
+
+class NearDuplicateViewTests(MockUpstreamMixin, TestCase):
+    URL = '/api/cultural/analyze/'
+
+    def post(self, image_bytes):
+        return self.client.post(self.URL, {'image': base64.b64encode(image_bytes).decode()},
+                                content_type='application/json')
+
+    def setUp(self):
+        super().setUp()
+        original = base64.b64decode(self.image)
+        png = io.BytesIO()
+        Image.open(io.BytesIO(original)).save(png, 'PNG')  # mismos píxeles, otros bytes: otro sha256
+        self.original, self.recoded = original, png.getvalue()
+
+    def test_misma_foto_recodificada_sale_de_cache(self):
+        first = self.post(self.original)
+        second = self.post(self.recoded)
+        self.assertEqual(second.status_code, 200, second.content)
+        metadata = second.json()['data']['metadata']
+        self.assertEqual((metadata['cache_hit'], metadata['hamming_distance']), ('near_duplicate', 0))
+        self.assertEqual(second.json()['data']['titulo'], first.json()['data']['titulo'])
+        self.assertEqual(self.upstream.calls, 1)
+
+    def test_entrada_expirada_se_quita_del_indice(self):
+        from .services import CulturalAnalysisService, _near_duplicates
+        self.post(self.original)
+        phash = CulturalAnalysisService().prepare_image(self.image).phash
+        self.assertIn(phash, _near_duplicates._values)
+        with mock.patch.object(TieredCache, 'get', return_value=(None, None)), \
+                mock.patch.object(_near_duplicates, 'remove', wraps=_near_duplicates.remove) as remove:
+            response = self.post(self.recoded)  # el índice la encuentra pero la caché ya no la tiene
+        remove.assert_called_once_with(phash)
+        self.assertIsNone(response.json()['data']['metadata']['cache_hit'])
+        self.assertEqual(self.upstream.calls, 2)
+        self.assertIn(phash, _near_duplicates._values)  # vuelta a indexar con el análisis nuevo
+
+
+class AnalyzeAsyncViewTests(MockUpstreamMixin, TestCase):
+    URL = '/api/cultural/analyze/async/'
+
+    async def test_validacion_y_postproceso_fuera_del_event_loop(self):
+        from .services import CulturalAnalysisService
+        loop_thread, threads = threading.get_ident(), {}
+
+        def spy(name, original):
+            def wrapper(*args, **kwargs):
+                threads[name] = threading.get_ident()
+                return original(*args, **kwargs)
+            return wrapper
+
+        with mock.patch.object(CulturalAnalysisSerializer, 'is_valid', autospec=True,
+                               side_effect=spy('is_valid', CulturalAnalysisSerializer.is_valid)), \
+                mock.patch.object(CulturalAnalysisService, '_finalize_analysis', autospec=True,
+                                  side_effect=spy('finalize', CulturalAnalysisService._finalize_analysis)):
+            response = await AsyncClient().post(self.URL, {'image': self.image}, content_type='application/json')
+        await aclose_async_session()  # la sesión es por event loop y este termina con el test
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(threads), {'is_valid', 'finalize'})
+        self.assertNotIn(loop_thread, threads.values())
+
+
+class AnalyzeStreamViewTests(MockUpstreamMixin, TestCase):
+    URL = '/api/cultural/analyze/stream'
+
+    @staticmethod
+    def events(body: str):
+        return [block.split('\n', 1)[0].removeprefix('event: ') for block in body.split('\n\n') if block]
+
+    def test_acepta_event_stream(self):
+        response = self.client.post(self.URL, {'image': self.image}, content_type='application/json',
+                                    HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        events = self.events(b''.join(response.streaming_content).decode())
+        self.assertIn('field', events)
+        self.assertEqual(events[-1], 'result')
+
+    def test_error_de_validacion_como_evento(self):
+        response = self.client.post(self.URL, {'image': ''}, content_type='application/json',
+                                    HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response['Content-Type'], 'text/event-stream; charset=utf-8')
+        self.assertTrue(response.content.decode().startswith('event: error\n'))
+
+    async def test_asgi_transmite_con_iterador_async(self):
+        response = await AsyncClient().post(self.URL, {'image': self.image}, content_type='application/json',
+                                            headers={'Accept': 'text/event-stream'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertGreater(len(chunks), 2)  # un trozo por evento, no el cuerpo entero de una vez
+        self.assertEqual(self.events(b''.join(chunks).decode())[-1], 'result')
+
+
+class AnalyzeBatchViewTests(MockUpstreamMixin, TestCase):
+    URL = '/api/cultural/analyze/batch'
+
+    def payload(self):
+        return {'images': [self.image, {'id': 'b', 'image': self.new_image()}, self.image]}
+
+    @staticmethod
+    def lines(body: bytes):
+        return [json.loads(line) for line in body.decode('utf-8').splitlines()]
+
+    def test_accept_ndjson_transmite_lineas(self):
+        response = self.client.post(self.URL, self.payload(), content_type='application/json',
+                                    HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = self.lines(b''.join(response.streaming_content))
+        self.assertEqual(sorted(line['index'] for line in lines[:-1]), [0, 1, 2])
+        self.assertEqual({k: lines[-1][k] for k in ('done', 'total', 'unique', 'succeeded')},
+                         {'done': True, 'total': 3, 'unique': 2, 'succeeded': 3})
+        self.assertEqual(self.upstream.calls, 2)
+
+    def test_sin_accept_responde_json(self):
+        response = self.client.post(self.URL, self.payload(), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data']['succeeded'], 3)
+
+    def test_error_de_validacion_como_linea(self):
+        response = self.client.post(self.URL, {'images': []}, content_type='application/json',
+                                    HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.lines(response.content)[0]['success'])
+
+    def test_resumen_sin_escapar_unicode(self):
+        response = self.client.post(self.URL, {'images': [base64.b64encode(b'no es imagen').decode()],
+                                               'stream': True}, content_type='application/json')
+        body = b''.join(response.streaming_content).decode('utf-8')
+        self.assertNotIn('\\u', body)
+        self.assertEqual(self.lines(body.encode())[-1]['failed'], 1)
+
+    async def test_asgi_transmite_con_iterador_async(self):
+        response = await AsyncClient().post(self.URL, self.payload(), content_type='application/json',
+                                            headers={'Accept': 'application/x-ndjson'})
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual(len(chunks), 4)  # una línea por imagen y el resumen
+
+
+class AnalysisJobRunnerTests(TransactionTestCase):
+    """Los workers usan su propia conexión: sin TransactionTestCase no verían los trabajos creados aquí."""
+
+    def setUp(self):
+        self.runner = AnalysisJobRunner(workers=1, maintenance_interval=0, retry_backoff=0.01)
+        self.addCleanup(self.runner._executor.shutdown)
+
+    def analyze(self, side_effect):
+        patcher = mock.patch('cultural.services.CulturalAnalysisService.analyze_image', side_effect=side_effect)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def wait(self):
+        self.assertTrue(self.runner.wait_idle(5))
+
+    @staticmethod
+    def image(width=64, height=48) -> str:
+        return base64.b64encode(synthetic_image_bytes(width, height, seed=random.randrange(1 << 30))).decode()
+
+    def test_guarda_la_imagen_reducida_con_el_hash_de_la_original(self):
+        analyze = self.analyze(lambda image: {'ok': True})
+        original = self.image(2400, 1800)
+        source = SourceImage.from_base64(original)
+        with mock.patch.object(self.runner._executor, 'submit'):  # sin ejecutar: se ve lo guardado
+            job = self.runner.submit(original)
+        job.refresh_from_db()
+        self.assertEqual(job.content_hash, source.content_hash)
+        self.assertLess(len(job.image_base64), len(original) // 10)
+        stored = SourceImage.from_base64(job.image_base64)
+        self.assertEqual(max(stored.width, stored.height), 1024)
+        self.runner._run(job.id)
+        image = analyze.call_args[0][0]
+        self.assertEqual(image.content_hash, source.content_hash)  # misma clave de caché que /analyze/
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.image_base64), (AnalysisJobStatus.COMPLETADO, ''))
+
+    def test_error_inesperado_se_reintenta_solo(self):
+        analyze = self.analyze([RuntimeError('boom'), {'ok': True}])
+        job = self.runner.submit(self.image())
+        self.wait()
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJobStatus.COMPLETADO)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(job.result, {'ok': True})
+        self.assertEqual(analyze.call_count, 2)
+
+    def test_agota_los_intentos_y_falla(self):
+        self.analyze(RuntimeError('boom'))
+        job = self.runner.submit(self.image())
+        self.wait()
+        job.refresh_from_db()
+        self.assertEqual(job.status, AnalysisJobStatus.FALLIDO)
+        self.assertEqual(job.attempts, JOB_MAX_ATTEMPTS)
+        self.assertEqual(job.image_base64, '')
+        self.assertIsNotNone(job.expires_at)
+
+    def test_recover_reencola_huerfanos_y_purga_expirados(self):
+        self.analyze(lambda image: {'image': image})
+        now = timezone.now()
+        pending = AnalysisJob.objects.create(image_base64='a')
+        stale = AnalysisJob.objects.create(image_base64='b', status=AnalysisJobStatus.PROCESANDO,
+                                           started_at=now - timedelta(hours=1), attempts=1)
+        running = AnalysisJob.objects.create(image_base64='c', status=AnalysisJobStatus.PROCESANDO,
+                                             started_at=now, attempts=1)
+        expired = AnalysisJob.objects.create(status=AnalysisJobStatus.COMPLETADO,
+                                             expires_at=now - timedelta(seconds=1))
+        self.assertEqual(self.runner.recover(), 2)
+        self.assertEqual(self.runner.recover(), 0)  # limitado por intervalo
+        self.wait()
+        for job, expected in ((pending, AnalysisJobStatus.COMPLETADO), (stale, AnalysisJobStatus.COMPLETADO),
+                              (running, AnalysisJobStatus.PROCESANDO)):
+            job.refresh_from_db()
+            self.assertEqual(job.status, expected)
+        self.assertFalse(AnalysisJob.objects.filter(id=expired.id).exists())
+
+    def test_no_reencola_un_analisis_en_dos_etapas_aun_dentro_de_su_presupuesto(self):
+        from .services import CulturalAnalysisService
+        with mock.patch.object(CulturalAnalysisService, 'TWO_STAGE', True):
+            budget = CulturalAnalysisService.upstream_budget()
+            self.assertGreater(job_stale_after(), budget)
+            running = AnalysisJob.objects.create(image_base64='a', status=AnalysisJobStatus.PROCESANDO,
+                                                 started_at=timezone.now() - timedelta(seconds=budget), attempts=1)
+            self.assertEqual(reset_stale_jobs(), 0)
+        running.refresh_from_db()
+        self.assertEqual(running.status, AnalysisJobStatus.PROCESANDO)
+
+    def test_consultar_un_trabajo_pendiente_dispara_la_recuperacion(self):
+        self.analyze(lambda image: {'ok': True})
+        job = AnalysisJob.objects.create(image_base64='a')
+        with mock.patch('cultural.views.get_job_runner', return_value=self.runner):
+            response = self.client.get(f'/api/cultural/analyze/jobs/{job.id}')
+            self.assertEqual(response.json()['job']['status'], AnalysisJobStatus.PENDIENTE)
+            self.wait()
+            response = self.client.get(f'/api/cultural/analyze/jobs/{job.id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data'], {'ok': True})
+
+
+class CrossWorkerFlightTests(SimpleTestCase):
+    """Dos SingleFlight sobre la misma caché de candados: dos workers."""
+
+    def setUp(self):
+        self.key = f'cross-{uuid.uuid4().hex}'
+        self.worker_a = SingleFlight(lock_alias='default', wait_timeout=5, lock_ttl=10)
+        self.worker_b = SingleFlight(lock_alias='default', wait_timeout=5, lock_ttl=10)
+        self.a_leading, self.b_polled = threading.Event(), threading.Event()
+        self.polls, self.lookups = 0, 0
+
+    def poll(self, value=None):
+        def poll():
+            self.polls += 1
+            self.b_polled.set()
+            return value() if callable(value) else value
+        return poll
+
+    def lookup(self, value=None):
+        def lookup():
+            self.lookups += 1
+            return value
+        return lookup
+
+    def lead_a(self, fn):
+        """Worker A toma el candado y corre `fn` cuando B ya está consultando."""
+        result = {}
+
+        def lead():
+            self.a_leading.set()
+            self.assertTrue(self.b_polled.wait(5))
+            return fn()
+
+        def run():
+            try:
+                result['a'] = self.worker_a.do(self.key, lead, lambda: None)
+            except Exception as e:
+                result['a'] = e
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.assertTrue(self.a_leading.wait(5))
+        return thread, result
+
+    def test_seguidora_remota_solo_consulta_la_cache_compartida(self):
+        shared = {}
+
+        def store():
+            # A guarda y espera otra consulta de B antes de soltar el candado
+            self.b_polled.clear()
+            shared['v'] = 'remoto'
+            self.assertTrue(self.b_polled.wait(5))
+            return 'remoto'
+        thread, _ = self.lead_a(store)
+        value = self.worker_b.do(self.key, lambda: 'propia', self.lookup(), self.poll(lambda: shared.get('v')))
+        thread.join()
+        self.assertEqual(value, ('remoto', REMOTE))
+        self.assertEqual(self.lookups, 0)  # la búsqueda completa (con estadísticas) no se repite
+        self.assertGreaterEqual(self.polls, 1)
+
+    def test_busqueda_completa_una_vez_al_tomar_el_candado(self):
+        def fail():
+            raise ValueError('upstream')
+        thread, result = self.lead_a(fail)
+        value = self.worker_b.do(self.key, lambda: 'propia', self.lookup(), self.poll())
+        thread.join()
+        self.assertIsInstance(result['a'], ValueError)
+        self.assertEqual(value, ('propia', LEADER))
+        self.assertEqual(self.lookups, 1)
+
+    def test_resultado_encontrado_al_tomar_el_candado(self):
+        thread, _ = self.lead_a(lambda: None)  # termina sin dejar nada en la caché que consulta B
+        value = self.worker_b.do(self.key, lambda: 'propia', self.lookup('en caché'), self.poll())
+        thread.join()
+        self.assertEqual(value, ('en caché', CACHED))
+
+
+class TrackedFlight(SingleFlight):
+    """SingleFlight que avisa cada vez que una petición se une a un vuelo: las pruebas esperan eso, no un sleep."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.joins = []  # True si esa petición quedó como líder
+        self._joined = threading.Condition()
+
+    def _join(self, key, stale=None):
+        future, leader = super()._join(key, stale)
+        with self._joined:
+            self.joins.append(leader)
+            self._joined.notify_all()
+        return future, leader
+
+    def wait_joins(self, n: int) -> None:
+        with self._joined:
+            assert self._joined.wait_for(lambda: len(self.joins) >= n, 5), f"{len(self.joins)} de {n} uniones"
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        self.flights = TrackedFlight(lock_alias=None, wait_timeout=5, lock_ttl=10)
+        self.calls = 0
+        self.release = threading.Event()
+
+    def slow(self, value='ok'):
+        def fn():
+            self.calls += 1
+            self.release.wait(5)
+            if isinstance(value, BaseException):
+                raise value
+            return value
+        return fn
+
+    def run_concurrently(self, flights, fns, key='k', lookup=lambda: None):
+        """Lanza un hilo por fn (el primero es la líder) y espera a que todos se unan al vuelo.
+
+        Devuelve (resultado|excepción, cómo) de cada uno.
+        """
+        results = [None] * len(fns)
+
+        def worker(i, fn):
+            try:
+                results[i] = flights.do(key, fn, lookup)
+            except BaseException as e:
+                results[i] = (e, None)
+
+        threads = [threading.Thread(target=worker, args=(i, fn)) for i, fn in enumerate(fns)]
+        threads[0].start()
+        flights.wait_joins(1)  # la primera lidera
+        for thread in threads[1:]:
+            thread.start()
+        flights.wait_joins(len(fns))
+        return threads, results
+
+    def finish(self, threads):
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+    def test_seguidoras_esperan_a_la_lider(self):
+        threads, results = self.run_concurrently(self.flights, [self.slow()] * 5)
+        self.finish(threads)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flights.joins, [True] + [False] * 4)
+        self.assertEqual(sorted(how for _, how in results), [COALESCED] * 4 + [LEADER])
+        self.assertEqual(self.flights.stats()['in_flight'], 0)
+
+    def test_error_de_la_lider_llega_a_las_seguidoras(self):
+        threads, results = self.run_concurrently(self.flights, [self.slow(ValueError('upstream'))] * 3)
+        self.finish(threads)
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(isinstance(error, ValueError) for error, _ in results))
+
+    def test_lider_vencida_la_releva_una_sola_seguidora(self):
+        flights = TrackedFlight(lock_alias=None, wait_timeout=0.5, lock_ttl=10)
+        relay = []
+
+        def stuck_leader():
+            self.release.wait(5)
+            return 'tarde'
+
+        def follower():
+            relay.append(1)
+            flights.wait_joins(9)  # 5 uniones iniciales y las 4 de las seguidoras vencidas
+            return 'relevo'
+
+        threads, results = self.run_concurrently(flights, [stuck_leader] + [follower] * 4)
+        for thread in threads[1:]:
+            thread.join()
+        self.assertEqual(len(relay), 1)
+        self.assertEqual(flights.joins.count(True), 2)  # la líder atascada y la relevista
+        self.assertEqual(sorted(how for _, how in results[1:]), [COALESCED] * 3 + [TIMEOUT])
+        self.assertEqual({value for value, _ in results[1:]}, {'relevo'})
+        self.finish(threads[:1])
+        self.assertEqual(results[0], ('tarde', LEADER))
+
+    def test_lider_abandonada_sin_error(self):
+        threads, results = self.run_concurrently(self.flights, [self.slow(KeyboardInterrupt()), self.slow()])
+        # KeyboardInterrupt no es Exception: el hilo de la líder muere sin resultado
+        self.finish(threads)
+        self.assertEqual(results[1], ('ok', TIMEOUT))
+        self.assertEqual(self.flights.joins, [True, False, True])
+
+    def test_async_seguidoras_esperan_a_la_lider(self):
+        calls = []
+
+        async def main():
+            go = asyncio.Event()
+
+            async def fn():
+                calls.append(1)
+                await go.wait()
+                return 'ok'
+
+            flights = asyncio.gather(*(self.flights.ado('k', fn, None) for _ in range(4)))
+            while len(self.flights.joins) < 4:
+                await asyncio.sleep(0)
+            go.set()
+            return await flights
+
+        results = asyncio.run(main())
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(how for _, how in results), [COALESCED] * 3 + [LEADER])
+
+
+class RecordTierTests(TestCase):
+    KEY = AnalysisKey(2, 'gpt-4o', 'v1', 'metodo', 'a' * 64)
+
+    def test_solo_sirve_filas_del_mismo_formato(self):
+        build_record(self.KEY._replace(cache_format=1), {'formato': 1}).save()
+        tier = RecordTier('db', ttl=3600)
+        self.assertIsNone(tier.get(self.KEY))
+        build_record(self.KEY, {'formato': 2}).save()
+        self.assertEqual(decode_value(tier.get(self.KEY)), {'formato': 2})
+        self.assertIsNone(tier.get(self.KEY._replace(cache_format=3)))
+
+    def test_record_analysis_guarda_una_copia(self):
+        result = {'titulo': 'Retablo', 'etiquetas': ['madera']}
+        with mock.patch('cultural.records._writer.submit') as submit:
+            record_analysis(self.KEY, result)
+        result['etiquetas'].append('cambiada después')
+        self.assertEqual(submit.call_args[0][0].result, {'titulo': 'Retablo', 'etiquetas': ['madera']})
+
+
+class TieredCacheTests(SimpleTestCase):
+    KEY = AnalysisKey(2, 'gpt-4o', 'v1', 'metodo', 'b' * 64)
+
+    def setUp(self):
+        self.upper, self.lower = LocalTier('local', 10, 60), LocalTier('shared', 10, 60)
+        self.cache = TieredCache([self.upper, self.lower])
+
+    def test_entrada_ilegible_es_fallo_y_se_borra(self):
+        self.upper.set(self.KEY, b'no es zlib')
+        self.lower.set(self.KEY, encode_value({'ok': True}))
+        with self.assertLogs('cultural.cache', 'WARNING'):
+            self.assertEqual(self.cache.get(self.KEY), ({'ok': True}, 'shared'))
+        self.assertEqual(decode_value(self.upper.get(self.KEY)), {'ok': True})  # repuesta desde abajo
+        self.assertEqual(self.cache.stats()['local']['errors'], 1)
+
+    def test_peek_lee_un_nivel_sin_estadisticas(self):
+        self.lower.set(self.KEY, encode_value({'ok': True}))
+        self.assertEqual(self.cache.peek(self.KEY, 'shared'), {'ok': True})
+        self.assertIsNone(self.cache.peek(self.KEY, 'local'))
+        self.assertIsNone(asyncio.run(self.cache.apeek(self.KEY, 'local')))
+        self.assertIsNone(self.upper.get(self.KEY))  # sin promoción
+        self.assertEqual(self.cache.stats()['shared']['hits'] + self.cache.stats()['local']['misses'], 0)
+
+    def test_entrada_ilegible_async(self):
+        self.upper.set(self.KEY, encode_value({'ok': True})[:-4])
+        with self.assertLogs('cultural.cache', 'WARNING'):
+            self.assertEqual(asyncio.run(self.cache.aget(self.KEY)), (None, None))
+        self.assertIsNone(self.upper.get(self.KEY))
+
+
+class PromptTokenCountTests(SimpleTestCase):
+    def test_cuenta_una_vez_por_prompt_compilado(self):
+        categorias = ('GASTRONOMIA',)
+        with mock.patch.object(TokenCounter, 'count', autospec=True, side_effect=lambda self, text: len(text)) as count:
+            first = count_prompt_tokens(categorias=categorias, model='modelo-de-prueba')
+            calls = count.call_count
+            self.assertEqual(count_prompt_tokens(categorias=categorias, model='modelo-de-prueba'), first)
+            self.assertEqual(count.call_count, calls)
+        self.assertEqual(calls, 2)  # mensaje de sistema y prompt
+
+
+class UpstreamCallMetricTests(SimpleTestCase):
+    def test_cuenta_cada_etapa(self):
+        from .services import CulturalAnalysisService
+        image = PreparedImage(base64='aGVsbG8=', mime='image/jpeg', detail='low', width=8, height=8,
+                              original_bytes=5, sent_bytes=5, original_tokens=85, sent_tokens=85)
+        service = CulturalAnalysisService()
+        before = dict(ANALYSIS_UPSTREAM_CALLS.values)
+        service._routing_kwargs(image, {})
+        service._upstream_kwargs(image, {}, routing={'categorias': ('GASTRONOMIA',)})
+        for stage in ('routing', 'upstream'):
+            self.assertEqual(ANALYSIS_UPSTREAM_CALLS.values[(stage,)] - before.get((stage,), 0), 1)
+
+
+class MultiprocessMetricsTests(SimpleTestCase):
+    DEAD_WORKER = '999999999-1'  # pid inexistente
+
+    def setUp(self):
+        self.dir = Path(tempfile.mkdtemp())
+        settings_override = override_settings(METRICS_DIR=str(self.dir))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.registry = Registry()
+        self.requests = Counter('requests_total', "Peticiones", registry=self.registry)
+        self.latency = Histogram('latency_seconds', "Latencia", buckets=(1,), registry=self.registry)
+
+    def worker_file(self, process_id: str, requests: float) -> None:
+        (self.dir / f'{process_id}.json').write_text(json.dumps({
+            'requests_total': [[[], requests]],
+            'latency_seconds': [[[], {'buckets': [1], 'counts': [1, 0], 'sum': 0.5}]],
+        }))
+
+    def totals(self):
+        collected = self.registry.collect()
+        return collected['requests_total'].get(()), collected['latency_seconds'].get((), [None])[0]
+
+    def test_archivo_por_pid_e_inicio(self):
+        self.requests.inc()
+        self.registry.flush()
+        names = {p.name for p in self.dir.glob('*.json')}
+        self.assertEqual(len(names), 1)
+        self.assertRegex(names.pop(), rf'^{os.getpid()}-\d+\.json$')
+
+    def test_workers_terminados_se_juntan_sin_retroceder(self):
+        self.requests.inc(2)
+        self.registry.flush()
+        self.worker_file(self.DEAD_WORKER, 5)
+        self.worker_file(f'{os.getpid()}-1', 7)  # mismo pid, otro proceso (pid reutilizado)
+        self.assertEqual(self.totals(), (14.0, [2, 0]))
+        self.assertFalse((self.dir / f'{self.DEAD_WORKER}.json').exists())
+        self.assertTrue((self.dir / DEAD_FILE).exists())
+        self.requests.inc()
+        self.assertEqual(self.totals(), (15.0, [2, 0]))
+
+    def test_master_nuevo_vacia_el_directorio(self):
+        (self.dir / MASTER_FILE).write_text(self.DEAD_WORKER)
+        self.worker_file(self.DEAD_WORKER, 5)
+        self.requests.inc()
+        self.registry.flush()
+        self.assertEqual(self.totals(), (1.0, None))
+        self.assertNotEqual((self.dir / MASTER_FILE).read_text(), self.DEAD_WORKER)
+
+    def test_mismo_master_conserva_el_directorio(self):
+        self.requests.inc()
+        self.registry.flush()  # anota el master
+        self.worker_file(self.DEAD_WORKER, 5)
+        self.registry._claimed = False  # como la primera escritura de otro worker del mismo master
+        self.registry.flush()
+        self.assertEqual(self.totals()[0], 6.0)
+
+
+class StructuredOutputTests(SimpleTestCase):
+    CATEGORIAS = ('GASTRONOMIA', 'DANZA')
+
+    def setUp(self):
+        self.response_format, self.validate = get_structured_output(self.CATEGORIAS)
+
+    @staticmethod
+    def analysis(**changes):
+        analysis = {
+            'titulo': 'Pachamanca', 'categoria': 'GASTRONOMIA', 'descripcion': 'd', 'confianza': 0.9,
+            'es_de_huanuco': True, 'razones': ['hojas de chincho'], 'dudas': [], 'contexto_cultural': 'c',
+            'periodo_historico': 'p', 'ubicacion': 'u', 'significado': 's',
+        }
+        analysis.update(changes)
+        return {k: v for k, v in analysis.items() if v is not ...}
+
+    def parse(self, analysis, **message):
+        content = analysis if isinstance(analysis, str) else json.dumps(analysis)
+        return parse_structured({'choices': [{'message': {'content': content, **message}}]}, self.validate)
+
+    def assertInvalid(self, analysis, message):
+        with self.assertRaisesMessage(ValueError, message):
+            self.parse(analysis)
+
+    def test_schema_strict_y_memoizado(self):
+        schema = self.response_format['json_schema']['schema']
+        self.assertTrue(self.response_format['json_schema']['strict'])
+        self.assertEqual(set(schema['required']), set(schema['properties']))
+        self.assertIs(get_structured_output(self.CATEGORIAS)[1], self.validate)
+
+    def test_respuesta_valida(self):
+        self.assertEqual(self.parse(self.analysis())['titulo'], 'Pachamanca')
+        self.assertEqual(self.parse(self.analysis(confianza=1))['confianza'], 1)
+
+    def test_campos_faltantes_o_sobrantes(self):
+        self.assertInvalid(self.analysis(dudas=...), "faltan ['dudas']")
+        self.assertInvalid(self.analysis(extra='x'), "no permitidos ['extra']")
+        self.assertInvalid(self.analysis(dudas=..., extra='x'), "faltan ['dudas']; no permitidos ['extra']")
+
+    def test_tipos_exactos(self):
+        self.assertInvalid(self.analysis(confianza=True), '$.confianza: se esperaba number')
+        self.assertInvalid(self.analysis(titulo=3), '$.titulo: se esperaba string')
+        self.assertInvalid(self.analysis(es_de_huanuco=1), '$.es_de_huanuco: se esperaba boolean')
+        self.assertInvalid(self.analysis(razones=['a', None]), '$.razones[]: se esperaba string')
+        self.assertInvalid(self.analysis(razones='a'), '$.razones: se esperaba una lista')
+        self.assertInvalid(['no', 'objeto'], '$: se esperaba un objeto')
+
+    def test_categoria_fuera_del_enum(self):
+        self.assertInvalid(self.analysis(categoria='Gastronomía'), "valor no permitido 'Gastronomía'")
+
+    def test_confianza_fuera_de_rango(self):
+        self.assertInvalid(self.analysis(confianza=1.5), 'Confianza inválida')
+        self.assertInvalid(json.dumps(self.analysis()).replace('0.9', 'NaN'), 'Confianza inválida')
+
+    def test_rechazo_y_contenido_no_json(self):
+        with self.assertRaisesMessage(ValueError, 'rechazó'):
+            self.parse(self.analysis(), refusal='no puedo')
+        self.assertInvalid('```json {}```', '')
+        with self.assertRaisesMessage(ValueError, 'no retornó'):
+            parse_structured({'choices': []}, self.validate)
+
+    def test_schema_no_strict(self):
+        validate = compile_validator({'type': 'object', 'properties': {'a': {'type': 'integer'}, 'b': {'type': 'string'}},
+                                      'required': ['a']})
+        validate({'a': 1, 'otro': None})  # sin additionalProperties: False se admiten otras claves
+        with self.assertRaisesMessage(ValueError, "faltan ['a']"):
+            validate({'b': 'x'})
+        with self.assertRaisesMessage(ValueError, '$.a: se esperaba integer'):
+            validate({'a': 1.0})
+
+
+class EmbeddingIndexTests(SimpleTestCase):
+    ELEMENTOS = [{'titulo': t, 'descripcion': f'descripción de {t}'} for t in ('Kotosh', 'Pachamanca', 'Negritos')]
+
+    def setUp(self):
+        directory = Path(tempfile.mkdtemp())
+        self.path, self.manifest = directory / 'e.npy', directory / 'e.manifest.json'
+
+    def index(self, elementos):
+        return EmbeddingIndex.for_elements(elementos, self.path, self.manifest)
+
+    def test_elementos_nuevos_se_agregan_al_final_del_archivo(self):
+        first = self.index(self.ELEMENTOS[:2])
+        self.assertEqual((first.reused, first.computed), (0, 2))
+        inode = self.path.stat().st_ino
+        added = self.index(self.ELEMENTOS)
+        self.assertEqual((added.reused, added.computed), (2, 1))
+        self.assertEqual(self.path.stat().st_ino, inode)  # mismo archivo: no se reescribió
+        np.testing.assert_array_equal(added.matrix, np.stack([embed(e) for e in self.ELEMENTOS]))
+        again = self.index(self.ELEMENTOS)
+        self.assertEqual((again.reused, again.computed), (3, 0))
+
+    def test_elemento_editado_reescribe_el_archivo(self):
+        self.index(self.ELEMENTOS)
+        inode = self.path.stat().st_ino
+        edited = [dict(self.ELEMENTOS[0], descripcion='otra'), *self.ELEMENTOS[1:]]
+        index = self.index(edited)
+        self.assertEqual((index.reused, index.computed), (2, 1))
+        self.assertNotEqual(self.path.stat().st_ino, inode)
+
+    def test_filas_sin_manifiesto_se_ignoran(self):
+        self.index(self.ELEMENTOS)
+        manifest = json.loads(self.manifest.read_text())
+        manifest['hashes'] = manifest['hashes'][:2]  # agregado interrumpido antes del manifiesto
+        self.manifest.write_text(json.dumps(manifest))
+        self.assertEqual(self.index(self.ELEMENTOS[:2]).matrix.shape, (2, EMBEDDING_DIM))
+        index = self.index(self.ELEMENTOS)
+        self.assertEqual((index.reused, index.computed), (2, 1))
+        self.assertEqual(np.load(self.path).shape, (3, EMBEDDING_DIM))
+
+
+class KnowledgeSnapshotTests(SimpleTestCase):
+    def setUp(self):
+        self.file = Path(tempfile.mkdtemp()) / 'elementos_huanuco.json'
+        for name, value in (('DATA_FILE', self.file), ('_snapshot', knowledge._EMPTY_SNAPSHOT),
+                            ('_snapshot_stat', ()), ('_stats', dict.fromkeys(knowledge._stats, 0))):
+            patcher = mock.patch.object(knowledge, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def write(self, text: str) -> None:
+        self.file.write_text(text, encoding='utf-8')
+
+    def test_json_mal_formado_mantiene_el_ultimo_snapshot(self):
+        self.write(json.dumps([{'titulo': 'Kotosh'}]))
+        good = knowledge.get_knowledge_snapshot()
+        self.write('[{"titulo": "Kotosh", ')
+        with self.assertLogs('cultural.analysis.knowledge', 'ERROR') as logs:
+            self.assertIs(knowledge.get_knowledge_snapshot(), good)
+        with mock.patch.object(Path, 'read_bytes') as read_bytes:
+            for _ in range(3):
+                self.assertIs(knowledge.get_knowledge_snapshot(), good)
+        read_bytes.assert_not_called()  # no se relee hasta que cambie el archivo
+        self.assertEqual(len(logs.output), 1)
+        self.assertEqual(knowledge.get_knowledge_stats()['errors'], 1)
+
+        self.write(json.dumps([{'titulo': 'Kotosh'}, {'titulo': 'Huánuco Pampa'}]))
+        self.assertEqual(len(knowledge.get_knowledge_snapshot().elementos), 2)
+
+    def test_derivada_lenta_no_frena_recargas_ni_otras_derivadas(self):
+        self.write(json.dumps([{'titulo': 'Kotosh'}]))
+        snapshot = knowledge.get_knowledge_snapshot()
+        building, release, builds = threading.Event(), threading.Event(), []
+
+        def slow(elementos):
+            builds.append(1)
+            building.set()
+            self.assertTrue(release.wait(5))
+            return 'lenta'
+
+        threads = [threading.Thread(target=snapshot.derived, args=('lenta', slow)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(building.wait(5))
+        self.assertEqual(snapshot.derived('otra', len), 1)
+        self.write(json.dumps([{'titulo': 'Kotosh'}, {'titulo': 'Huánuco Pampa'}]))
+        self.assertEqual(len(knowledge.get_knowledge_snapshot().elementos), 2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(snapshot.derived('lenta', slow), 'lenta')
+        self.assertEqual(len(builds), 1)
@@ -0,0 +1,48 @@
+# cultural/uploads.py
+"""
+Imágenes subidas como archivo (multipart/form-data) en vez de base64 en el JSON:
+un 33% menos de datos por la red y sin el cuerpo entero en memoria como str.
+
+HashingTemporaryFileUploadHandler (FILE_UPLOAD_HANDLERS) escribe cada archivo en
+un temporal a medida que llega y calcula su sha256 sobre los mismos trozos, así
+la clave de caché del análisis no obliga a releerlo.
+"""
+import hashlib
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+from .analysis.images import SourceImage
+
+
+class HashingTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """Como TemporaryFileUploadHandler (siempre a disco), con `content_hash` en cada archivo."""
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._sha256 = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.content_hash = self._sha256.hexdigest()
+        return file
+
+
+def upload_content_hash(file: UploadedFile) -> str:
+    """sha256 del archivo (el mismo que SourceImage.content_hash de su base64)."""
+    content_hash = getattr(file, 'content_hash', None)
+    if content_hash is None:  # otro upload handler: se calcula leyendo por trozos
+        sha256 = hashlib.sha256()
+        for chunk in file.chunks():
+            sha256.update(chunk)
+        content_hash = file.content_hash = sha256.hexdigest()
+    return content_hash
+
+
+def source_from_upload(file: UploadedFile) -> SourceImage:
+    """SourceImage sobre el archivo subido (no se carga a memoria ni se pasa a base64)."""
+    return SourceImage(file=file, content_hash=upload_content_hash(file), size=file.size)
@@ -8,6 +8,12 @@ urlpatterns = [
     path('items', views.get_cultural_items, name='get_cultural_items'),
     path('items/<int:id>', views.get_cultural_item_detail, name='get_cultural_item_detail'),
     path('analyze/', views.analyze_cultural_content, name='analyze_cultural_content'),
+    path('analyze/async/', views.analyze_cultural_content_async, name='analyze_cultural_content_async'),
+    path('analyze/stream', views.analyze_cultural_stream, name='analyze_cultural_stream'),
+    path('analyze/batch', views.analyze_cultural_batch, name='analyze_cultural_batch'),
+    path('analyze/jobs', views.submit_analysis_job, name='submit_analysis_job'),
+    path('analyze/jobs/<uuid:job_id>', views.get_analysis_job, name='get_analysis_job'),
+    path('analyze/status', views.get_analysis_status, name='get_analysis_status'),  # Admin only
     path('items/me', views.get_my_cultural_items, name='get_my_cultural_items'),
     
     # Endpoints de reportes
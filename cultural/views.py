@@ -2,25 +2,48 @@
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, renderer_classes
 from rest_framework.permissions import AllowAny, IsAuthenticated, IsAdminUser
-from .services import analyze_cultural_image, OpenAIAnalysisError
+from rest_framework.renderers import JSONRenderer
+from .services import (
+    analyze_cultural_image, aanalyze_cultural_image, iter_batch_analysis,
+    stream_cultural_analysis, get_upstream_stats, get_token_stats, OpenAIAnalysisError
+)
+from .analysis.images import ImagePreparationError
+from .analysis.openai_client import UpstreamUnavailableError
+from .cache import get_analysis_cache_stats
+from .coalescing import get_analysis_flights
+from .metrics import render_metrics
+from .renderers import EventStreamRenderer, NDJSONRenderer, sse_event
 from .serializers import (
     CulturalAnalysisSerializer, 
+    CulturalBatchAnalysisSerializer,
     CulturalItemSerializer, 
     CulturalReportSerializer,
     CulturalReportListSerializer,
-    ApproveReportSerializer
+    ApproveReportSerializer,
+    AnalysisJobSerializer
 )
 
-from .models import CulturalItem, CulturalReport, ReportStatus
+from .models import AnalysisJob, AnalysisJobStatus, CulturalItem, CulturalReport, ReportStatus
+from .jobs import get_job_runner, JobQueueFull
+from .analysis.knowledge import get_knowledge_snapshot
+from .analysis.validation import METODO_EMBEDDINGS, get_embedding_index
 from django.utils import timezone
 import json
 import os
 from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
+import time
 
 import traceback
 
+# OpenAI no disponible (circuito abierto o límite de concurrencia lleno): 503 con retry_after
+UPSTREAM_UNAVAILABLE = UpstreamUnavailableError.code
+
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def create_cultural_item(request):
@@ -101,16 +124,16 @@ def analyze_cultural_content(request):
         
         print("Serializer validado exitosamente")
         
-        # Obtener imagen base64
-        image_base64 = serializer.validated_data['image']
+        # Imagen ya decodificada por el serializer (SourceImage: base64 o archivo subido)
+        image = serializer.validated_data['image']
         ubicacion = serializer.validated_data.get('ubicacion', 'Huánuco, Perú')
         
-        print(f"Imagen base64 recibida (longitud: {len(image_base64)})")
+        print(f"Imagen recibida: {image}")
         print(f"Ubicación: {ubicacion}")
         
         # Realizar análisis
         print("Llamando a analyze_cultural_image...")
-        analysis_result = analyze_cultural_image(image_base64)
+        analysis_result = analyze_cultural_image(image)
         print("Análisis completado exitosamente")
         
         return Response({
@@ -122,28 +145,184 @@ def analyze_cultural_content(request):
     except OpenAIAnalysisError as e:
         error_message = str(e)
         print(f"OpenAIAnalysisError: {error_message}")
+        payload, http_status = _analysis_error_payload(error_message, e.code, e.retry_after)
+        return Response(payload, status=http_status)
         
-        # Si es error de confianza baja, notificar sin datos
-        if "Confianza insuficiente" in error_message:
-            # Extraer la descripción del por qué no califica
-            descripcion = error_message.split('). ', 1)[-1] if '). ' in error_message else error_message
-            
-            return Response({
-                'success': False,
-                'message': 'No se identificó como elemento cultural de Huánuco',
-                'reason': descripcion,
-                'data': None
-            }, status=status.HTTP_200_OK)
-        
-        # Otros errores (API, timeout, auth) siguen siendo 400
+    except Exception as e:
+        print(f"Error inesperado en analyze_cultural_content: {e}")
+        traceback.print_exc()
         return Response({
             'success': False,
+            'message': f'Error interno del servidor: {str(e)}',
+            'data': None
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+def _analysis_error_payload(error_message, code=None, retry_after=None):
+    """Respuesta para OpenAIAnalysisError (compartida por la vista sync y la async)"""
+    # Circuito abierto o demasiadas llamadas en curso: no se llamó a OpenAI
+    if code == UPSTREAM_UNAVAILABLE:
+        return {
+            'success': False,
+            'code': code,
             'message': error_message,
+            'retry_after': retry_after,
             'data': None
-        }, status=status.HTTP_400_BAD_REQUEST)
+        }, status.HTTP_503_SERVICE_UNAVAILABLE
+
+    # Si es error de confianza baja, notificar sin datos
+    if "Confianza insuficiente" in error_message:
+        # Extraer la descripción del por qué no califica
+        descripcion = error_message.split('). ', 1)[-1] if '). ' in error_message else error_message
         
+        return {
+            'success': False,
+            'message': 'No se identificó como elemento cultural de Huánuco',
+            'reason': descripcion,
+            'data': None
+        }, status.HTTP_200_OK
+    
+    # Otros errores (API, timeout, auth) siguen siendo 400
+    return {
+        'success': False,
+        'message': error_message,
+        'data': None
+    }, status.HTTP_400_BAD_REQUEST
+
+
+async def analyze_cultural_content_async(request):
+    """
+    Variante async de analyze_cultural_content para servir con ASGI
+    (uvicorn api.asgi:application): la espera a OpenAI no ocupa un hilo,
+    así un proceso mantiene cientos de análisis en vuelo.
+    Misma entrada y respuesta que /analyze/.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Método no permitido'},
+                            status=status.HTTP_405_METHOD_NOT_ALLOWED)
+    if request.content_type == 'multipart/form-data':
+        # el parseo lee el cuerpo (ya en un temporal) y escribe los archivos: fuera del event loop
+        data = await sync_to_async(lambda: {**request.POST.dict(), **request.FILES.dict()})()
+    else:
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse({'success': False, 'message': 'JSON inválido'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = CulturalAnalysisSerializer(data=data)
+    # decodifica el base64 y Pillow revisa la imagen: fuera del event loop
+    if not await sync_to_async(serializer.is_valid, thread_sensitive=False)():
+        return JsonResponse({
+            'success': False,
+            'message': 'Datos inválidos',
+            'errors': serializer.errors
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        analysis_result = await aanalyze_cultural_image(serializer.validated_data['image'])
+        return JsonResponse({
+            'success': True,
+            'message': 'Análisis completado exitosamente',
+            'data': analysis_result
+        }, status=status.HTTP_200_OK, json_dumps_params={'ensure_ascii': False})
+    except OpenAIAnalysisError as e:
+        payload, http_status = _analysis_error_payload(str(e), e.code, e.retry_after)
+        return JsonResponse(payload, status=http_status, json_dumps_params={'ensure_ascii': False})
+    except Exception as e:
+        traceback.print_exc()
+        return JsonResponse({
+            'success': False,
+            'message': f'Error interno del servidor: {str(e)}',
+            'data': None
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# Django 4.2 no acepta @csrf_exempt sobre vistas async; mismo efecto que en las vistas DRF
+analyze_cultural_content_async.csrf_exempt = True
+
+
+def _streaming_content(request, iterator):
+    """
+    Cuerpo de un StreamingHttpResponse. Bajo ASGI, Django 4.2 junta todo un
+    iterador sync antes de enviarlo: ahí se entrega uno async que avanza el
+    sync en un hilo (cada paso puede esperar a OpenAI), trozo por trozo.
+    """
+    if not isinstance(request._request, ASGIRequest):
+        return iterator
+    step = sync_to_async(next, thread_sensitive=False)
+
+    async def content():
+        done = object()
+        try:
+            while (item := await step(iterator, done)) is not done:
+                yield item
+        finally:
+            # cliente desconectado: cerrar el generador (libera la conexión y los análisis pendientes)
+            await sync_to_async(iterator.close, thread_sensitive=False)()
+    return content()
+
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+def analyze_cultural_stream(request):
+    """
+    Igual que /analyze/ pero responde con Server-Sent Events: un evento "field"
+    por cada campo en cuanto OpenAI lo genera (titulo y categoria primero) y un
+    evento final "result" (análisis validado, mismo cuerpo que /analyze/) o "error".
+    Acepta Accept: text/event-stream y transmite tanto bajo WSGI como bajo ASGI.
+    """
+    serializer = CulturalAnalysisSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response({
+            'success': False,
+            'message': 'Datos inválidos',
+            'errors': serializer.errors
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    events = stream_cultural_analysis(serializer.validated_data['image'])
+
+    def sse():
+        for event, data in events:
+            if event == 'result':
+                data = {'success': True, 'message': 'Análisis completado exitosamente', 'data': data}
+            elif event == 'error':
+                data, _ = _analysis_error_payload(str(data), data.code, data.retry_after)
+            yield sse_event(event, data)
+
+    response = StreamingHttpResponse(_streaming_content(request, sse()), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx no debe acumular los eventos
+    return response
+
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+@renderer_classes([JSONRenderer, NDJSONRenderer])
+def analyze_cultural_batch(request):
+    """
+    Analiza varias imágenes en paralelo (ANALYSIS_BATCH_CONCURRENCY a la vez);
+    las repetidas se analizan una sola vez. Responde todo junto o, con
+    "stream": true (o Accept: application/x-ndjson), una línea NDJSON por
+    imagen a medida que terminan y una última línea con el resumen.
+    """
+    serializer = CulturalBatchAnalysisSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response({
+            'success': False,
+            'message': 'Datos inválidos',
+            'errors': serializer.errors
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    items = serializer.validated_data['images']
+    by_hash, images = {}, {}
+    for index, item in enumerate(items):
+        content_hash = item['image'].content_hash
+        by_hash.setdefault(content_hash, []).append(index)
+        images.setdefault(content_hash, item['image'])
+    t_start = time.perf_counter()
+    try:
+        results = iter_batch_analysis(list(images.values()))
     except Exception as e:
-        print(f"Error inesperado en analyze_cultural_content: {e}")
         traceback.print_exc()
         return Response({
             'success': False,
@@ -151,6 +330,142 @@ def analyze_cultural_content(request):
             'data': None
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def item_results():
+        for content_hash, analysis, error in results:
+            for index in by_hash[content_hash]:
+                entry = {'index': index, 'id': items[index]['id'], 'hash': content_hash}
+                if error is None:
+                    entry.update({'success': True, 'data': analysis})
+                else:
+                    payload, _ = _analysis_error_payload(str(error), error.code, error.retry_after)
+                    entry.update(payload)
+                yield entry
+
+    def summary(entries_ok, entries_failed):
+        return {
+            'total': len(items),
+            'unique': len(by_hash),
+            'succeeded': entries_ok,
+            'failed': entries_failed,
+            'elapsed_ms': round((time.perf_counter() - t_start) * 1000, 1),
+        }
+
+    stream = serializer.validated_data['stream'] or isinstance(request.accepted_renderer, NDJSONRenderer)
+    if stream:
+        def ndjson():
+            ok = failed = 0
+            for entry in item_results():
+                ok, failed = (ok + 1, failed) if entry['success'] else (ok, failed + 1)
+                yield json.dumps(entry, ensure_ascii=False) + '\n'
+            yield json.dumps({'done': True, **summary(ok, failed)}, ensure_ascii=False) + '\n'
+        return StreamingHttpResponse(_streaming_content(request, ndjson()), content_type='application/x-ndjson')
+
+    entries = sorted(item_results(), key=lambda e: e['index'])
+    ok = sum(1 for e in entries if e['success'])
+    return Response({
+        'success': True,
+        'message': 'Lote analizado',
+        'data': {'results': entries, **summary(ok, len(entries) - ok)}
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes([AllowAny])
+def submit_analysis_job(request):
+    """
+    Encola el análisis y responde de inmediato con el id del trabajo.
+    El resultado se consulta en /analyze/jobs/<job_id>.
+    """
+    serializer = CulturalAnalysisSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response({
+            'success': False,
+            'message': 'Datos inválidos',
+            'errors': serializer.errors
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        # el trabajo guarda la imagen ya reducida, no la recibida
+        job = get_job_runner().submit(serializer.validated_data['image'], user=request.user)
+    except JobQueueFull as e:
+        return Response({
+            'success': False,
+            'message': str(e),
+            'data': None
+        }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    except ImagePreparationError as e:
+        return Response({
+            'success': False,
+            'message': str(e),
+            'data': None
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response({
+        'success': True,
+        'message': 'Análisis encolado',
+        'data': AnalysisJobSerializer(job).data
+    }, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def get_analysis_job(request, job_id):
+    """
+    Estado de un trabajo. Al completarse, 'data' trae el mismo resultado que /analyze/;
+    si falló, la respuesta es la misma que daría /analyze/ con ese error.
+    """
+    job = AnalysisJob.objects.filter(id=job_id).first()
+    if job is not None and job.status in (AnalysisJobStatus.PENDIENTE, AnalysisJobStatus.PROCESANDO):
+        # quien consulta un trabajo sin terminar dispara la recuperación (limitada por intervalo)
+        get_job_runner().recover()
+    if job is None or (job.expires_at and job.expires_at < timezone.now()):
+        return Response({
+            'success': False,
+            'message': 'Trabajo no encontrado o expirado'
+        }, status=status.HTTP_404_NOT_FOUND)
+
+    job_data = AnalysisJobSerializer(job).data
+    if job.status == AnalysisJobStatus.COMPLETADO:
+        return Response({
+            'success': True,
+            'message': 'Análisis completado exitosamente',
+            'job': job_data,
+            'data': job.result
+        }, status=status.HTTP_200_OK)
+
+    if job.status == AnalysisJobStatus.FALLIDO:
+        payload, http_status = _analysis_error_payload(job.error)
+        payload['job'] = job_data
+        return Response(payload, status=http_status)
+
+    return Response({
+        'success': True,
+        'message': 'Análisis en proceso',
+        'job': job_data,
+        'data': None
+    }, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def get_analysis_status(request):
+    """Estado del análisis en este proceso: circuito y concurrencia hacia OpenAI, cachés y agrupación."""
+    return Response({
+        'success': True,
+        'data': {
+            'upstream': get_upstream_stats(),
+            'tokens': get_token_stats(),
+            'cache': get_analysis_cache_stats(),
+            'coalescing': get_analysis_flights().stats(),
+        }
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def get_metrics(request):
+    """Métricas de todos los workers en formato de texto de Prometheus (ver cultural/metrics.py)."""
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # =============== ENDPOINTS DE REPORTES ===============
 
 @api_view(['POST'])
@@ -390,6 +705,12 @@ def add_to_elementos_json(cultural_item):
             with open(json_path, 'w', encoding='utf-8') as f:
                 json.dump(elementos, f, ensure_ascii=False, indent=2)
             
+            # Publicar el nuevo snapshot sin esperar al siguiente análisis; si la validación
+            # usa embeddings, aquí se agrega al .npy solo la fila nueva (no en la petición que lo lea)
+            snapshot = get_knowledge_snapshot(force=True)
+            if getattr(settings, 'LOCAL_VALIDATION_METHOD', None) == METODO_EMBEDDINGS:
+                get_embedding_index(snapshot)
+            
             print(f"Elemento '{cultural_item.titulo}' agregado a elementos_huanuco.json")
             return True
         else: